@@ -0,0 +1,31 @@
+"""query cache
+
+Revision ID: 2b8f6a1c9d3e
+Revises: 07ec7ca54c2f
+Create Date: 2026-10-18 09:12:40.318214
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from adsputils import UTCDateTime
+
+
+# revision identifiers, used by Alembic.
+revision = '2b8f6a1c9d3e'
+down_revision = '07ec7ca54c2f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('query_cache',
+                    sa.Column('key', sa.String(40), primary_key=True),
+                    sa.Column('run_id', sa.String(64)),
+                    sa.Column('results', sa.Text),
+                    sa.Column('hits', sa.Integer, default=0),
+                    sa.Column('created', UTCDateTime),
+                    )
+
+
+def downgrade():
+    op.drop_table('query_cache')
@@ -0,0 +1,29 @@
+"""setup mirror
+
+Revision ID: 3f9c7b2e5d18
+Revises: 8a4d2e6b1f57
+Create Date: 2026-10-18 16:02:37.218349
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from adsputils import UTCDateTime
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9c7b2e5d18'
+down_revision = '8a4d2e6b1f57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('setups',
+                    sa.Column('user_id', sa.Integer, primary_key=True),
+                    sa.Column('setups', sa.Text),
+                    sa.Column('updated', UTCDateTime),
+                    )
+
+
+def downgrade():
+    op.drop_table('setups')
@@ -0,0 +1,65 @@
+"""seen results
+
+Revision ID: 5c3e1d7f0a42
+Revises: 2b8f6a1c9d3e
+Create Date: 2026-10-18 11:02:17.524431
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import Column, Integer, ARRAY, String
+from adsputils import UTCDateTime
+
+
+# revision identifiers, used by Alembic.
+revision = '5c3e1d7f0a42'
+down_revision = '2b8f6a1c9d3e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('seen_results',
+                    Column('id', Integer, primary_key=True),
+                    Column('user_id', Integer),
+                    Column('query_key', String(40)),
+                    Column('bibcode', String(19)),
+                    Column('created', UTCDateTime),
+                    sa.UniqueConstraint('user_id', 'query_key', 'bibcode', name='seen_results_user_query_bibcode_key'),
+                    )
+
+    # one row per bibcode, keeping the date it was first stored
+    op.execute("""
+        INSERT INTO seen_results (user_id, query_key, bibcode, created)
+        SELECT user_id, COALESCE(qid, 'setup:' || setup_id), bibcode, min(created)
+        FROM results, unnest(results) AS bibcode
+        WHERE qid IS NOT NULL OR setup_id IS NOT NULL
+        GROUP BY 1, 2, 3
+        """)
+
+    op.drop_table('results')
+
+
+def downgrade():
+    op.create_table('results',
+                    Column('id', Integer, primary_key=True),
+                    Column('user_id', Integer),
+                    Column('qid', String(32)),
+                    Column('results', ARRAY(String)),
+                    Column('created', UTCDateTime),
+                    Column('setup_id', Integer),
+                    )
+
+    # bibcodes first seen in the same run go back into the same row
+    op.execute("""
+        INSERT INTO results (user_id, qid, setup_id, results, created)
+        SELECT user_id,
+               CASE WHEN query_key LIKE 'setup:%' THEN NULL ELSE query_key END,
+               CASE WHEN query_key LIKE 'setup:%' THEN CAST(substring(query_key FROM 7) AS integer) ELSE NULL END,
+               array_agg(bibcode),
+               created
+        FROM seen_results
+        GROUP BY user_id, query_key, created
+        """)
+
+    op.drop_table('seen_results')
@@ -0,0 +1,31 @@
+"""setup frequency flags
+
+Revision ID: 6e2a9d4c8b31
+Revises: 3f9c7b2e5d18
+Create Date: 2026-10-18 17:11:05.634120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e2a9d4c8b31'
+down_revision = '3f9c7b2e5d18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('setups', sa.Column('daily', sa.Boolean))
+    op.add_column('setups', sa.Column('weekly', sa.Boolean))
+
+    # fill in the flags of the setups already mirrored
+    op.execute("UPDATE setups SET "
+               "daily = EXISTS (SELECT 1 FROM json_array_elements(setups::json) s WHERE s->>'frequency' = 'daily'), "
+               "weekly = EXISTS (SELECT 1 FROM json_array_elements(setups::json) s WHERE s->>'frequency' = 'weekly')")
+
+
+def downgrade():
+    op.drop_column('setups', 'weekly')
+    op.drop_column('setups', 'daily')
@@ -0,0 +1,29 @@
+"""email cache
+
+Revision ID: 8a4d2e6b1f57
+Revises: 5c3e1d7f0a42
+Create Date: 2026-10-18 13:26:51.904712
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from adsputils import UTCDateTime
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4d2e6b1f57'
+down_revision = '5c3e1d7f0a42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('emails',
+                    sa.Column('user_id', sa.Integer, primary_key=True),
+                    sa.Column('email', sa.String(255)),
+                    sa.Column('updated', UTCDateTime),
+                    )
+
+
+def downgrade():
+    op.drop_table('emails')
@@ -0,0 +1,43 @@
+"""query cache run key
+
+Revision ID: b4e7a2d9c6f1
+Revises: 6e2a9d4c8b31
+Create Date: 2026-10-18 21:04:52.170863
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from adsputils import UTCDateTime
+
+
+# revision identifiers, used by Alembic.
+revision = 'b4e7a2d9c6f1'
+down_revision = '6e2a9d4c8b31'
+branch_labels = None
+depends_on = None
+
+
+# the cache only holds results for runs in progress, so it's recreated empty rather than converted
+def upgrade():
+    op.drop_table('query_cache')
+    op.create_table('query_cache',
+                    sa.Column('run_id', sa.String(64), primary_key=True),
+                    sa.Column('key', sa.String(40), primary_key=True),
+                    sa.Column('results', sa.Text),
+                    sa.Column('created', UTCDateTime),
+                    sa.Column('last_used', UTCDateTime),
+                    )
+    # least recently used entries of a run are looked up for eviction
+    op.create_index('query_cache_run_last_used_idx', 'query_cache', ['run_id', 'last_used'])
+
+
+def downgrade():
+    op.drop_index('query_cache_run_last_used_idx', 'query_cache')
+    op.drop_table('query_cache')
+    op.create_table('query_cache',
+                    sa.Column('key', sa.String(40), primary_key=True),
+                    sa.Column('run_id', sa.String(64)),
+                    sa.Column('results', sa.Text),
+                    sa.Column('hits', sa.Integer, default=0),
+                    sa.Column('created', UTCDateTime),
+                    )
@@ -0,0 +1,28 @@
+"""email cache expiry
+
+Revision ID: c8f3e5a1b7d2
+Revises: b4e7a2d9c6f1
+Create Date: 2026-10-18 21:47:13.592704
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from adsputils import UTCDateTime
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8f3e5a1b7d2'
+down_revision = 'b4e7a2d9c6f1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('emails', sa.Column('expires', UTCDateTime))
+
+    # spread the expiry of the addresses already cached over the second half of the default TTL of 7 days
+    op.execute("UPDATE emails SET expires = updated + (3.5 + 3.5 * random()) * interval '1 day'")
+
+
+def downgrade():
+    op.drop_column('emails', 'expires')
@@ -0,0 +1,25 @@
+"""setup builder version
+
+Revision ID: d7c1f4a8e2b9
+Revises: f5b9d3e7a2c4
+Create Date: 2026-10-19 10:26:48.310572
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7c1f4a8e2b9'
+down_revision = 'f5b9d3e7a2c4'
+branch_labels = None
+depends_on = None
+
+
+# setups mirrored so far have no builder version, so they're fetched from vault again
+def upgrade():
+    op.add_column('setups', sa.Column('builder_version', sa.Integer))
+
+
+def downgrade():
+    op.drop_column('setups', 'builder_version')
@@ -0,0 +1,34 @@
+"""arxiv categories
+
+Revision ID: f5b9d3e7a2c4
+Revises: c8f3e5a1b7d2
+Create Date: 2026-10-19 00:41:37.208164
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from adsputils import UTCDateTime
+
+
+# revision identifiers, used by Alembic.
+revision = 'f5b9d3e7a2c4'
+down_revision = 'c8f3e5a1b7d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('arxiv_categories',
+                    sa.Column('run_id', sa.String(64), primary_key=True),
+                    sa.Column('arxiv_class', sa.String(64), primary_key=True),
+                    sa.Column('start', sa.String(16)),
+                    sa.Column('results', sa.Text),
+                    sa.Column('created', UTCDateTime),
+                    )
+    # cached query results are stored in compact form from now on; the cache only lasts for a run anyway
+    op.execute('DELETE FROM query_cache')
+
+
+def downgrade():
+    op.drop_table('arxiv_categories')
+    op.execute('DELETE FROM query_cache')
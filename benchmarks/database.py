@@ -0,0 +1,43 @@
+"""Scratch database used by the benchmarks, kept apart from the database the pipeline is configured with"""
+
+import os
+
+from alembic import command
+from alembic.config import Config
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+
+PROJ_HOME = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def _same_database(url, other):
+    url, other = make_url(url), make_url(other)
+    return (url.host, url.port, url.database) == (other.host, other.port, other.database)
+
+
+def use_scratch_database(url=None, apps=()):
+    """
+    Brings a scratch database up to the latest migration and points the given apps at it. The benchmarks write
+    synthetic rows and drop indexes, so the database configured in SQLALCHEMY_URL is refused
+    :param url: SQLAlchemy URL of the scratch database; the database must exist
+    :param apps: myADSCelery apps whose sessions are moved to the scratch database
+    :return: no return
+    """
+    for app in apps:
+        if _same_database(url, app._config.get('SQLALCHEMY_URL')):
+            raise ValueError('{0} is the database configured in SQLALCHEMY_URL; '
+                             'the benchmarks must be run against a scratch database'.format(make_url(url)))
+
+    cfg = Config(os.path.join(PROJ_HOME, 'alembic.ini'))
+    cfg.set_main_option('script_location', os.path.join(PROJ_HOME, 'alembic'))
+    cfg.set_main_option('use_flask_db_url', 'false')
+    # the ini parser reads % as the start of an interpolation
+    cfg.set_main_option('sqlalchemy.url', str(url).replace('%', '%%'))
+    command.upgrade(cfg, 'head')
+
+    for app in apps:
+        app._session.remove()
+        app._engine.dispose()
+        app._engine = create_engine(url, echo=app._config.get('SQLALCHEMY_ECHO', False))
+        app._session.configure(bind=app._engine)
+        app._config['SQLALCHEMY_URL'] = url
@@ -0,0 +1,239 @@
+"""Local stand-ins for the vault, Solr, adsws and SMTP services, used by the benchmarks"""
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+import asyncore
+import hashlib
+import json
+import random
+import smtpd
+import threading
+import time
+import urlparse
+
+ARXIV_CLASSES = ['astro-ph.GA', 'astro-ph.CO', 'astro-ph.EP', 'astro-ph.HE', 'astro-ph.IM', 'astro-ph.SR',
+                 'gr-qc', 'hep-ph', 'physics.space-ph']
+
+
+def make_setup(user_id, frequency='daily', seed=0):
+    """
+    Builds a synthetic myADS setup for a user, mixing arxiv, citations, keyword, authors and general queries
+    :param user_id: int
+    :param frequency: 'daily' or 'weekly'; daily setups are mostly arxiv queries
+    :param seed: random seed, so that setups are reproducible between runs
+    :return: list of setups, as returned by /vault/get-myads
+    """
+    rand = random.Random(seed * 1000003 + user_id)
+    setup = []
+    setup_id = user_id * 100
+    # arxiv queries are shared between many users: draw classes and keywords from small pools
+    num_arxiv = 1 if frequency == 'daily' else rand.choice([0, 1])
+    for _ in range(num_arxiv):
+        setup_id += 1
+        classes = sorted(rand.sample(ARXIV_CLASSES[:6], rand.choice([1, 1, 2])))
+        keywords = rand.choice([None, None, 'galaxies', 'exoplanets', 'dark matter'])
+        classes_q = 'arxiv_class:({0})'.format(' OR '.join(classes))
+        date_q = 'entdate:["2020-01-01Z00:00" TO "2020-01-01Z23:59"] pubdate:[2019-00 TO *]'
+        if keywords:
+            query = [{'q': 'bibstem:arxiv ({0} ({1})) {2}'.format(classes_q, keywords, date_q),
+                      'sort': 'score desc, bibcode desc'},
+                     {'q': 'bibstem:arxiv ({0} NOT ({1})) {2}'.format(classes_q, keywords, date_q),
+                      'sort': 'bibcode desc'}]
+        else:
+            query = [{'q': 'bibstem:arxiv {0} {1}'.format(classes_q, date_q),
+                      'sort': 'bibcode desc'}]
+        setup.append({'id': setup_id, 'name': 'arXiv - {0}'.format(', '.join(classes)), 'qid': None,
+                      'active': True, 'stateful': False, 'frequency': 'daily', 'type': 'template',
+                      'template': 'arxiv', 'data': keywords, 'classes': classes, 'query': query})
+
+    if frequency == 'weekly' or rand.random() < 0.2:
+        for _ in range(rand.randint(1, 4)):
+            setup_id += 1
+            author = 'Author{0}, A'.format(rand.randint(0, 5000))
+            template = rand.choice(['citations', 'keyword', 'authors', 'query'])
+            if template == 'citations':
+                setup.append({'id': setup_id, 'name': author, 'qid': None, 'active': True, 'stateful': True,
+                              'frequency': frequency, 'type': 'template', 'template': 'citations',
+                              'data': 'author:"{0}"'.format(author),
+                              'query': [{'q': 'citations(author:"{0}")'.format(author),
+                                         'sort': 'entry_date desc, bibcode desc'}]})
+            elif template == 'keyword':
+                keyword = rand.choice(['AGN', 'supernovae', 'star formation', 'cosmology', 'exoplanets'])
+                setup.append({'id': setup_id, 'name': keyword, 'qid': None, 'active': True, 'stateful': False,
+                              'frequency': frequency, 'type': 'template', 'template': 'keyword', 'data': keyword,
+                              'query': [{'q': '{0} entdate:[NOW-7DAYS TO NOW]'.format(keyword),
+                                         'sort': 'entry_date desc, bibcode desc'},
+                                        {'q': 'trending({0})'.format(keyword), 'sort': 'score desc, bibcode desc'},
+                                        {'q': 'useful({0})'.format(keyword), 'sort': 'score desc, bibcode desc'}]})
+            elif template == 'authors':
+                setup.append({'id': setup_id, 'name': 'Favorite Authors', 'qid': None, 'active': True,
+                              'stateful': True, 'frequency': frequency, 'type': 'template', 'template': 'authors',
+                              'data': 'author:"{0}"'.format(author),
+                              'query': [{'q': 'author:"{0}" entdate:[NOW-7DAYS TO NOW]'.format(author),
+                                         'sort': 'score desc, bibcode desc'}]})
+            else:
+                setup.append({'id': setup_id, 'name': 'Query {0}'.format(setup_id),
+                              'qid': hashlib.md5(str(setup_id)).hexdigest(), 'active': True,
+                              'stateful': rand.choice([True, False]), 'frequency': frequency, 'type': 'query'})
+
+    return setup
+
+
+def make_docs(query, num_docs, num_authors=8):
+    """
+    Builds a deterministic list of Solr docs for a query, so that identical queries get identical results
+    :param query: query string
+    :param num_docs: number of docs to return
+    :param num_authors: number of authors per doc
+    :return: list of docs
+    """
+    prefix = hashlib.md5(query.encode('utf-8')).hexdigest()[:6]
+    docs = []
+    for i in range(num_docs):
+        n = (int(prefix, 16) + i) % 100000
+        number = '2001.{0:05d}'.format(n)
+        bibcode = '2020arXiv2001{0:05d}K'.format(n)
+        docs.append({'bibcode': bibcode,
+                     'title': ['Synthetic paper {0} for {1}'.format(i, prefix)],
+                     'author_norm': ['Author{0}, {1}'.format(j, chr(65 + j % 26)) for j in range(num_authors)],
+                     'identifier': [bibcode, 'arXiv:{0}'.format(number)],
+                     'year': '2020',
+                     'bibstem': ['arXiv']})
+    return docs
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        services = self.server.services
+        time.sleep(services.latency)
+        services.count(self.path)
+        url = urlparse.urlparse(self.path)
+        params = dict((k, v[0]) for k, v in urlparse.parse_qs(url.query).items())
+
+        if url.path.startswith('/v1/vault/get-myads/'):
+            user_id = int(url.path.rstrip('/').split('/')[-1])
+            body = make_setup(user_id, frequency=services.frequency, seed=services.seed)
+        elif url.path.startswith('/v1/vault/execute_query/'):
+            qid = url.path.rstrip('/').split('/')[-1]
+            rows = min(int(params.get('rows', 5)), services.num_results)
+            body = {'responseHeader': {'params': {'q': 'docs({0})'.format(qid), 'fl': params.get('fl'),
+                                                  'sort': params.get('sort')}},
+                    'response': {'numFound': services.num_results, 'start': 0, 'docs': make_docs(qid, rows)}}
+        elif url.path.startswith('/v1/search/query'):
+            if params.get('stats'):
+                body = {'response': {'numFound': 1, 'docs': []},
+                        'stats': {'stats_fields': {'citation_count': {'sum': 42.0}}}}
+            else:
+                rows = min(int(params.get('rows', 10)), services.num_results)
+                body = {'responseHeader': {'params': params},
+                        'response': {'numFound': services.num_results, 'start': 0,
+                                     'docs': make_docs(params.get('q', ''), rows)}}
+        elif url.path.startswith('/v1/user/'):
+            user_id = url.path.rstrip('/').split('/')[-1]
+            body = {'id': user_id, 'email': 'user{0}@example.com'.format(user_id)}
+        else:
+            return self._reply(json.dumps({'error': 'not found'}), status=404)
+
+        self._reply(json.dumps(body))
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _SMTPServer(smtpd.SMTPServer):
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        time.sleep(self.services.smtp_latency)
+        self.services.count('smtp')
+
+
+class LocalServices(object):
+    """
+    Runs fake vault/Solr/adsws (HTTP) and SMTP endpoints on localhost, in background threads
+    """
+
+    def __init__(self, latency=0.05, smtp_latency=0.01, num_results=50, frequency='daily', seed=0):
+        """
+        :param latency: delay added to every HTTP request (units=seconds)
+        :param smtp_latency: delay added to every message received over SMTP (units=seconds)
+        :param num_results: maximum number of docs returned per query
+        :param frequency: 'daily' or 'weekly'; frequency of the generated setups
+        :param seed: random seed for the generated setups
+        """
+        self.latency = latency
+        self.smtp_latency = smtp_latency
+        self.num_results = num_results
+        self.frequency = frequency
+        self.seed = seed
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._http = None
+        self._smtp = None
+        self._smtp_thread = None
+        self._running = False
+
+    def count(self, path):
+        key = path.split('?')[0].rsplit('/', 1)[0] if path != 'smtp' else path
+        with self._lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def start(self):
+        self._http = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._http.services = self
+        http_thread = threading.Thread(target=self._http.serve_forever)
+        http_thread.daemon = True
+        http_thread.start()
+
+        self._smtp = _SMTPServer(('127.0.0.1', 0), None)
+        self._smtp.services = self
+        self._running = True
+        self._smtp_thread = threading.Thread(target=self._smtp_loop)
+        self._smtp_thread.daemon = True
+        self._smtp_thread.start()
+
+    def _smtp_loop(self):
+        while self._running:
+            asyncore.loop(timeout=0.1, count=1)
+
+    def stop(self):
+        self._http.shutdown()
+        self._running = False
+        self._smtp_thread.join()
+        asyncore.close_all()
+
+    @property
+    def api_endpoint(self):
+        return 'http://127.0.0.1:{0}'.format(self._http.server_address[1])
+
+    @property
+    def smtp_port(self):
+        return self._smtp.socket.getsockname()[1]
+
+    def config(self):
+        """
+        :return: dict of config values pointing the pipeline to the local services
+        """
+        api = self.api_endpoint
+        return {'API_ENDPOINT': api,
+                'API_SOLR_QUERY_ENDPOINT': api + '/v1/search/query/',
+                'API_VAULT_MYADS_USERS': api + '/v1/vault/myads-users/%s',
+                'API_VAULT_MYADS_SETUP': api + '/v1/vault/get-myads/%s',
+                'API_VAULT_EXECUTE_QUERY': api + '/v1/vault/execute_query/%s?fl=%s&rows=%s&sort=%s',
+                'API_ADSWS_USER_EMAIL': api + '/v1/user/%s',
+                'MAIL_SERVER': '127.0.0.1',
+                'MAIL_PORT': self.smtp_port,
+                'MAIL_USE_TLS': False,
+                'MAIL_USERNAME': None,
+                'MAIL_PASSWORD': None}
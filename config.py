@@ -30,11 +30,61 @@ STATEFUL_RESULTS_DAYS = 7
 # Number of queries to switch from one to two column email format
 NUM_QUERIES_TWO_COL = 3
 
+# Number of threads used to run a user's queries concurrently (1 runs them one after another)
+MYADS_QUERY_THREADS = 4
+
 # Reschedule sending if there's an error (units=seconds)
 MYADS_RESEND_WINDOW = 60*10
 # Reschedule sending if there's an error with Solr (units=seconds)
 MYADS_SOLR_RESEND_WINDOW = 60*15
 TOTAL_RETRIES = 3
+# A successful check that the Solr searchers were updated is shared by all tasks for this long (units=seconds)
+SOLR_READY_TTL = 60*10
+
+# Number of users read from or inserted into the authors table per batch
+USERS_CHUNK_SIZE = 1000
+
+# Number of processing tasks published per chunk by run.py
+DISPATCH_CHUNK_SIZE = 500
+# Dispatch is paused while more messages than this are waiting in the process queue
+DISPATCH_MAX_QUEUE_DEPTH = 20000
+# Pause between queue depth checks, and base delay between publish retries (units=seconds)
+DISPATCH_THROTTLE_DELAY = 5
+DISPATCH_RETRIES = 3
+
+# Shared cache of templated query results, valid for a single processing run
+QUERY_CACHE_MAX_ENTRIES = 5000
+# Maximum age of a cache entry; older entries are removed at the start of each run (units=seconds)
+QUERY_CACHE_TTL = 60*60*12
+# Entries are evicted by last use, which is only written on a hit if it's older than this (units=seconds)
+QUERY_CACHE_TOUCH_INTERVAL = 60
+
+# Number of concurrent vault requests when syncing the local mirror of myADS setups before dispatch
+SETUP_SYNC_THREADS = 8
+# Number of mirrored users whose locally built templated queries are checked against vault at each sync
+SETUP_CHECK_SAMPLE_SIZE = 50
+
+# Number of days covered by templated queries: daily queries run on Mondays (to include the weekend), and weekly
+# queries; must match vault, as templated queries are built locally from the mirrored setups
+MYADS_DAILY_TIME_RANGE = 2
+MYADS_WEEKLY_TIME_RANGE = 6
+
+# The new papers of each arXiv category in the daily setups are fetched once per daily run, as far back as daily
+# queries go (MYADS_DAILY_TIME_RANGE), and queries on categories alone are assembled from them
+# Maximum number of papers fetched per arXiv category; larger categories are left to Solr
+ARXIV_CATEGORY_ROWS = 5000
+# Total number of papers in the parsed arXiv category lists kept by each worker process
+ARXIV_CATEGORY_CACHE_SIZE = 100000
+
+# Queries returning more rows than this are fetched from Solr in pages of this size, using cursorMark
+SOLR_PAGE_SIZE = 500
+
+# Email addresses are cached locally and fetched again from adsws by the processing task after this long
+# (units=seconds)
+EMAIL_CACHE_TTL = 60*60*24*7
+# Each cached address expires at a random time between (1 - EMAIL_CACHE_TTL_JITTER) * EMAIL_CACHE_TTL and
+# EMAIL_CACHE_TTL, so that addresses cached in the same run don't all expire in the same later run
+EMAIL_CACHE_TTL_JITTER = 0.5
 
 # Number of days back, from today, to check for new records
 ARXIV_TIMEDELTA_DAYS = 1
@@ -46,10 +96,43 @@ ARXIV_UPDATE_AGENT_DIR = ARXIV_INCOMING_ABS_DIR + '/UpdateAgent'
 
 # Directory for incoming astronomy articles
 ASTRO_INCOMING_DIR = '/proj/ads/abstracts/ast/index/current/'
-ASTRO_SAMPLE_SIZE = 3
+# Number of bibcodes sampled from the astronomy ingest file and checked in Solr, with a single query
+ASTRO_SAMPLE_SIZE = 10
+# Fraction of the sampled bibcodes that must be found in Solr for the astronomy ingest to count as complete
+ASTRO_SAMPLE_READY_FRACTION = 0.8
+
+# Ingest files are checked as soon as they change (with pyinotify, if installed) and, since changes made over
+# network filesystems aren't always notified, at least this often (units=seconds)
+INGEST_POLL_INTERVAL = 30
+# First delay between Solr readiness probes; the delay doubles after each failed probe (units=seconds)
+SOLR_PROBE_MIN_DELAY = 15
+
+# Directory where the compiled email templates are stored, so that workers starting up don't compile them again; a
+# per-user temporary directory is used if None
+TEMPLATE_CACHE_DIR = None
+# Number of rendered results (about 1 kB each) kept by each worker process, so that papers included in many emails
+# are only formatted once
+RESULT_CACHE_SIZE = 20000
+# Total size of the rendered query sections kept by each worker process, so that sections shared by many users (e.g.
+# arXiv categories) are only rendered once (units=characters)
+SECTION_CACHE_SIZE = 10000000
 
 MAIL_DEFAULT_SENDER = 'ads@cfa.harvard.edu'
 MAIL_PASSWORD = None
 MAIL_PORT = 25
 MAIL_SERVER = None
-MAIL_USERNAME = None
\ No newline at end of file
+MAIL_USERNAME = None
+# SMTP connections are pooled and reused across tasks within each worker process
+MAIL_POOL_SIZE = 2
+# Number of messages sent on a single connection before it is recycled
+MAIL_POOL_MAX_MESSAGES = 100
+# Idle connections older than this are assumed closed by the server and reopened (units=seconds)
+MAIL_POOL_MAX_IDLE = 60
+# Emails are assembled in memory up to this size, and in a temporary file beyond it (units=bytes)
+MAIL_SPOOL_SIZE = 1048576
+
+# Directory where each worker process writes its stage timings, in the Prometheus text format (e.g. the
+# node_exporter textfile collector directory); metrics are not written if None
+METRICS_DIR = None
+# Minimum time between metrics writes of a worker process (units=seconds)
+METRICS_FLUSH_INTERVAL = 30
@@ -1,9 +1,13 @@
-from adsputils import get_date, ADSCelery
-from .models import AuthorInfo, Results
+from adsputils import get_date, ADSCelery, UTCDateTime
+from .models import ArxivCategory, AuthorInfo, KeyValue, QueryCache, UserEmail, UserSetup
+from . import queries
 
 from datetime import timedelta
-from sqlalchemy.sql.expression import and_
-from sqlalchemy.orm import exc as ormexc
+from sqlalchemy import Integer, String
+from sqlalchemy.sql.expression import and_, func, select, text, bindparam
+from sqlalchemy.dialects.postgresql import insert
+import json
+import random
 
 
 class myADSCelery(ADSCelery):
@@ -17,8 +21,11 @@ class myADSCelery(ADSCelery):
 
         user_ids = set()
         with self.session_scope() as session:
-            for q in session.query(AuthorInfo).filter(AuthorInfo.last_sent < get_date()).all():
-                user_ids.add(q.id)
+            # stream only the IDs through a server-side cursor
+            q = session.query(AuthorInfo.id).filter(AuthorInfo.last_sent < get_date()).\
+                execution_options(stream_results=True).yield_per(self._config.get('USERS_CHUNK_SIZE', 1000))
+            for (user_id,) in q:
+                user_ids.add(user_id)
 
         r = self.client.get(self._config.get('API_VAULT_MYADS_USERS') % get_date(since).isoformat(),
                             headers={'Accept': 'application/json',
@@ -29,15 +36,17 @@ class myADSCelery(ADSCelery):
             self.logger.warning('Error getting new myADS users from API')
         else:
             new_users = r.json()['users']
-            for n in new_users:
-                try:
-                    q = session.query(AuthorInfo).filter_by(id=n).one()
-                except ormexc.NoResultFound:
-                    author = AuthorInfo(id=n, created=get_date(), last_sent=None)
-                    with self.session_scope() as session:
-                        session.add(author)
-                        session.commit()
-                user_ids.add(n)
+            chunk_size = self._config.get('USERS_CHUNK_SIZE', 1000)
+            now = get_date()
+            with self.session_scope() as session:
+                # users already in the authors table are left untouched
+                for i in range(0, len(new_users), chunk_size):
+                    session.execute(insert(AuthorInfo.__table__).
+                                    values([{'id': n, 'created': now, 'last_sent': None}
+                                            for n in new_users[i:i + chunk_size]]).
+                                    on_conflict_do_nothing(index_elements=['id']))
+                session.commit()
+            user_ids.update(new_users)
 
         return list(user_ids)
 
@@ -60,51 +69,376 @@ class myADSCelery(ADSCelery):
             self.logger.warning('Must pass either qid or setup ID to get recent results. User: {0}'.format(user_id))
             return None
 
+        if qid:
+            query_key = qid
+        else:
+            query_key = 'setup:{0}'.format(setup_id)
+
+        # output: input results not first seen before ndays ago - this is returned
+        # the output results are then upserted, so results already seen keep their first-seen date
+        sql = text("""
+            WITH output AS (
+                SELECT DISTINCT i.bibcode
+                FROM unnest(CAST(:input_results AS varchar[])) AS i(bibcode)
+                WHERE NOT EXISTS (SELECT 1 FROM seen_results s
+                                  WHERE s.user_id = :user_id AND s.query_key = :query_key
+                                  AND s.bibcode = i.bibcode AND s.created < :ndays_date)
+            ), inserted AS (
+                INSERT INTO seen_results (user_id, query_key, bibcode, created)
+                SELECT :user_id, :query_key, o.bibcode, :now
+                FROM output o
+                ON CONFLICT (user_id, query_key, bibcode) DO NOTHING
+            )
+            SELECT bibcode FROM output
+            """).bindparams(bindparam('user_id', type_=Integer),
+                            bindparam('query_key', type_=String),
+                            bindparam('now', type_=UTCDateTime),
+                            bindparam('ndays_date', type_=UTCDateTime))
+
         now = get_date()
-        ndays_date = now - timedelta(days=ndays)
-        old_results = set()
-        with self.session_scope() as session:
-            # get stored results older than ndays old
-            if qid:
-                q = session.query(Results).filter(and_(Results.qid == qid,
-                                                       Results.user_id == user_id,
-                                                       Results.created < ndays_date)).all()
-            else:
-                q = session.query(Results).filter(and_(Results.setup_id == setup_id,
-                                                       Results.user_id == user_id,
-                                                       Results.created < ndays_date)).all()
-
-            for res in q:
-                old_results.update(res.results)
-
-            # remove results older than ndays old - this is returned
-            output_results = set(input_results).difference(old_results)
-
-            # now remove the rest of the stored results, so we're not storing any overlap
-            if qid:
-                r = session.query(Results).filter(and_(Results.qid == qid,
-                                                       Results.user_id == user_id,
-                                                       Results.created >= ndays_date))
-            else:
-                r = session.query(Results).filter(and_(Results.setup_id == setup_id,
-                                                       Results.user_id == user_id,
-                                                       Results.created >= ndays_date))
-
-            for res in r.all():
-                old_results.update(res.results)
-
-            # remove all results currently stored for this query - this is stored
-            new_results = list(output_results.difference(old_results))
-
-            # don't store empty results sets
-            if new_results:
-                if qid:
-                    results = Results(user_id=user_id, qid=qid, results=new_results, created=now)
-                else:
-                    results = Results(user_id=user_id, setup_id=setup_id, results=new_results, created=now)
-
-                session.add(results)
-                session.commit()
+        with self.session_scope() as session:
+            output_results = [row[0] for row in session.execute(sql, {'user_id': user_id,
+                                                                      'query_key': query_key,
+                                                                      'input_results': list(input_results),
+                                                                      'now': now,
+                                                                      'ndays_date': now - timedelta(days=ndays)})]
+            session.commit()
 
         # note that old results will be returned if the bibcode has changed; it's a feature not a bug
-        return list(output_results)
+        return output_results
+
+    def get_cached_query(self, key=None, run_id=None):
+        """
+        Fetches the cached results of a query for the current processing run. Hits are plain reads, so that workers
+        running the same query don't wait on each other; the last use of the entry is only written if it's older than
+        QUERY_CACHE_TOUCH_INTERVAL
+
+        :param key: string; hash of the canonical query parameters
+        :param run_id: string; ID of the processing run the cache entry is valid for
+        :return: list of docs, or None if the query isn't cached for this run
+        """
+
+        now = get_date()
+        ttl_date = now - timedelta(seconds=self._config.get('QUERY_CACHE_TTL', 43200))
+        touch_date = now - timedelta(seconds=self._config.get('QUERY_CACHE_TOUCH_INTERVAL', 60))
+        table = QueryCache.__table__
+        with self.session_scope() as session:
+            res = session.execute(select([table.c.results, table.c.last_used]).
+                                  where(and_(table.c.run_id == run_id,
+                                             table.c.key == key,
+                                             table.c.created >= ttl_date))).first()
+            if res is None:
+                return None
+
+            if res[1] < touch_date:
+                # workers that read the entry at the same time skip the update once the first one is done
+                session.execute(table.update().
+                                where(and_(table.c.run_id == run_id,
+                                           table.c.key == key,
+                                           table.c.last_used < touch_date)).
+                                values(last_used=now))
+                session.commit()
+
+        return json.loads(res[0])
+
+    def set_cached_query(self, key=None, run_id=None, results=None):
+        """
+        Stores the results of a query for the current processing run, replacing an existing or expired entry. Once the
+        run has more than QUERY_CACHE_MAX_ENTRIES entries, the least recently used ones are evicted
+
+        :param key: string; hash of the canonical query parameters
+        :param run_id: string; ID of the processing run the cache entry is valid for
+        :param results: list of docs
+        :return: no return
+        """
+
+        now = get_date()
+        table = QueryCache.__table__
+        with self.session_scope() as session:
+            stmt = insert(table).values(run_id=run_id, key=key, results=json.dumps(results), created=now, last_used=now)
+            session.execute(stmt.on_conflict_do_update(index_elements=['run_id', 'key'],
+                                                       set_={'results': stmt.excluded.results,
+                                                             'created': stmt.excluded.created,
+                                                             'last_used': stmt.excluded.last_used}))
+            max_entries = self._config.get('QUERY_CACHE_MAX_ENTRIES', 5000)
+            num_entries = session.execute(select([func.count()]).where(table.c.run_id == run_id)).scalar()
+            if num_entries > max_entries:
+                lru = select([table.c.key]).where(table.c.run_id == run_id).order_by(table.c.last_used.desc()).\
+                    offset(max_entries)
+                session.execute(table.delete().where(and_(table.c.run_id == run_id, table.c.key.in_(lru))))
+            session.commit()
+
+    def expire_cached_queries(self):
+        """
+        Removes the query cache entries and precomputed arXiv category lists older than QUERY_CACHE_TTL, left behind
+        by earlier runs, and the Solr readiness checks older than SOLR_READY_TTL; run at the start of each processing
+        run. Entries of other runs still in progress are kept
+
+        :return: number of entries removed
+        """
+
+        now = get_date()
+        ttl_date = now - timedelta(seconds=self._config.get('QUERY_CACHE_TTL', 43200))
+        # readiness checks are stored by test bibcode, so each run leaves one behind
+        ready_ttl_date = now - timedelta(seconds=self._config.get('SOLR_READY_TTL', 600))
+        with self.session_scope() as session:
+            num_expired = session.query(QueryCache).filter(QueryCache.created < ttl_date).\
+                delete(synchronize_session=False)
+            num_expired += session.query(ArxivCategory).filter(ArxivCategory.created < ttl_date).\
+                delete(synchronize_session=False)
+            num_expired += session.query(KeyValue).filter(and_(KeyValue.key.like('solr.ready.%'),
+                                                               KeyValue.value < ready_ttl_date.isoformat())).\
+                delete(synchronize_session=False)
+            session.commit()
+
+        return num_expired
+
+    def get_arxiv_category(self, run_id=None, arxiv_class=None):
+        """
+        Fetches the list of new papers in an arXiv category, precomputed for a daily processing run
+
+        :param run_id: string; ID of the processing run
+        :param arxiv_class: arXiv class, as used in the query (e.g. astro-ph.* or astro-ph.GA)
+        :return: tuple of (earliest entry date covered, e.g. 2020-01-01T00:00; list of [entry date, pubdate,
+            compact SearchResult]), or None if the category wasn't precomputed for the run
+        """
+
+        with self.session_scope() as session:
+            entry = session.query(ArxivCategory.start, ArxivCategory.results).\
+                filter_by(run_id=run_id, arxiv_class=arxiv_class).first()
+            if entry is None:
+                return None
+            return entry.start, json.loads(entry.results)
+
+    def set_arxiv_category(self, run_id=None, arxiv_class=None, start=None, results=None):
+        """
+        Stores the list of new papers in an arXiv category for a daily processing run, replacing an existing one
+
+        :param run_id: string; ID of the processing run
+        :param arxiv_class: arXiv class, as used in the query (e.g. astro-ph.* or astro-ph.GA)
+        :param start: earliest entry date covered by the list, e.g. 2020-01-01T00:00
+        :param results: list of [entry date, pubdate, compact SearchResult]
+        :return: no return
+        """
+
+        table = ArxivCategory.__table__
+        with self.session_scope() as session:
+            stmt = insert(table).values(run_id=run_id, arxiv_class=arxiv_class, start=start,
+                                        results=json.dumps(results), created=get_date())
+            session.execute(stmt.on_conflict_do_update(index_elements=['run_id', 'arxiv_class'],
+                                                       set_={'start': stmt.excluded.start,
+                                                             'results': stmt.excluded.results,
+                                                             'created': stmt.excluded.created}))
+            session.commit()
+
+    def get_cached_emails(self, user_ids=None):
+        """
+        Fetches the locally cached email addresses that haven't expired
+
+        :param user_ids: list of ADSWS user IDs
+        :return: dict; email address per user ID, for users found in the cache
+        """
+
+        with self.session_scope() as session:
+            q = session.query(UserEmail.user_id, UserEmail.email).filter(and_(UserEmail.user_id.in_(user_ids),
+                                                                              UserEmail.expires > get_date()))
+            return dict((user_id, email) for user_id, email in q)
+
+    def set_cached_emails(self, emails=None):
+        """
+        Stores email addresses in the local cache, replacing existing entries. Each entry expires at a random time
+        between (1 - EMAIL_CACHE_TTL_JITTER) * EMAIL_CACHE_TTL and EMAIL_CACHE_TTL from now
+
+        :param emails: dict; email address per ADSWS user ID
+        :return: no return
+        """
+
+        if not emails:
+            return
+
+        now = get_date()
+        ttl = self._config.get('EMAIL_CACHE_TTL', 604800)
+        jitter = self._config.get('EMAIL_CACHE_TTL_JITTER', 0.5)
+        table = UserEmail.__table__
+        with self.session_scope() as session:
+            stmt = insert(table).values([{'user_id': user_id, 'email': email, 'updated': now,
+                                          'expires': now + timedelta(seconds=ttl * (1 - jitter * random.random()))}
+                                         for user_id, email in emails.items()])
+            session.execute(stmt.on_conflict_do_update(index_elements=['user_id'],
+                                                       set_={'email': stmt.excluded.email,
+                                                             'updated': stmt.excluded.updated,
+                                                             'expires': stmt.excluded.expires}))
+            session.commit()
+
+    def invalidate_cached_email(self, user_id=None):
+        """
+        Removes a user's email address from the local cache, e.g. after sending to it failed
+
+        :param user_id: int; ADSWS user ID
+        :return: no return
+        """
+
+        with self.session_scope() as session:
+            session.query(UserEmail).filter_by(user_id=user_id).delete()
+            session.commit()
+
+    def build_template_query(self, setup=None, date=None):
+        """
+        Builds the queries of a templated setup for the given day, with the time ranges vault uses
+
+        :param setup: dict; templated setup, as returned by vault
+        :param date: datetime.date; day the queries are run on
+        :return: list of dicts with the query (q) and its sort, or None if the setup can't be built locally
+        """
+        return queries.build_template_query(setup, date=date,
+                                            daily_range=self._config.get('MYADS_DAILY_TIME_RANGE', 2),
+                                            weekly_range=self._config.get('MYADS_WEEKLY_TIME_RANGE', 6))
+
+    def get_cached_setup(self, user_id=None, frequency=None):
+        """
+        Fetches a user's myADS setups from the local mirror of vault. The queries of templated setups are built for
+        today from the stored template parameters. Templated setups that couldn't be built locally are stored with
+        the queries vault built on the day they were fetched, so if the user has such setups of the given frequency,
+        the setups are only returned if they were fetched today. Setups stored by another version of the query
+        builder, or of a template and frequency whose queries differed from vault's at the last check, are fetched
+        from vault
+
+        :param user_id: int; ADSWS user ID
+        :param frequency: 'daily' or 'weekly'
+        :return: list of setups, as returned by vault, or None if the user must be fetched from vault
+        """
+
+        with self.session_scope() as session:
+            entry = session.query(UserSetup).filter_by(user_id=user_id).first()
+            if entry is None or entry.builder_version != queries.BUILDER_VERSION:
+                return None
+            setups = json.loads(entry.setups)
+            updated = entry.updated
+
+        today = get_date().date()
+        mismatches = None
+        for s in setups:
+            if s['type'] != 'template' or (frequency is not None and s['frequency'] != frequency):
+                continue
+            if 'query' not in s:
+                if mismatches is None:
+                    mismatches = self.get_setup_mismatches(today)
+                if (s['template'], s['frequency']) in mismatches:
+                    return None
+                s['query'] = self.build_template_query(s, today)
+            elif updated.date() != today:
+                return None
+
+        return setups
+
+    def set_cached_setups(self, setups=None):
+        """
+        Stores myADS setups in the local mirror of vault, replacing existing entries. The queries of templated
+        setups aren't stored if they can be built locally
+
+        :param setups: dict; list of setups per ADSWS user ID
+        :return: no return
+        """
+
+        if not setups:
+            return
+
+        now = get_date()
+        stored = {}
+        for user_id, user_setups in setups.items():
+            stored[user_id] = []
+            for s in user_setups:
+                if s['type'] == 'template' and 'query' in s and \
+                        self.build_template_query(s, now.date()) == s['query']:
+                    s = dict(s)
+                    del s['query']
+                stored[user_id].append(s)
+
+        table = UserSetup.__table__
+        with self.session_scope() as session:
+            stmt = insert(table).values([{'user_id': user_id,
+                                          'setups': json.dumps(user_setups),
+                                          'daily': any(s['frequency'] == 'daily' for s in user_setups),
+                                          'weekly': any(s['frequency'] == 'weekly' for s in user_setups),
+                                          'updated': now,
+                                          'builder_version': queries.BUILDER_VERSION}
+                                         for user_id, user_setups in stored.items()])
+            session.execute(stmt.on_conflict_do_update(index_elements=['user_id'],
+                                                       set_={'setups': stmt.excluded.setups,
+                                                             'daily': stmt.excluded.daily,
+                                                             'weekly': stmt.excluded.weekly,
+                                                             'updated': stmt.excluded.updated,
+                                                             'builder_version': stmt.excluded.builder_version}))
+            session.commit()
+
+    def sample_cached_setups(self, sample_size=50):
+        """
+        Picks random users of the local mirror of vault whose templated setups are built locally
+
+        :param sample_size: maximum number of users
+        :return: list of ADSWS user IDs
+        """
+
+        with self.session_scope() as session:
+            q = session.query(UserSetup.user_id).\
+                filter(text("EXISTS (SELECT 1 FROM json_array_elements(setups.setups::json) s "
+                            "WHERE s->>'type' = 'template' AND s->'query' IS NULL)")).\
+                order_by(func.random()).limit(sample_size)
+            return [user_id for (user_id,) in q]
+
+    def get_setup_mismatches(self, date=None):
+        """
+        :param date: datetime.date; day of the check
+        :return: set of (template, frequency) whose queries built locally differed from vault's at the check of
+            that day
+        """
+
+        with self.session_scope() as session:
+            kv = session.query(KeyValue).filter_by(key='setup.mismatches').first()
+            value = json.loads(kv.value) if kv else None
+        if not value or value['date'] != date.isoformat():
+            return set()
+        return set(tuple(m) for m in value['mismatches'])
+
+    def set_setup_mismatches(self, date=None, mismatches=None):
+        """
+        Records the templates and frequencies whose queries built locally differed from vault's, replacing the
+        previous check; their setups are fetched from vault for the rest of the day
+
+        :param date: datetime.date; day of the check
+        :param mismatches: set of (template, frequency)
+        :return: no return
+        """
+
+        value = json.dumps({'date': date.isoformat(), 'mismatches': sorted(mismatches or [])})
+        with self.session_scope() as session:
+            session.execute(insert(KeyValue.__table__).values(key='setup.mismatches', value=value).
+                            on_conflict_do_update(index_elements=['key'], set_={'value': value}))
+            session.commit()
+
+    def get_users_without_frequency(self, user_ids=None, frequency='daily'):
+        """
+        Finds the users that, according to the local mirror of vault, have no setups of the given frequency.
+        Users missing from the mirror aren't returned
+
+        :param user_ids: list of ADSWS user IDs
+        :param frequency: 'daily' or 'weekly'
+        :return: set of user IDs
+        """
+
+        flag = UserSetup.daily if frequency == 'daily' else UserSetup.weekly
+        with self.session_scope() as session:
+            q = session.query(UserSetup.user_id).filter(and_(UserSetup.user_id.in_(user_ids), flag.is_(False)))
+            return set(user_id for (user_id,) in q)
+
+    def invalidate_cached_setups(self, user_ids=None):
+        """
+        Removes users from the local mirror of vault, so that their setups are fetched from vault again
+
+        :param user_ids: list of ADSWS user IDs
+        :return: no return
+        """
+
+        with self.session_scope() as session:
+            session.query(UserSetup).filter(UserSetup.user_id.in_(user_ids)).delete(synchronize_session=False)
+            session.commit()
@@ -0,0 +1,258 @@
+"""
+In-process timing histograms and counters for the pipeline, exported in the Prometheus text format
+
+Each worker process keeps its own metrics and periodically writes them to <METRICS_DIR>/myads_<host>_<index>.prom,
+where they can be picked up by the node_exporter textfile collector. Files are named after the host and the index
+of the process in the Celery pool, so that a restarted process takes over the file and the series of the process
+it replaces.
+"""
+
+from billiard.process import current_process
+from contextlib import contextmanager
+import errno
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+
+# upper bounds of the histogram buckets (units=seconds)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+STAGE_SECONDS = 'myads_stage_seconds'
+STAGE_ERRORS = 'myads_stage_errors_total'
+
+_HELP = {STAGE_SECONDS: 'Time spent in each stage of myADS processing',
+         STAGE_ERRORS: 'Number of myADS processing stages that raised an exception',
+         'myads_emails_total': 'Number of myADS emails processed, by status',
+         'myads_query_cache_total': 'Number of lookups in the shared template query cache, by result'}
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(u'{0}="{1}"'.format(k, _escape(v)) for k, v in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _metrics_file(directory, host, index):
+    return os.path.join(directory, 'myads_{0}_{1}.prom'.format(host, index))
+
+
+def _pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # the process exists, but belongs to another user
+        return e.errno == errno.EPERM
+    return True
+
+
+def worker_labels():
+    """
+    :return: dict of the labels identifying this worker process: host name and index in the Celery pool (0 outside
+        of a prefork pool)
+    """
+    return {'host': socket.gethostname(), 'index': getattr(current_process(), 'index', 0)}
+
+
+class Registry(object):
+    """
+    Thread-safe store of histograms and counters, keyed by metric name and sorted label pairs
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._last_flush = 0
+
+    def observe(self, name, value, **labels):
+        """
+        Records a value in a histogram
+
+        :param name: metric name
+        :param value: observed value
+        :param labels: metric labels
+        :return: no return
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0., 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist['buckets'][i] += 1
+            hist['sum'] += value
+            hist['count'] += 1
+
+    def inc(self, name, amount=1, **labels):
+        """
+        Increments a counter
+
+        :param name: metric name
+        :param amount: increment
+        :param labels: metric labels
+        :return: no return
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        """
+        Times the enclosed block into the stage histogram; exceptions are counted and re-raised
+
+        :param stage: name of the stage (e.g. 'setup', 'query', 'send_email')
+        :param labels: additional labels, e.g. frequency and template
+        """
+        labels['stage'] = stage
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.inc(STAGE_ERRORS, **labels)
+            raise
+        finally:
+            self.observe(STAGE_SECONDS, time.time() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def render(self, extra_labels=None):
+        """
+        Renders all metrics in the Prometheus text exposition format
+
+        :param extra_labels: dict of labels added to every sample (e.g. the worker host and pool index)
+        :return: unicode string
+        """
+        extra = tuple(sorted((extra_labels or {}).items()))
+        with self._lock:
+            histograms = dict((k, {'buckets': list(v['buckets']), 'sum': v['sum'], 'count': v['count']})
+                              for k, v in self._histograms.items())
+            counters = dict(self._counters)
+
+        lines = []
+        for name in sorted(set(k[0] for k in histograms)):
+            lines.append(u'# HELP {0} {1}'.format(name, _HELP.get(name, name)))
+            lines.append(u'# TYPE {0} histogram'.format(name))
+            for key in sorted(k for k in histograms if k[0] == name):
+                hist = histograms[key]
+                labels = key[1] + extra
+                for bound, count in zip(self.buckets + (float('inf'),), hist['buckets'] + [hist['count']]):
+                    le = (('le', _format_value(bound)),)
+                    lines.append(u'{0}_bucket{1} {2}'.format(name, _format_labels(labels + le), count))
+                lines.append(u'{0}_sum{1} {2}'.format(name, _format_labels(labels), _format_value(hist['sum'])))
+                lines.append(u'{0}_count{1} {2}'.format(name, _format_labels(labels), hist['count']))
+        for name in sorted(set(k[0] for k in counters)):
+            lines.append(u'# HELP {0} {1}'.format(name, _HELP.get(name, name)))
+            lines.append(u'# TYPE {0} counter'.format(name))
+            for key in sorted(k for k in counters if k[0] == name):
+                lines.append(u'{0}{1} {2}'.format(name, _format_labels(key[1] + extra), counters[key]))
+
+        return u'\n'.join(lines) + u'\n'
+
+    def write(self, path, extra_labels=None):
+        """
+        Atomically writes the rendered metrics to a file, headed by a comment with the pid of the writing process
+
+        :param path: output file
+        :param extra_labels: dict of labels added to every sample
+        :return: no return
+        """
+        directory = os.path.dirname(path) or '.'
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.myads_metrics')
+        with os.fdopen(fd, 'w') as f:
+            f.write('# pid {0}\n'.format(os.getpid()))
+            f.write(self.render(extra_labels).encode('utf-8'))
+        os.rename(tmp_path, path)
+
+    def flush(self, directory, min_interval=0):
+        """
+        Writes this process's metrics to <directory>/myads_<host>_<index>.prom, at most once every min_interval
+        seconds
+
+        :param directory: output directory; nothing is written if empty
+        :param min_interval: minimum time between writes (units=seconds)
+        :return: path of the file written, or None
+        """
+        if not directory:
+            return None
+        now = time.time()
+        if now - self._last_flush < min_interval:
+            return None
+        self._last_flush = now
+        labels = worker_labels()
+        path = _metrics_file(directory, labels['host'], labels['index'])
+        self.write(path, extra_labels=labels)
+        return path
+
+    def remove(self, directory):
+        """
+        Removes this process's metrics file, so that metrics of exited workers are not exported
+
+        :param directory: output directory
+        :return: no return
+        """
+        if not directory:
+            return
+        labels = worker_labels()
+        try:
+            os.remove(_metrics_file(directory, labels['host'], labels['index']))
+        except OSError:
+            pass
+
+
+def remove_stale(directory):
+    """
+    Removes the metrics files written by processes of this host that are no longer running, e.g. workers that were
+    killed before they could remove their own, or whose pool shrank
+
+    :param directory: output directory
+    :return: list of the paths removed
+    """
+    if not directory:
+        return []
+    pattern = re.compile(r'^myads_{0}_\d+\.prom$'.format(re.escape(socket.gethostname())))
+    removed = []
+    for name in os.listdir(directory):
+        if not pattern.match(name):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            with open(path) as f:
+                m = re.match(r'^# pid (\d+)$', f.readline().strip())
+        except IOError:
+            continue
+        if m is None or _pid_running(int(m.group(1))):
+            continue
+        try:
+            os.remove(path)
+            removed.append(path)
+        except OSError:
+            pass
+    return removed
+
+
+registry = Registry()
+observe = registry.observe
+inc = registry.inc
+timer = registry.timer
+render = registry.render
+flush = registry.flush
+remove = registry.remove
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from sqlalchemy import Column, Integer, ARRAY, String, Text
+from sqlalchemy import Boolean, Column, Index, Integer, String, Text, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 import json
 from adsputils import get_date, UTCDateTime
@@ -26,12 +26,66 @@ class AuthorInfo(Base):
     last_sent = Column(UTCDateTime)
 
 
-class Results(Base):
-    __tablename__ = 'results'
+class SeenResult(Base):
+    """Bibcode seen by a user for a stateful query, stamped with the time it was first seen"""
+    __tablename__ = 'seen_results'
+    __table_args__ = (UniqueConstraint('user_id', 'query_key', 'bibcode', name='seen_results_user_query_bibcode_key'),)
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer)
-    qid = Column(String(32))
-    setup_id = Column(Integer)
-    results = Column(ARRAY(String))
-    created = Column(UTCDateTime)
\ No newline at end of file
+    # QID of the query (from vault "queries" table), or setup:<ID> for templated queries
+    query_key = Column(String(40))
+    bibcode = Column(String(19))
+    created = Column(UTCDateTime)
+
+
+class QueryCache(Base):
+    """Solr results of a templated query, shared by all workers for the length of one processing run"""
+    __tablename__ = 'query_cache'
+    __table_args__ = (Index('query_cache_run_last_used_idx', 'run_id', 'last_used'),)
+
+    run_id = Column(String(64), primary_key=True)
+    key = Column(String(40), primary_key=True)
+    results = Column(Text)
+    created = Column(UTCDateTime)
+    # entries are evicted by last use, which is only updated every QUERY_CACHE_TOUCH_INTERVAL
+    last_used = Column(UTCDateTime)
+
+
+class ArxivCategory(Base):
+    """New papers of an arXiv category, fetched once per daily processing run to assemble queries on categories"""
+    __tablename__ = 'arxiv_categories'
+
+    run_id = Column(String(64), primary_key=True)
+    arxiv_class = Column(String(64), primary_key=True)
+    # earliest entry date covered by the list, e.g. 2020-01-01T00:00
+    start = Column(String(16))
+    # JSON list of [entry date, pubdate, compact SearchResult]
+    results = Column(Text)
+    created = Column(UTCDateTime)
+
+
+class UserEmail(Base):
+    """Email address of a user, as last fetched from adsws"""
+    __tablename__ = 'emails'
+
+    user_id = Column(Integer, primary_key=True)
+    email = Column(String(255))
+    updated = Column(UTCDateTime)
+    # the expiry is spread out, so that entries cached together aren't all fetched again together
+    expires = Column(UTCDateTime)
+
+
+class UserSetup(Base):
+    """myADS setups of a user, mirrored from vault (/vault/get-myads) and synced incrementally"""
+    __tablename__ = 'setups'
+
+    user_id = Column(Integer, primary_key=True)
+    # JSON list of setups, as returned by vault
+    setups = Column(Text)
+    # whether the user has setups of each frequency
+    daily = Column(Boolean)
+    weekly = Column(Boolean)
+    updated = Column(UTCDateTime)
+    # version of the query builder the setups were stored with (queries.BUILDER_VERSION)
+    builder_version = Column(Integer)
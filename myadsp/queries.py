@@ -0,0 +1,71 @@
+"""Templated myADS queries, built the way vault builds them, so that they needn't be fetched from vault every day"""
+
+import datetime
+
+# version of the query builder, stored with the mirrored setups; bump it whenever the built queries change, so that
+# setups stored by an earlier version are fetched from vault again
+BUILDER_VERSION = 1
+
+
+def _arxiv_classes(classes):
+    """
+    :param classes: list of arXiv classes, or a single class
+    :return: arxiv_class clause; classes without a subcategory match all of their subcategories
+    """
+    if type(classes) != list:
+        classes = [classes]
+    return 'arxiv_class:(' + ' OR '.join(c + '.*' if '.' not in c else c for c in classes) + ')'
+
+
+def build_template_query(setup=None, date=None, daily_range=2, weekly_range=6):
+    """
+    Builds the queries of a templated setup for the given day, as /vault/get-myads returns them on that day
+
+    :param setup: dict; templated setup, as returned by vault
+    :param date: datetime.date; day the queries are run on
+    :param daily_range: number of days covered by daily queries run on Mondays, to include the weekend
+    :param weekly_range: number of days covered by weekly queries
+    :return: list of dicts with the query (q) and its sort, or None if the setup can't be built locally
+    """
+
+    template = setup.get('template')
+    frequency = setup.get('frequency')
+    data = setup.get('data')
+    beg_pubyear = (date - datetime.timedelta(days=180)).year
+    weekly_start = date - datetime.timedelta(days=weekly_range)
+    weekly_dates = 'entdate:["{0}Z00:00" TO "{1}Z23:59"] pubdate:[{2}-00 TO *]'.format(weekly_start, date,
+                                                                                        beg_pubyear)
+
+    if template == 'arxiv':
+        if not setup.get('classes'):
+            return None
+        classes = _arxiv_classes(setup['classes'])
+        if frequency == 'daily':
+            # on Mondays, the weekend is included
+            start = date - datetime.timedelta(days=daily_range) if date.weekday() == 0 else date
+            dates = 'entdate:["{0}Z00:00" TO NOW] pubdate:[{1}-00 TO *]'.format(start, beg_pubyear)
+            # papers matching the keywords are sorted by score, the other recent papers by bibcode
+            parts = [(' ', 'score desc, bibcode desc'), (' NOT ', 'bibcode desc')]
+        elif frequency == 'weekly':
+            dates = weekly_dates
+            parts = [(' ', 'score desc, bibcode desc')]
+        else:
+            return None
+
+        if not data:
+            return [{'q': 'bibstem:arxiv {0} {1}'.format(classes, dates), 'sort': 'bibcode desc'}]
+        return [{'q': 'bibstem:arxiv ({0}{1}({2})) {3}'.format(classes, connector, data, dates), 'sort': sort}
+                for connector, sort in parts]
+
+    if not data:
+        return None
+    if template == 'citations':
+        return [{'q': 'citations({0})'.format(data), 'sort': 'entry_date desc, bibcode desc'}]
+    if template == 'authors':
+        return [{'q': '{0} {1}'.format(data, weekly_dates), 'sort': 'score desc, bibcode desc'}]
+    if template == 'keyword':
+        return [{'q': '{0} {1}'.format(data, weekly_dates), 'sort': 'entry_date desc, bibcode desc'},
+                {'q': 'trending({0})'.format(data), 'sort': 'score desc, bibcode desc'},
+                {'q': 'useful({0})'.format(data), 'sort': 'score desc, bibcode desc'}]
+
+    return None
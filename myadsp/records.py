@@ -0,0 +1,134 @@
+"""Compact representation of the search results included in myADS emails"""
+
+import hashlib
+
+
+class SearchResult(object):
+    """
+    Search result, keeping only the fields used for stateful filtering and rendering. Authors beyond the number
+    displayed are dropped, keeping their count, and the arXiv ID of results of templated queries is resolved from
+    the identifiers once.
+
+    Supports the read-only dict access (r['bibcode'], r.get('title'), 'arxiv_id' in r) used on raw Solr docs
+    """
+    __slots__ = ('bibcode', 'title', 'authors', 'num_authors', 'bibstem', 'year', 'arxiv_id')
+
+    # maximum number of authors displayed in the emails
+    MAX_AUTHORS = 3
+    # Solr fields a result is built from
+    DOC_FIELDS = ('bibcode', 'title', 'author_norm', 'identifier', 'year', 'bibstem')
+
+    def __init__(self, bibcode=None, title=u'', authors=None, num_authors=0, bibstem=None, year=None,
+                 arxiv_id=None):
+        self.bibcode = bibcode
+        self.title = title
+        self.authors = authors
+        self.num_authors = num_authors
+        self.bibstem = bibstem
+        self.year = year
+        self.arxiv_id = arxiv_id
+
+    @classmethod
+    def from_doc(cls, doc, resolve_arxiv_id=False):
+        """
+        Builds a result from a Solr doc
+
+        :param doc: dict, as returned by Solr
+        :param resolve_arxiv_id: boolean; if the doc has no arxiv_id, take it from the identifiers. Only results of
+            templated queries are shown with their arXiv ID
+        :return: SearchResult
+        """
+        title = doc.get('title', u'')
+        if type(title) == list:
+            title = title[0] if title else u''
+
+        authors = doc.get('author_norm')
+        num_authors = 0
+        if type(authors) == list:
+            num_authors = len(authors)
+            authors = tuple(authors[:cls.MAX_AUTHORS])
+        elif authors is not None:
+            num_authors = 1
+
+        bibstem = doc.get('bibstem')
+        if type(bibstem) == list:
+            bibstem = tuple(bibstem[:1])
+
+        arxiv_id = doc.get('arxiv_id')
+        if arxiv_id is None and resolve_arxiv_id:
+            for i in doc.get('identifier', []):
+                if i.startswith('arXiv:'):
+                    arxiv_id = i
+                    break
+
+        return cls(bibcode=doc.get('bibcode'), title=title, authors=authors, num_authors=num_authors,
+                   bibstem=bibstem, year=doc.get('year'), arxiv_id=arxiv_id)
+
+    def to_list(self):
+        """
+        Compact form of the result, for storage as JSON
+
+        :return: list of the field values, in the order of __slots__
+        """
+        return [getattr(self, k) for k in self.__slots__]
+
+    @classmethod
+    def from_list(cls, values):
+        """
+        Builds a result from its compact form
+
+        :param values: list, as returned by to_list, after a round trip through JSON
+        :return: SearchResult
+        """
+        r = cls(*values)
+        # JSON turns tuples into lists
+        if type(r.authors) == list:
+            r.authors = tuple(r.authors)
+        if type(r.bibstem) == list:
+            r.bibstem = tuple(r.bibstem)
+        return r
+
+    def __contains__(self, key):
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        return getattr(self, key)
+
+    def _key(self):
+        return (self.bibcode, self.title, self.authors, self.num_authors, self.bibstem, self.year, self.arxiv_id)
+
+    def __eq__(self, other):
+        if not isinstance(other, SearchResult):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return 'SearchResult({0})'.format(', '.join('{0}={1!r}'.format(k, getattr(self, k)) for k in self.__slots__))
+
+
+def digest(results):
+    """
+    Fingerprint of a list of results, so that caches can be keyed on the results without holding on to them
+
+    :param results: iterable of SearchResult
+    :return: SHA1 hex digest
+    """
+    h = hashlib.sha1()
+    for r in results:
+        h.update(repr(r._key()))
+        h.update('\n')
+    return h.hexdigest()
@@ -2,20 +2,124 @@
 import adsputils
 from myadsp import app as app_module
 from myadsp import utils
-from .models import AuthorInfo
+from myadsp import metrics
+from .models import AuthorInfo, KeyValue
 from .emails import myADSTemplate
 
 #from flask import current_app
 from kombu import Queue
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown, task_postrun
+from multiprocessing.pool import ThreadPool
 import os
 import json
 from sqlalchemy.orm import exc as ormexc
+from sqlalchemy.dialects.postgresql import insert
+from datetime import timedelta
 
 app = app_module.myADSCelery('myADS-pipeline', proj_home=os.path.realpath(os.path.join(os.path.dirname(__file__), '../')))
 app.conf.CELERY_QUEUES = (
     Queue('process', app.exchange, routing_key='process'),
 )
 logger = app.logger
+_query_pool = None
+
+
+@worker_init.connect
+@worker_process_init.connect
+def load_templates(**kwargs):
+    """
+    Loads the email templates as the worker starts: in the main process, so that forked worker processes inherit
+    them, and in each worker process, for pools that don't fork
+    """
+    utils.load_templates()
+
+
+@worker_process_shutdown.connect
+def close_smtp_connections(**kwargs):
+    """Closes the pooled SMTP connections and removes the metrics file of a worker process as it shuts down"""
+    utils.smtp_pool.close_all()
+    metrics.remove(app.conf.get('METRICS_DIR'))
+
+
+@task_postrun.connect
+def flush_metrics(**kwargs):
+    """Writes the stage timings of this worker process to METRICS_DIR, if set"""
+    try:
+        metrics.flush(app.conf.get('METRICS_DIR'), min_interval=app.conf.get('METRICS_FLUSH_INTERVAL', 30))
+    except (IOError, OSError) as e:
+        logger.warning('Error writing metrics to {0}: {1}'.format(app.conf.get('METRICS_DIR'), e))
+
+
+def _get_query_pool():
+    """
+    Thread pool used to run the queries of a single user concurrently; created on first use, so that
+    each worker process gets its own threads
+    """
+    global _query_pool
+    if _query_pool is None:
+        _query_pool = ThreadPool(app.conf.get('MYADS_QUERY_THREADS', 4))
+    return _query_pool
+
+
+def _fetch_setup_results(args):
+    """
+    Fetches the results of a single myADS setup
+
+    :param args: tuple of (myADS setup, run ID)
+    :return: tuple of (raw results, error); error is the RuntimeError raised while fetching results, if any
+    """
+    s, run_id = args
+    try:
+        if s['type'] == 'query':
+            with metrics.timer('query', frequency=s['frequency'], template='general'):
+                return utils.get_query_results(s), None
+        elif s['type'] == 'template':
+            with metrics.timer('query', frequency=s['frequency'], template=s['template']):
+                return utils.get_template_query_results(s, run_id=run_id), None
+        else:
+            return [], None
+    except RuntimeError as e:
+        return None, e
+
+
+def _solr_searcher_ready(test_bibcode, userid=None):
+    """
+    Checks that the solr searchers have been updated, by querying for the test bibcode. A successful check is
+    stored and shared by all workers for SOLR_READY_TTL seconds; failed checks are not stored, so the next
+    task probes again
+
+    :param test_bibcode: bibcode from the latest ingest
+    :param userid: user being processed, for logging
+    :return: boolean
+    """
+    key = 'solr.ready.{0}'.format(test_bibcode)
+    with app.session_scope() as session:
+        kv = session.query(KeyValue).filter_by(key=key).first()
+        if kv is not None and adsputils.get_date(kv.value) > \
+                adsputils.get_date() - timedelta(seconds=app.conf.get('SOLR_READY_TTL', 600)):
+            return True
+
+    q = app.client.get('{0}?q=identifier:{1}&fl=bibcode,identifier,entry_date'.format(app.conf.get('API_SOLR_QUERY_ENDPOINT'),
+                                                                                      test_bibcode),
+                       headers={'Authorization': 'Bearer ' + app.conf.get('API_TOKEN')})
+
+    if q.status_code != 200:
+        logger.warning('Error retrieving the test bibcode {0} from solr while processing for user {1}. Retrying'.
+                       format(test_bibcode, userid))
+        return False
+    elif q.json()['response']['numFound'] == 0:
+        logger.warning('Test bibcode {0} not found in solr while processing for user {1}. Retrying'.
+                       format(test_bibcode, userid))
+        return False
+
+    now = adsputils.get_date().isoformat()
+    with app.session_scope() as session:
+        session.execute(insert(KeyValue.__table__).
+                        values(key=key, value=now).
+                        on_conflict_do_update(index_elements=['key'], set_={'value': now}))
+        session.commit()
+
+    return True
 
 
 @app.task(queue='process')
@@ -31,6 +135,7 @@ def task_process_myads(message):
             even if they were already processed today)
          'test_send_to': email address to send output to, if not that of the user (for testing)
          'retries': number of retries attempted
+         'run_id': ID of the processing run; templated query results are shared between users of the same run
         }
     :return: no return
     """
@@ -61,12 +166,15 @@ def task_process_myads(message):
             else:
                 logger.info('Email for user {0} already sent today, but force mode is on'.format(userid))
 
-    # first fetch the myADS setup from /vault/get-myads
-    r = app.client.get(app.conf.get('API_VAULT_MYADS_SETUP') % userid,
-                       headers={'Accept': 'application/json',
-                                'Authorization': 'Bearer {0}'.format(app.conf.get('API_TOKEN'))})
+    # first fetch the myADS setup, from the local mirror of vault if possible, else from /vault/get-myads
+    with metrics.timer('setup', frequency=message['frequency']):
+        myads_setup = app.get_cached_setup(userid, frequency=message['frequency'])
+        if myads_setup is None:
+            myads_setup = utils.get_user_setup(userid)
+            if myads_setup is not None:
+                app.set_cached_setups({userid: myads_setup})
 
-    if r.status_code != 200:
+    if myads_setup is None:
         if message.get('retries', None):
             retries = message['retries']
         else:
@@ -82,21 +190,7 @@ def task_process_myads(message):
 
     if message.get('test_bibcode', None):
         # check that the solr searcher we're getting is still ok by querying for the test bibcode
-        q = app.client.get('{0}?q=identifier:{1}&fl=bibcode,identifier,entry_date'.format(app.conf.get('API_SOLR_QUERY_ENDPOINT'),
-                                                                                          message.get('test_bibcode')),
-                           headers={'Authorization': 'Bearer ' + app.conf.get('API_TOKEN')})
-
-        fail = True
-        if q.status_code != 200:
-            logger.warning('Error retrieving the test bibcode {0} from solr while processing for user {1}. Retrying'.
-                           format(message.get('test_bibcode'), userid))
-        elif q.json()['response']['numFound'] == 0:
-            logger.warning('Test bibcode {0} not found in solr while processing for user {1}. Retrying'.
-                           format(message.get('test_bibcode'), userid))
-        else:
-            fail = False
-
-        if fail:
+        if not _solr_searcher_ready(message.get('test_bibcode'), userid):
             if message.get('solr_retries', None):
                 retries = message['solr_retries']
             else:
@@ -113,63 +207,55 @@ def task_process_myads(message):
                 return
 
     # then execute each qid /vault/execute-query/qid
-    setup = r.json()
-    payload = []
+    setup = [s for s in myads_setup if s['frequency'] == message['frequency']]
     for s in setup:
-        if s['frequency'] == message['frequency']:
-            # only return 5 results, unless it's the daily arXiv posting, then return max
-            # TODO should all stateful queries return all results or will this be overwhelming for some? well-cited
-            # users can get 40+ new cites in one weekly astro update
-            if s['frequency'] == 'daily' and s['stateful'] is False:
-                s['rows'] = 2000
+        # only return 5 results, unless it's the daily arXiv posting, then return max
+        # TODO should all stateful queries return all results or will this be overwhelming for some? well-cited
+        # users can get 40+ new cites in one weekly astro update
+        if s['frequency'] == 'daily' and s['stateful'] is False:
+            s['rows'] = 2000
+        else:
+            s['rows'] = 5
+        s['fields'] = 'bibcode,title,author_norm,identifier,year,bibstem'
+
+    # the queries of all setups are run concurrently; results come back in setup order
+    if len(setup) > 1 and app.conf.get('MYADS_QUERY_THREADS', 4) > 1:
+        fetched = _get_query_pool().map(_fetch_setup_results, [(s, message.get('run_id', None)) for s in setup])
+    else:
+        fetched = [_fetch_setup_results((s, message.get('run_id', None))) for s in setup]
+
+    payload = []
+    for s, (raw_results, error) in zip(setup, fetched):
+        if s['type'] == 'query':
+            qtype = 'general'
+        elif s['type'] == 'template':
+            qtype = s['template']
+        else:
+            logger.warning('Wrong query type passed for query {0}, user {1}'.format(s, userid))
+            continue
+
+        if error:
+            if message.get('query_retries', None):
+                retries = message['query_retries']
             else:
-                s['rows'] = 5
-            s['fields'] = 'bibcode,title,author_norm,identifier,year,bibstem'
-            if s['type'] == 'query':
-                qtype = 'general'
-                try:
-                    raw_results = utils.get_query_results(s)
-                except RuntimeError:
-                    if message.get('query_retries', None):
-                        retries = message['query_retries']
-                    else:
-                        retries = 0
-                    if retries < app.conf.get('TOTAL_RETRIES', 3):
-                        message['query_retries'] = retries + 1
-                        logger.warning('Error getting query results for user {0}. Retrying. Retry: {1}'.format(userid,
-                                                                                                               retries))
-                        task_process_myads.apply_async(args=(message,), countdown=app.conf.get('MYADS_RESEND_WINDOW', 3600))
-                        return
-                    else:
-                        logger.warning('Maximum number of query retries attempted for user {0}; myADS processing '
-                                       'failed due to retrieving query results failures.'.format(userid))
-            elif s['type'] == 'template':
-                qtype = s['template']
-                try:
-                    raw_results = utils.get_template_query_results(s)
-                except RuntimeError:
-                    if message.get('query_retries', None):
-                        retries = message['query_retries']
-                    else:
-                        retries = 0
-                    if retries < app.conf.get('TOTAL_RETRIES', 3):
-                        message['query_retries'] = retries + 1
-                        logger.warning('Error getting template query results for user {0}. Retrying. '
-                                       'Retry:'.format(userid, retries))
-                        task_process_myads.apply_async(args=(message,), countdown=app.conf.get('MYADS_RESEND_WINDOW', 3600))
-                        return
-                    else:
-                        logger.warning('Maximum number of query retries attempted for user {0}; myADS processing '
-                                       'failed due to retrieving query results failures.'.format(userid))
+                retries = 0
+            if retries < app.conf.get('TOTAL_RETRIES', 3):
+                message['query_retries'] = retries + 1
+                logger.warning('Error getting {0} query results for user {1}. Retrying. Retry: {2}'.
+                               format(qtype, userid, retries))
+                task_process_myads.apply_async(args=(message,), countdown=app.conf.get('MYADS_RESEND_WINDOW', 3600))
+                return
             else:
-                logger.warning('Wrong query type passed for query {0}, user {1}'.format(s, userid))
-                pass
-
-            for r in raw_results:
-                # for stateful queries, remove previously seen results, store new results
-                if s['stateful']:
-                    docs = r['results']
-                    bibcodes = [doc['bibcode'] for doc in docs]
+                logger.warning('Maximum number of query retries attempted for user {0}; myADS processing '
+                               'failed due to retrieving query results failures.'.format(userid))
+                continue
+
+        for r in raw_results:
+            # for stateful queries, remove previously seen results, store new results
+            if s['stateful']:
+                docs = r['results']
+                bibcodes = [doc.bibcode for doc in docs]
+                with metrics.timer('recent_results', frequency=message['frequency'], template=qtype):
                     if s.get('qid', None):
                         good_bibc = app.get_recent_results(user_id=userid,
                                                            qid=s['qid'],
@@ -180,19 +266,16 @@ def task_process_myads(message):
                                                            setup_id=s['id'],
                                                            input_results=bibcodes,
                                                            ndays=app.conf.get('STATEFUL_RESULTS_DAYS', 7))
-                    results = [doc for doc in docs if doc['bibcode'] in good_bibc]
-                else:
-                    results = r['results']
-
-                payload.append({'name': r['name'],
-                                'query_url': r['query_url'],
-                                'results': results,
-                                'query': r['query'],
-                                'qtype': qtype,
-                                'id': s['id']})
-        else:
-            # wrong frequency for this round of processing
-            pass
+                results = [doc for doc in docs if doc.bibcode in good_bibc]
+            else:
+                results = r['results']
+
+            payload.append({'name': r['name'],
+                            'query_url': r['query_url'],
+                            'results': results,
+                            'query': r['query'],
+                            'qtype': qtype,
+                            'id': s['id']})
 
     if len(payload) == 0:
         logger.info('No payload for user {0} for the {1} email. No email was sent.'.format(userid, message['frequency']))
@@ -202,23 +285,28 @@ def task_process_myads(message):
     if message.get('test_send_to', None):
         email = message.get('test_send_to')
     else:
-        email = utils.get_user_email(userid=userid)
+        with metrics.timer('email_lookup', frequency=message['frequency']):
+            email = utils.get_user_email(userid=userid)
 
     if message['frequency'] == 'daily':
         subject = 'Daily arXiv myADS Notification'
     else:
         subject = 'Weekly myADS Notification'
 
-    payload_plain = utils.payload_to_plain(payload)
-    if len(payload) < app.conf.get('NUM_QUERIES_TWO_COL', 3):
-        payload_html = utils.payload_to_html(payload, col=1, frequency=message['frequency'], email_address=email)
-    else:
-        payload_html = utils.payload_to_html(payload, col=2, frequency=message['frequency'], email_address=email)
-    msg = utils.send_email(email_addr=email,
-                           email_template=myADSTemplate,
-                           payload_plain=payload_plain,
-                           payload_html=payload_html,
-                           subject=subject)
+    with metrics.timer('payload', frequency=message['frequency']):
+        if len(payload) < app.conf.get('NUM_QUERIES_TWO_COL', 3):
+            col = 1
+        else:
+            col = 2
+        payload_plain, payload_html = utils.render_payload(payload, col=col, frequency=message['frequency'],
+                                                           email_address=email)
+    with metrics.timer('send_email', frequency=message['frequency']):
+        msg = utils.send_email(email_addr=email,
+                               email_template=myADSTemplate,
+                               payload_plain=payload_plain,
+                               payload_html=payload_html,
+                               subject=subject)
+    metrics.inc('myads_emails_total', frequency=message['frequency'], status='sent' if msg else 'failed')
 
     if msg:
         # update author table w/ last sent datetime
@@ -229,6 +317,9 @@ def task_process_myads(message):
             session.commit()
 
     else:
+        # the cached address may be out of date
+        if not message.get('test_send_to', None):
+            app.invalidate_cached_email(userid)
         if message.get('send_retries', None):
             retries = message['send_retries']
         else:
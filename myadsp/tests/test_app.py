@@ -1,12 +1,14 @@
 import unittest
 import os
 import httpretty
+import json
+from mock import patch
 from sqlalchemy.sql.expression import and_
 from datetime import timedelta
 
 import adsputils as utils
 from myadsp import app
-from myadsp.models import AuthorInfo, Results, Base
+from myadsp.models import ArxivCategory, AuthorInfo, KeyValue, SeenResult, QueryCache, UserEmail, UserSetup, Base
 
 
 class TestmyADSCelery(unittest.TestCase):
@@ -79,6 +81,27 @@ class TestmyADSCelery(unittest.TestCase):
         users = app.get_users(since=since)
         self.assertEqual([1,2,3], users)
 
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(AuthorInfo).count(), 3)
+            self.assertIsNone(session.query(AuthorInfo).filter_by(id=2).one().last_sent)
+
+        # new users are inserted in batches; users already stored are left untouched
+        app._config['USERS_CHUNK_SIZE'] = 2
+        httpretty.reset()
+        httpretty.register_uri(
+            httpretty.GET, self.app.conf['API_VAULT_MYADS_USERS'] % since.isoformat(),
+            content_type='application/json',
+            status=200,
+            body='{"users":[1,3,4,5,6]}'
+        )
+
+        users = app.get_users(since=since)
+        self.assertEqual([1,3,4,5,6], sorted(users))
+
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(AuthorInfo).count(), 6)
+            self.assertEqual(session.query(AuthorInfo).filter_by(id=1).one().last_sent, since)
+
     def test_get_recent_results(self):
         app = self.app
         created_1 = utils.get_date('2019-01-01')
@@ -87,12 +110,10 @@ class TestmyADSCelery(unittest.TestCase):
         created_3 = today - timedelta(self.app.conf['STATEFUL_RESULTS_DAYS'] - 1)
 
         with self.app.session_scope() as session:
-            old_res_1 = Results(user_id=2, qid='1234567890abcdefghijklmnopqrstuv', results=['bib1'], created=created_1)
-            old_res_2 = Results(user_id=2, qid='1234567890abcdefghijklmnopqrstuv', results=['bib2','bib3'], created=created_2)
-            newish_res = Results(user_id=2, qid='1234567890abcdefghijklmnopqrstuv', results=['bib4'], created=created_3)
-            session.add(old_res_1)
-            session.add(old_res_2)
-            session.add(newish_res)
+            session.add(SeenResult(user_id=2, query_key='1234567890abcdefghijklmnopqrstuv', bibcode='bib1', created=created_1))
+            session.add(SeenResult(user_id=2, query_key='1234567890abcdefghijklmnopqrstuv', bibcode='bib2', created=created_2))
+            session.add(SeenResult(user_id=2, query_key='1234567890abcdefghijklmnopqrstuv', bibcode='bib3', created=created_2))
+            session.add(SeenResult(user_id=2, query_key='1234567890abcdefghijklmnopqrstuv', bibcode='bib4', created=created_3))
             session.commit()
 
         input_res = ['bib1', 'bib2', 'bib3', 'bib4', 'bib5']
@@ -102,24 +123,20 @@ class TestmyADSCelery(unittest.TestCase):
         self.assertEqual(set(new_res), set(['bib4', 'bib5']))
 
         with self.app.session_scope() as session:
-            new_stored = session.query(Results).filter(and_(Results.qid == '1234567890abcdefghijklmnopqrstuv',
-                                                            Results.user_id == 2,
-                                                            Results.created >= today)).all()
+            new_stored = session.query(SeenResult).filter(and_(SeenResult.query_key == '1234567890abcdefghijklmnopqrstuv',
+                                                               SeenResult.user_id == 2,
+                                                               SeenResult.created >= today)).all()
 
-            new_bibc = []
-            for s in new_stored:
-                new_bibc += s.results
+            new_bibc = [s.bibcode for s in new_stored]
 
-        # new results are stored, excluding results more recent than STATEFUL_RESULTS_DAYS
+        # new results are stored, results more recent than STATEFUL_RESULTS_DAYS keep their first-seen date
         self.assertEqual(new_bibc, ['bib5'])
 
         with self.app.session_scope() as session:
-            old_res_1 = Results(user_id=2, setup_id=123, results=['bib1'], created=created_1)
-            old_res_2 = Results(user_id=2, setup_id=123, results=['bib2', 'bib3'], created=created_2)
-            newish_res = Results(user_id=2, setup_id=123, results=['bib4'], created=created_3)
-            session.add(old_res_1)
-            session.add(old_res_2)
-            session.add(newish_res)
+            session.add(SeenResult(user_id=2, query_key='setup:123', bibcode='bib1', created=created_1))
+            session.add(SeenResult(user_id=2, query_key='setup:123', bibcode='bib2', created=created_2))
+            session.add(SeenResult(user_id=2, query_key='setup:123', bibcode='bib3', created=created_2))
+            session.add(SeenResult(user_id=2, query_key='setup:123', bibcode='bib4', created=created_3))
             session.commit()
 
         input_res = ['bib1', 'bib2', 'bib3', 'bib4', 'bib5']
@@ -129,17 +146,196 @@ class TestmyADSCelery(unittest.TestCase):
         self.assertEqual(set(new_res), set(['bib4', 'bib5']))
 
         with self.app.session_scope() as session:
-            new_stored = session.query(Results).filter(and_(Results.setup_id == 123,
-                                                            Results.user_id == 2,
-                                                            Results.created >= today)).all()
+            new_stored = session.query(SeenResult).filter(and_(SeenResult.query_key == 'setup:123',
+                                                               SeenResult.user_id == 2,
+                                                               SeenResult.created >= today)).all()
 
-            new_bibc = []
-            for s in new_stored:
-                new_bibc += s.results
+            new_bibc = [s.bibcode for s in new_stored]
 
-        # new results are stored, excluding results more recent than STATEFUL_RESULTS_DAYS
+        # new results are stored, results more recent than STATEFUL_RESULTS_DAYS keep their first-seen date
         self.assertEqual(new_bibc, ['bib5'])
 
+        # rerunning with the same results returns the recent results again, without storing duplicates
+        new_res = app.get_recent_results(user_id=2, setup_id=123, input_results=input_res + ['bib5'], ndays=self.app.conf['STATEFUL_RESULTS_DAYS'])
+        self.assertEqual(set(new_res), set(['bib4', 'bib5']))
+
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(SeenResult).filter(and_(SeenResult.query_key == 'setup:123',
+                                                                   SeenResult.user_id == 2)).count(), 5)
+
+    def test_query_cache(self):
+        app = self.app
+        docs = [{'bibcode': 'bib1', 'title': ['Title 1']}, {'bibcode': 'bib2', 'title': ['Title 2']}]
+
+        self.assertIsNone(app.get_cached_query(key='abc', run_id='run1'))
+
+        app.set_cached_query(key='abc', run_id='run1', results=docs)
+        self.assertEqual(app.get_cached_query(key='abc', run_id='run1'), docs)
+        self.assertEqual(app.get_cached_query(key='abc', run_id='run1'), docs)
+        # entries are only valid for the run they were created in
+        self.assertIsNone(app.get_cached_query(key='abc', run_id='run2'))
+
+        # the same query is stored separately for a run in progress at the same time
+        app.set_cached_query(key='abc', run_id='run2', results=docs[:1])
+        self.assertEqual(app.get_cached_query(key='abc', run_id='run1'), docs)
+        self.assertEqual(app.get_cached_query(key='abc', run_id='run2'), docs[:1])
+
+        # expired entries are replaced
+        old = utils.get_date() - timedelta(seconds=app._config.get('QUERY_CACHE_TTL') + 60)
+        with self.app.session_scope() as session:
+            session.query(QueryCache).filter_by(run_id='run1').update({'created': old, 'last_used': old})
+            session.commit()
+        self.assertIsNone(app.get_cached_query(key='abc', run_id='run1'))
+        app.set_cached_query(key='abc', run_id='run1', results=docs[1:])
+        self.assertEqual(app.get_cached_query(key='abc', run_id='run1'), docs[1:])
+
+        # the least recently used entries of the run are evicted once the cache is full
+        app._config['QUERY_CACHE_MAX_ENTRIES'] = 2
+        app.set_cached_query(key='def', run_id='run1', results=docs)
+        with self.app.session_scope() as session:
+            session.query(QueryCache).filter_by(run_id='run1', key='abc').update({'last_used': old})
+            session.commit()
+        # a hit on an entry last used before QUERY_CACHE_TOUCH_INTERVAL marks it as used
+        self.assertEqual(app.get_cached_query(key='abc', run_id='run1'), docs[1:])
+        with self.app.session_scope() as session:
+            session.query(QueryCache).filter_by(run_id='run1', key='def').update({'last_used': old})
+            session.commit()
+        app.set_cached_query(key='ghi', run_id='run1', results=docs)
+        with self.app.session_scope() as session:
+            self.assertEqual(set([(c.run_id, c.key) for c in session.query(QueryCache).all()]),
+                             set([('run1', 'abc'), ('run1', 'ghi'), ('run2', 'abc')]))
+
+        # expired entries are removed at the start of a run
+        with self.app.session_scope() as session:
+            session.query(QueryCache).filter_by(run_id='run2').update({'created': old})
+            session.commit()
+        self.assertEqual(app.expire_cached_queries(), 1)
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(QueryCache).filter_by(run_id='run2').count(), 0)
+            self.assertEqual(session.query(QueryCache).filter_by(run_id='run1').count(), 2)
+
+        # so are the Solr readiness checks of earlier runs
+        with self.app.session_scope() as session:
+            session.add(KeyValue(key='solr.ready.bib1', value=old.isoformat()))
+            session.add(KeyValue(key='solr.ready.bib2', value=utils.get_date().isoformat()))
+            session.add(KeyValue(key='last.setup.sync', value=old.isoformat()))
+            session.commit()
+        self.assertEqual(app.expire_cached_queries(), 1)
+        with self.app.session_scope() as session:
+            self.assertEqual(set(kv.key for kv in session.query(KeyValue).all()),
+                             set(['solr.ready.bib2', 'last.setup.sync']))
+
+    def test_arxiv_category(self):
+        app = self.app
+        results = [['2020-01-01T00:00', '2020-01-00', ['2020arXiv200100001K', 'Paper 1', ['Kurtz, M'], 1,
+                                                         None, None, 'arXiv:2001.00001']]]
+        self.assertIsNone(app.get_arxiv_category(run_id='run1', arxiv_class='astro-ph.*'))
+        app.set_arxiv_category(run_id='run1', arxiv_class='astro-ph.*', start='2019-12-25T00:00', results=results)
+        app.set_arxiv_category(run_id='run2', arxiv_class='astro-ph.*', start='2019-12-26T00:00', results=[])
+        self.assertEqual(app.get_arxiv_category(run_id='run1', arxiv_class='astro-ph.*'), ('2019-12-25T00:00', results))
+        self.assertIsNone(app.get_arxiv_category(run_id='run1', arxiv_class='gr-qc.*'))
+
+        # lists are expired with the query cache
+        with self.app.session_scope() as session:
+            session.query(ArxivCategory).filter_by(run_id='run1').\
+                update({'created': utils.get_date() - timedelta(days=2)})
+            session.commit()
+        self.assertEqual(app.expire_cached_queries(), 1)
+        self.assertIsNone(app.get_arxiv_category(run_id='run1', arxiv_class='astro-ph.*'))
+        self.assertEqual(app.get_arxiv_category(run_id='run2', arxiv_class='astro-ph.*'), ('2019-12-26T00:00', []))
+
+
+    def test_email_cache(self):
+        app = self.app
+
+        self.assertEqual(app.get_cached_emails([1, 2]), {})
+
+        app.set_cached_emails({1: 'one@test.com', 2: 'two@test.com'})
+        app.set_cached_emails({2: 'new@test.com'})
+        self.assertEqual(app.get_cached_emails([1, 2, 3]), {1: 'one@test.com', 2: 'new@test.com'})
+
+        app.invalidate_cached_email(1)
+        self.assertEqual(app.get_cached_emails([1, 2]), {2: 'new@test.com'})
+
+        # entries expire at a random time within the last EMAIL_CACHE_TTL_JITTER of the TTL
+        ttl = app._config.get('EMAIL_CACHE_TTL')
+        app.set_cached_emails(dict((user_id, 'user@test.com') for user_id in range(10, 110)))
+        with self.app.session_scope() as session:
+            entries = session.query(UserEmail).filter(UserEmail.user_id >= 10).all()
+            ttls = [(e.expires - e.updated).total_seconds() for e in entries]
+        self.assertTrue(all((1 - app._config.get('EMAIL_CACHE_TTL_JITTER')) * ttl <= t <= ttl for t in ttls))
+        self.assertGreater(len(set(ttls)), 1)
+
+        # expired entries aren't returned
+        with self.app.session_scope() as session:
+            session.query(UserEmail).filter_by(user_id=2).one().expires = utils.get_date() - timedelta(seconds=1)
+            session.commit()
+        self.assertEqual(app.get_cached_emails([1, 2]), {})
+
+    def test_setup_cache(self):
+        app = self.app
+        query_setup = {'id': 1, 'type': 'query', 'qid': 'abc', 'frequency': 'weekly'}
+        template_setup = {'id': 2, 'type': 'template', 'template': 'arxiv', 'frequency': 'daily',
+                          'query': [{'q': 'bibstem:arxiv entdate:["2020-01-01Z00:00" TO "2020-01-01Z23:59"]',
+                                     'sort': 'bibcode desc'}]}
+
+        self.assertIsNone(app.get_cached_setup(1, frequency='daily'))
+
+        app.set_cached_setups({1: [query_setup, template_setup], 2: [query_setup]})
+        app.set_cached_setups({2: []})
+        self.assertEqual(app.get_cached_setup(1, frequency='daily'), [query_setup, template_setup])
+        self.assertEqual(app.get_cached_setup(2, frequency='weekly'), [])
+
+        # users missing from the mirror are never filtered out
+        self.assertEqual(app.get_users_without_frequency([1, 2, 3], frequency='daily'), {2})
+        self.assertEqual(app.get_users_without_frequency([1, 2, 3], frequency='weekly'), {2})
+        app.set_cached_setups({2: [query_setup]})
+        self.assertEqual(app.get_users_without_frequency([1, 2, 3], frequency='daily'), {2})
+        self.assertEqual(app.get_users_without_frequency([1, 2, 3], frequency='weekly'), set())
+
+        # templated queries are built by vault for the day they're fetched on
+        with self.app.session_scope() as session:
+            session.query(UserSetup).filter_by(user_id=1).one().updated = utils.get_date('2019-01-01')
+            session.commit()
+        self.assertIsNone(app.get_cached_setup(1, frequency='daily'))
+        self.assertEqual(app.get_cached_setup(1, frequency='weekly'), [query_setup, template_setup])
+
+        # templated setups that can be built locally are stored as template parameters, and built for the day
+        # they're run on
+        now = utils.get_date()
+        arxiv_setup = {'id': 3, 'type': 'template', 'template': 'arxiv', 'frequency': 'daily', 'data': None,
+                       'classes': ['astro-ph']}
+        app.set_cached_setups({4: [dict(arxiv_setup, query=app.build_template_query(arxiv_setup, now.date()))]})
+        with self.app.session_scope() as session:
+            entry = session.query(UserSetup).filter_by(user_id=4).one()
+            self.assertEqual(json.loads(entry.setups), [arxiv_setup])
+            entry.updated = utils.get_date('2019-01-01')
+            session.commit()
+        with patch('myadsp.app.get_date', return_value=now + timedelta(days=1)):
+            self.assertEqual(app.get_cached_setup(4, frequency='daily'),
+                             [dict(arxiv_setup, query=app.build_template_query(arxiv_setup,
+                                                                               (now + timedelta(days=1)).date()))])
+
+        # templates and frequencies whose queries differed from vault's at today's check are fetched from vault
+        app.set_setup_mismatches(now.date(), {('arxiv', 'daily')})
+        self.assertEqual(app.get_setup_mismatches(now.date()), {('arxiv', 'daily')})
+        self.assertIsNone(app.get_cached_setup(4, frequency='daily'))
+        self.assertEqual(app.get_setup_mismatches((now + timedelta(days=1)).date()), set())
+        app.set_setup_mismatches(now.date(), set())
+        self.assertEqual(app.get_cached_setup(4, frequency='daily'),
+                         [dict(arxiv_setup, query=app.build_template_query(arxiv_setup, now.date()))])
+        self.assertEqual(app.sample_cached_setups(), [4])
+
+        # so are setups stored by another version of the query builder
+        with self.app.session_scope() as session:
+            session.query(UserSetup).filter_by(user_id=4).one().builder_version = None
+            session.commit()
+        self.assertIsNone(app.get_cached_setup(4, frequency='daily'))
+
+        app.invalidate_cached_setups([1, 2])
+        self.assertIsNone(app.get_cached_setup(1, frequency='weekly'))
+        self.assertIsNone(app.get_cached_setup(2, frequency='weekly'))
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
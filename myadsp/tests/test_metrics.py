@@ -0,0 +1,91 @@
+import unittest
+import errno
+import os
+import shutil
+import socket
+import tempfile
+from mock import Mock, patch
+
+from myadsp import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.registry = metrics.Registry(buckets=(0.1, 1.0))
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+
+    def test_timer(self):
+        self.registry.observe(metrics.STAGE_SECONDS, 0.05, stage='query', frequency='daily', template='arxiv')
+        self.registry.observe(metrics.STAGE_SECONDS, 0.5, stage='query', frequency='daily', template='arxiv')
+        with self.registry.timer('send_email', frequency='daily'):
+            pass
+        with self.assertRaises(RuntimeError):
+            with self.registry.timer('setup', frequency='weekly'):
+                raise RuntimeError('vault is down')
+        self.registry.inc('myads_emails_total', frequency='daily', status='sent')
+        self.registry.inc('myads_emails_total', frequency='daily', status='sent')
+
+        text = self.registry.render()
+        self.assertIn('# TYPE myads_stage_seconds histogram', text)
+        self.assertIn('myads_stage_seconds_bucket{frequency="daily",stage="query",template="arxiv",le="0.1"} 1', text)
+        self.assertIn('myads_stage_seconds_bucket{frequency="daily",stage="query",template="arxiv",le="1.0"} 2', text)
+        self.assertIn('myads_stage_seconds_bucket{frequency="daily",stage="query",template="arxiv",le="+Inf"} 2', text)
+        self.assertIn('myads_stage_seconds_sum{frequency="daily",stage="query",template="arxiv"} 0.55', text)
+        self.assertIn('myads_stage_seconds_count{frequency="daily",stage="send_email"} 1', text)
+        self.assertIn('myads_stage_seconds_count{frequency="weekly",stage="setup"} 1', text)
+        self.assertIn('# TYPE myads_stage_errors_total counter', text)
+        self.assertIn('myads_stage_errors_total{frequency="weekly",stage="setup"} 1', text)
+        self.assertIn('myads_emails_total{frequency="daily",status="sent"} 2', text)
+
+    def test_flush(self):
+        self.assertIsNone(self.registry.flush(None))
+
+        host = socket.gethostname()
+        self.registry.inc('myads_emails_total', frequency='daily', status='failed')
+        path = self.registry.flush(self.tmpdir)
+        self.assertEqual(path, os.path.join(self.tmpdir, 'myads_{0}_0.prom'.format(host)))
+        with open(path) as f:
+            text = f.read()
+        self.assertTrue(text.startswith('# pid {0}\n'.format(os.getpid())))
+        self.assertIn('myads_emails_total{{frequency="daily",status="failed",host="{0}",index="0"}} 1'.
+                      format(host), text)
+
+        # rate limited
+        self.assertIsNone(self.registry.flush(self.tmpdir, min_interval=60))
+        self.assertEqual(os.listdir(self.tmpdir), ['myads_{0}_0.prom'.format(host)])
+
+        # a restarted process takes over the file of the pool index it replaces
+        with patch.object(metrics, 'current_process', return_value=Mock(index=1)):
+            self.assertEqual(metrics.Registry().flush(self.tmpdir),
+                             os.path.join(self.tmpdir, 'myads_{0}_1.prom'.format(host)))
+
+        self.registry.remove(self.tmpdir)
+        self.assertEqual(os.listdir(self.tmpdir), ['myads_{0}_1.prom'.format(host)])
+
+    def test_remove_stale(self):
+        self.assertEqual(metrics.remove_stale(None), [])
+
+        host = socket.gethostname()
+        running = os.path.join(self.tmpdir, 'myads_{0}_0.prom'.format(host))
+        self.registry.flush(self.tmpdir)
+        stale = os.path.join(self.tmpdir, 'myads_{0}_1.prom'.format(host))
+        other_host = os.path.join(self.tmpdir, 'myads_{0}-other_1.prom'.format(host))
+        for path in (stale, other_host):
+            with open(path, 'w') as f:
+                f.write('# pid 999999\nmyads_emails_total 1\n')
+
+        with patch.object(metrics.os, 'kill', side_effect=lambda pid, sig: self._kill(pid)):
+            self.assertEqual(metrics.remove_stale(self.tmpdir), [stale])
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         sorted(os.path.basename(p) for p in (running, other_host)))
+
+    @staticmethod
+    def _kill(pid):
+        if pid != os.getpid():
+            raise OSError(errno.ESRCH, 'No such process')
@@ -0,0 +1,61 @@
+import unittest
+import datetime
+
+from myadsp.queries import build_template_query
+
+
+class TestQueries(unittest.TestCase):
+
+    # a Wednesday
+    date = datetime.date(2020, 1, 8)
+
+    def test_arxiv(self):
+        setup = {'type': 'template', 'template': 'arxiv', 'frequency': 'daily', 'data': 'AGN',
+                 'classes': ['astro-ph', 'physics.space-ph']}
+        self.assertEqual(build_template_query(setup, self.date),
+                         [{'q': 'bibstem:arxiv (arxiv_class:(astro-ph.* OR physics.space-ph) (AGN)) '
+                                'entdate:["2020-01-08Z00:00" TO NOW] pubdate:[2019-00 TO *]',
+                           'sort': 'score desc, bibcode desc'},
+                          {'q': 'bibstem:arxiv (arxiv_class:(astro-ph.* OR physics.space-ph) NOT (AGN)) '
+                                'entdate:["2020-01-08Z00:00" TO NOW] pubdate:[2019-00 TO *]',
+                           'sort': 'bibcode desc'}])
+
+        # on Mondays, daily queries include the weekend
+        setup = dict(setup, data=None)
+        self.assertEqual(build_template_query(setup, datetime.date(2020, 1, 6)),
+                         [{'q': 'bibstem:arxiv arxiv_class:(astro-ph.* OR physics.space-ph) '
+                                'entdate:["2020-01-04Z00:00" TO NOW] pubdate:[2019-00 TO *]',
+                           'sort': 'bibcode desc'}])
+
+        setup = dict(setup, frequency='weekly', data='AGN')
+        self.assertEqual(build_template_query(setup, self.date, weekly_range=6),
+                         [{'q': 'bibstem:arxiv (arxiv_class:(astro-ph.* OR physics.space-ph) (AGN)) '
+                                'entdate:["2020-01-02Z00:00" TO "2020-01-08Z23:59"] pubdate:[2019-00 TO *]',
+                           'sort': 'score desc, bibcode desc'}])
+
+        self.assertIsNone(build_template_query(dict(setup, classes=None), self.date))
+
+    def test_other_templates(self):
+        self.assertEqual(build_template_query({'template': 'citations', 'frequency': 'weekly',
+                                               'data': 'author:"Kurtz, M."'}, self.date),
+                         [{'q': 'citations(author:"Kurtz, M.")', 'sort': 'entry_date desc, bibcode desc'}])
+        self.assertEqual(build_template_query({'template': 'authors', 'frequency': 'weekly',
+                                               'data': 'author:"Kurtz, M."'}, self.date),
+                         [{'q': 'author:"Kurtz, M." entdate:["2020-01-02Z00:00" TO "2020-01-08Z23:59"] '
+                                'pubdate:[2019-00 TO *]',
+                           'sort': 'score desc, bibcode desc'}])
+        self.assertEqual(build_template_query({'template': 'keyword', 'frequency': 'weekly', 'data': 'AGN'},
+                                              self.date),
+                         [{'q': 'AGN entdate:["2020-01-02Z00:00" TO "2020-01-08Z23:59"] pubdate:[2019-00 TO *]',
+                           'sort': 'entry_date desc, bibcode desc'},
+                          {'q': 'trending(AGN)', 'sort': 'score desc, bibcode desc'},
+                          {'q': 'useful(AGN)', 'sort': 'score desc, bibcode desc'}])
+
+        self.assertIsNone(build_template_query({'template': 'keyword', 'frequency': 'weekly', 'data': None},
+                                               self.date))
+        self.assertIsNone(build_template_query({'template': 'unknown', 'frequency': 'weekly', 'data': 'AGN'},
+                                               self.date))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import json
+
+from myadsp import utils
+from myadsp.records import SearchResult, digest
+
+
+class TestRecords(unittest.TestCase):
+
+    doc = {u'bibcode': u'2019arXiv190800829P',
+           u'title': [u'Gravitational wave signatures from an extended inert doublet dark matter model'],
+           u'author_norm': [u'Paul, A', u'Banerjee, B', u'Majumdar, D', u'Other, A', u'Other, B'],
+           u'identifier': [u'2019arXiv190800829P', u'arXiv:1908.00829'],
+           u'year': u'2019',
+           u'bibstem': [u'arXiv', u'arXiv1908']}
+
+    def test_from_doc(self):
+        # the arXiv ID is only resolved for the results of templated queries
+        self.assertIsNone(SearchResult.from_doc(self.doc).arxiv_id)
+        r = SearchResult.from_doc(self.doc, resolve_arxiv_id=True)
+        self.assertEqual(r.bibcode, u'2019arXiv190800829P')
+        self.assertEqual(r.title, u'Gravitational wave signatures from an extended inert doublet dark matter model')
+        self.assertEqual(r.authors, (u'Paul, A', u'Banerjee, B', u'Majumdar, D'))
+        self.assertEqual(r.num_authors, 5)
+        self.assertEqual(r.bibstem, (u'arXiv',))
+        self.assertEqual(r.arxiv_id, u'arXiv:1908.00829')
+        self.assertFalse(hasattr(r, '__dict__'))
+
+        # dict-style access, as used on the raw Solr docs
+        self.assertEqual(r['bibcode'], u'2019arXiv190800829P')
+        self.assertTrue('arxiv_id' in r)
+        r = SearchResult.from_doc({u'bibcode': u'1971JVST....8..324K', u'identifier': [u'1971JVST....8..324K']})
+        self.assertFalse('arxiv_id' in r)
+        self.assertIsNone(r.get('arxiv_id'))
+        self.assertRaises(KeyError, lambda: r['arxiv_id'])
+        self.assertEqual(r.title, u'')
+
+        self.assertEqual(SearchResult.from_doc(self.doc), SearchResult.from_doc(dict(self.doc)))
+        self.assertNotEqual(SearchResult.from_doc(self.doc), r)
+
+    def test_compact_form(self):
+        r = SearchResult.from_doc(dict(self.doc, bibstem=[u'arXiv'], year=u'2019'))
+        self.assertEqual(SearchResult.from_list(json.loads(json.dumps(r.to_list()))), r)
+        r = SearchResult.from_doc({u'bibcode': u'1971JVST....8..324K', u'author_norm': u'Kurtz, J'})
+        self.assertEqual(SearchResult.from_list(json.loads(json.dumps(r.to_list()))), r)
+
+    def test_digest(self):
+        r = SearchResult.from_doc(self.doc)
+        other = SearchResult.from_doc(dict(self.doc, title=[u'Other title']))
+        self.assertEqual(digest([r, other]), digest([SearchResult.from_doc(self.doc), other]))
+        self.assertNotEqual(digest([r, other]), digest([other, r]))
+        self.assertNotEqual(digest([r]), digest([r, r]))
+        self.assertEqual(len(digest([])), 40)
+
+    def test_formatting(self):
+        r = SearchResult.from_doc(self.doc, resolve_arxiv_id=True)
+        self.assertEqual(utils._get_first_author_formatted(r), u'Paul, A; Banerjee, B; Majumdar, D and 2 more')
+        self.assertEqual(utils._get_first_author_formatted(r, num_authors=1), u'Paul, A and 4 more')
+        # asking for more authors than are kept doesn't drop the others
+        self.assertEqual(utils._get_first_author_formatted(r, num_authors=5), u'Paul, A; Banerjee, B; Majumdar, D and 2 more')
+        self.assertEqual(utils._get_first_author_formatted(SearchResult.from_doc(dict(self.doc, author_norm=[u'Paul, A', u'Banerjee, B']))),
+                         u'Paul, A and Banerjee, B')
+        self.assertEqual(utils._get_first_author_formatted(SearchResult.from_doc({u'bibcode': u'1971JVST....8..324K'})), '')
+        self.assertEqual(utils._get_title(r), r.title)
+
+        payload = [{'name': 'Test', 'query_url': 'https://path/to/query?{0}{1}', 'qtype': 'arXiv', 'id': 1,
+                    'results': [r]}]
+        self.assertEqual(utils.payload_to_plain(payload),
+                         u'Test (https://path/to/query?arXiv1) \n'
+                         u'"Gravitational wave signatures from an extended inert doublet dark matter model," '
+                         u'Paul, A; Banerjee, B; Majumdar, D and 2 more (2019arXiv190800829P)\n\n')
+        self.assertIn(u'arXiv:1908.00829', utils.payload_to_html(payload, col=1, email_address='test@test.com'))
+        self.assertIn(u'arXiv:1908.00829', utils.payload_to_html(payload, col=2, email_address='test@test.com'))
+
+
+if __name__ == '__main__':
+    unittest.main()
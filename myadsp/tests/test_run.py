@@ -0,0 +1,129 @@
+import unittest
+from mock import patch, MagicMock
+import gzip
+import os
+import shutil
+import tempfile
+import time
+from StringIO import StringIO
+
+import run
+
+
+class TestRun(unittest.TestCase):
+
+    def _conn(self, depths):
+        """Broker connection whose queue depth checks return (or raise) the given values in turn"""
+        def queue_declare(queue=None, passive=False):
+            depth = depths.pop(0)
+            if isinstance(depth, Exception):
+                raise depth
+            return MagicMock(message_count=depth)
+
+        conn = MagicMock()
+        conn.channel.return_value.queue_declare.side_effect = queue_declare
+        return conn
+
+    def test_wait_for_queue(self):
+        with patch('time.sleep') as sleep:
+            # no pause while the queue is below the limit
+            self.assertEqual(run._wait_for_queue(self._conn([5]), 'process', 10, 1), 5)
+            self.assertEqual(sleep.call_count, 0)
+
+            # pauses until the queue drains below the limit
+            self.assertEqual(run._wait_for_queue(self._conn([20, 15, 8]), 'process', 10, 1), 8)
+            self.assertEqual(sleep.call_count, 2)
+
+            # a broker error backs off and keeps the last known depth, so the throttle stays on
+            sleep.reset_mock()
+            self.assertEqual(run._wait_for_queue(self._conn([IOError(), IOError(), 3]), 'process', 10, 1,
+                                                 last_depth=20), 3)
+            self.assertEqual(sleep.call_count, 3)
+
+            sleep.reset_mock()
+            self.assertEqual(run._wait_for_queue(self._conn([IOError()]), 'process', 10, 1, last_depth=4), 4)
+            self.assertEqual(sleep.call_count, 1)
+
+    def test_dispatch_tasks(self):
+        conn = self._conn([0, 30, 0])
+        with patch.dict(run.config, {'DISPATCH_CHUNK_SIZE': 2, 'DISPATCH_MAX_QUEUE_DEPTH': 10,
+                                     'DISPATCH_THROTTLE_DELAY': 1}), \
+                patch('time.sleep') as sleep, \
+                patch.object(run.app, 'connection_for_write') as connection_for_write, \
+                patch.object(run.app, 'producer_or_acquire'), \
+                patch.object(run.tasks.task_process_myads, 'apply_async') as apply_async:
+            connection_for_write.return_value.__enter__.return_value = conn
+            self.assertEqual(run._dispatch_tasks([1, 2, 3], {'frequency': 'daily'}), [])
+
+            # the depth of the task's queue is checked before each chunk
+            self.assertEqual([c[1]['queue'] for c in conn.channel.return_value.queue_declare.call_args_list],
+                             ['process'] * 3)
+            self.assertEqual(sleep.call_count, 1)
+            self.assertEqual([c[1]['args'][0] for c in apply_async.call_args_list],
+                             [{'frequency': 'daily', 'userid': u} for u in [1, 2, 3]])
+
+    def test_arxiv_ingest_file_ready(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        arxiv_file = os.path.join(tmp, 'UpdateAgent.out.2020-01-02.gz')
+        buf = StringIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            f.write('oai/arXiv.org/2001/00001 2020-01-02T01:00:29\n'
+                    'oai/arXiv.org/2001/00002 2020-01-02T01:00:30\n'
+                    'oai/arXiv.org/astro-ph/0001001 2020-01-02T01:00:31\n')
+        data = buf.getvalue()
+
+        def write(content, mtime):
+            with open(arxiv_file, 'wb') as f:
+                f.write(content)
+            os.utime(arxiv_file, (mtime, mtime))
+
+        checks = []
+
+        def wait_for_file(path, check, timeout, poll_interval=30):
+            now = time.time()
+            # still being written: the file changes between checks, and a truncated gzip can't be read yet
+            write(data[:len(data) // 2], now - 2)
+            checks.append(check(False))
+            write(data[:len(data) // 2] + '\0' * 4, now - 1)
+            checks.append(check(False))
+            checks.append(check(False))
+            # written completely
+            write(data, now)
+            checks.append(check(False))
+            checks.append(check(False))
+            return checks[-1]
+
+        with patch.dict(run.config, {'ARXIV_UPDATE_AGENT_DIR': tmp, 'ARXIV_INCOMING_ABS_DIR': tmp}), \
+                patch.object(run.watch, 'wait_for_file', side_effect=wait_for_file):
+            # the abstract of the last record isn't there, so the check stops before probing solr
+            self.assertIsNone(run._arxiv_ingest_complete(date='2020-01-02'))
+        self.assertEqual(checks, [None, None, None, None, ['oai/arXiv.org/2001/00002']])
+
+        # a file that was last written longer ago than the time between checks is read on the first check
+        def wait_for_file_once(path, check, timeout, poll_interval=30):
+            checks.append(check(False))
+            return checks[-1]
+
+        checks = []
+        write(data, time.time() - 3600)
+        with patch.dict(run.config, {'ARXIV_UPDATE_AGENT_DIR': tmp, 'ARXIV_INCOMING_ABS_DIR': tmp}), \
+                patch.object(run.watch, 'wait_for_file', side_effect=wait_for_file_once):
+            self.assertIsNone(run._arxiv_ingest_complete(date='2020-01-02'))
+        self.assertEqual(checks, [['oai/arXiv.org/2001/00002']])
+
+        # a file just closed after writing is read right away, without waiting for the next check
+        def wait_for_file_closed(path, check, timeout, poll_interval=30):
+            checks.append(check(True))
+            return checks[-1]
+
+        checks = []
+        write(data, time.time())
+        with patch.dict(run.config, {'ARXIV_UPDATE_AGENT_DIR': tmp, 'ARXIV_INCOMING_ABS_DIR': tmp}), \
+                patch.object(run.watch, 'wait_for_file', side_effect=wait_for_file_closed):
+            self.assertIsNone(run._arxiv_ingest_complete(date='2020-01-02'))
+        self.assertEqual(checks, [['oai/arXiv.org/2001/00002']])
+
+
+if __name__ == '__main__':
+    unittest.main()
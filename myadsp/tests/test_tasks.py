@@ -2,12 +2,14 @@ import unittest
 import sys
 import os
 import json
+import time
+import datetime
 import httpretty
 from mock import patch
 
 import adsputils
-from myadsp import app, utils, tasks
-from myadsp.models import Base, AuthorInfo
+from myadsp import app, utils, tasks, metrics
+from myadsp.models import Base, AuthorInfo, KeyValue
 from ..emails import myADSTemplate
 
 class TestmyADSCelery(unittest.TestCase):
@@ -152,16 +154,14 @@ class TestmyADSCelery(unittest.TestCase):
 
         with patch.object(self.app, 'get_recent_results') as get_recent_results, \
             patch.object(utils, 'get_user_email') as get_user_email, \
-            patch.object(utils, 'payload_to_plain') as payload_to_plain, \
-            patch.object(utils, 'payload_to_html') as payload_to_html, \
+            patch.object(utils, 'render_payload') as render_payload, \
             patch.object(utils, 'send_email') as send_email, \
             patch.object(tasks.task_process_myads, 'apply_async') as rerun_task:
 
             get_recent_results.return_value = ['2019arXiv190800829P', '2019arXiv190800678L']
             get_user_email.return_value = 'test@test.com'
-            payload_to_plain.return_value = 'plain payload'
-            payload_to_html.return_value = '<em>html payload</em>'
-            send_email.return_value = 'this should be a MIMEMultipart object'
+            render_payload.return_value = ('plain payload', '<em>html payload</em>')
+            send_email.return_value = True
 
             tasks.task_process_myads(msg)
             self.assertTrue(rerun_task.called)
@@ -360,15 +360,13 @@ class TestmyADSCelery(unittest.TestCase):
 
         with patch.object(self.app, 'get_recent_results') as get_recent_results, \
             patch.object(utils, 'get_user_email') as get_user_email, \
-            patch.object(utils, 'payload_to_plain') as payload_to_plain, \
-            patch.object(utils, 'payload_to_html') as payload_to_html, \
+            patch.object(utils, 'render_payload') as render_payload, \
             patch.object(utils, 'send_email') as send_email:
 
             get_recent_results.return_value = ['2019arXiv190800829P', '2019arXiv190800678L']
             get_user_email.return_value = 'test@test.com'
-            payload_to_plain.return_value = 'plain payload'
-            payload_to_html.return_value = '<em>html payload</em>'
-            send_email.return_value = 'this should be a MIMEMultipart object'
+            render_payload.return_value = ('plain payload', '<em>html payload</em>')
+            send_email.return_value = True
 
             # already ran today, tried to run again without force=True
             with patch.object(tasks.logger, 'warning', return_value=None) as logger:
@@ -392,4 +390,73 @@ class TestmyADSCelery(unittest.TestCase):
 
             with self.app.session_scope() as session:
                 user = session.query(AuthorInfo).filter_by(id=123).first()
-                self.assertEqual(adsputils.get_date().date(), user.last_sent.date())
\ No newline at end of file
+                self.assertEqual(adsputils.get_date().date(), user.last_sent.date())
+
+    def test_fetch_setup_results(self):
+        setups = [{'id': 1, 'type': 'query', 'frequency': 'weekly'},
+                  {'id': 2, 'type': 'query', 'frequency': 'weekly'},
+                  {'id': 3, 'type': 'template', 'template': 'citations', 'frequency': 'weekly'}]
+
+        def get_results(s, run_id=None):
+            # the first setup is the slowest
+            time.sleep(0.05 * (4 - s['id']))
+            return [{'name': 'Query {0}'.format(s['id']), 'run_id': run_id}]
+
+        with patch.object(utils, 'get_query_results', side_effect=get_results), \
+            patch.object(utils, 'get_template_query_results', side_effect=get_results):
+            fetched = tasks._get_query_pool().map(tasks._fetch_setup_results, [(s, 'run1') for s in setups])
+
+        # results come back in setup order
+        self.assertEqual([f[0][0]['name'] for f in fetched], ['Query 1', 'Query 2', 'Query 3'])
+        self.assertEqual(fetched[2][0][0]['run_id'], 'run1')
+        self.assertEqual([f[1] for f in fetched], [None, None, None])
+        # query timings are recorded by template
+        text = metrics.render()
+        self.assertIn('myads_stage_seconds_count{frequency="weekly",stage="query",template="general"}', text)
+        self.assertIn('myads_stage_seconds_count{frequency="weekly",stage="query",template="citations"}', text)
+
+        # query errors are returned with the results, instead of being raised
+        with patch.object(utils, 'get_query_results', side_effect=RuntimeError('error')):
+            raw_results, error = tasks._fetch_setup_results((setups[0], None))
+        self.assertIsNone(raw_results)
+        self.assertIsInstance(error, RuntimeError)
+
+    @httpretty.activate
+    def test_solr_searcher_ready(self):
+        httpretty.register_uri(
+            httpretty.GET, self.app.conf['API_SOLR_QUERY_ENDPOINT'],
+            content_type='application/json',
+            status=200,
+            body=json.dumps({'response': {'numFound': 0, 'docs': []}})
+        )
+
+        # failed checks aren't stored
+        self.assertFalse(tasks._solr_searcher_ready('2020arXiv200100001K', 123))
+        with self.app.session_scope() as session:
+            self.assertIsNone(session.query(KeyValue).filter_by(key='solr.ready.2020arXiv200100001K').first())
+
+        httpretty.reset()
+        httpretty.register_uri(
+            httpretty.GET, self.app.conf['API_SOLR_QUERY_ENDPOINT'],
+            content_type='application/json',
+            status=200,
+            body=json.dumps({'response': {'numFound': 1, 'docs': [{'bibcode': '2020arXiv200100001K'}]}})
+        )
+        self.assertTrue(tasks._solr_searcher_ready('2020arXiv200100001K', 123))
+
+        # the successful check is shared, so solr isn't queried again
+        httpretty.reset()
+        httpretty.register_uri(
+            httpretty.GET, self.app.conf['API_SOLR_QUERY_ENDPOINT'],
+            content_type='application/json',
+            status=500,
+            body='error'
+        )
+        self.assertTrue(tasks._solr_searcher_ready('2020arXiv200100001K', 456))
+
+        # until the stored check expires
+        with self.app.session_scope() as session:
+            kv = session.query(KeyValue).filter_by(key='solr.ready.2020arXiv200100001K').one()
+            kv.value = (adsputils.get_date() - datetime.timedelta(days=1)).isoformat()
+            session.commit()
+        self.assertFalse(tasks._solr_searcher_ready('2020arXiv200100001K', 456))
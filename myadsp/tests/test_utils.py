@@ -3,12 +3,18 @@ import os
 import httpretty
 from mock import patch
 import urllib
+import smtplib
 import json
 import datetime
+import shutil
+import email
+import StringIO
+import tempfile
 
 import adsputils
-from myadsp import app, utils
-from myadsp.models import Base
+from myadsp import app, metrics, utils
+from myadsp.models import Base, KeyValue
+from myadsp.records import SearchResult
 from ..emails import myADSTemplate
 
 payload = [{'name': 'Query 1',
@@ -81,17 +87,104 @@ class TestmyADSCelery(unittest.TestCase):
 
     def test_send_email(self):
         email_addr = 'to@test.com'
-        payload_plain = 'plain test'
+        payload_plain = u'plain test\n.starts with a dot\r\nnon-ASCII \xe9 dropped'
         payload_html = '<em>html test</em>'
         with patch('smtplib.SMTP') as mock_smtp:
+            server = mock_smtp.return_value
+            server.mail.return_value = (250, 'OK')
+            server.rcpt.return_value = (250, 'OK')
+            server.getreply.side_effect = [(354, 'Go ahead'), (250, 'OK')]
             msg = utils.send_email(email_addr,
                                    email_template=myADSTemplate,
                                    payload_plain=payload_plain,
                                    payload_html=payload_html)
-
-            self.assertTrue(payload_plain in msg.get_payload()[0].get_payload())
-            self.assertTrue(payload_html in msg.get_payload()[1].get_payload())
-            self.assertTrue(myADSTemplate.subject == msg.get('subject'))
+            self.assertTrue(msg)
+
+            # the message is sent in the DATA format
+            server.mail.assert_called_with(self.app.conf.get('MAIL_DEFAULT_SENDER'))
+            server.rcpt.assert_called_with(email_addr)
+            data = ''.join(c[0][0] for c in server.send.call_args_list)
+            self.assertTrue(data.endswith('\r\n.\r\n'))
+            self.assertNotIn('\n', data.replace('\r\n', ''))
+            self.assertIn('\r\n..starts with a dot\r\n', data)
+
+            sent = email.message_from_string(data[:-len('.\r\n')].replace('\r\n', '\n'))
+            self.assertEqual(sent.get('subject'), myADSTemplate.subject)
+            self.assertEqual(sent.get('to'), email_addr)
+            self.assertTrue(u'plain test\n..starts with a dot\nnon-ASCII  dropped' in sent.get_payload()[0].get_payload())
+            self.assertTrue(payload_html in sent.get_payload()[1].get_payload())
+
+            # sending failed
+            server.getreply.side_effect = [(354, 'Go ahead'), (554, 'Rejected')]
+            self.assertIsNone(utils.send_email(email_addr, email_template=myADSTemplate, payload_plain=payload_plain,
+                                               payload_html=payload_html))
+
+    def test_smtp_data_writer(self):
+        f = StringIO.StringIO()
+        writer = utils.SMTPDataWriter(f, chunk_size=3)
+        writer.write(u'.a\r\nb\r\r\n.c\n..d\re')
+        writer.finish()
+        self.assertEqual(f.getvalue(), '..a\r\nb\r\n\r\n..c\r\n...d\r\ne\r\n')
+
+        f = StringIO.StringIO()
+        writer = utils.SMTPDataWriter(f)
+        writer.write_template(myADSTemplate.msg_html, payload=u'<p>\xe9t\xe9</p>', email_address='to@test.com')
+        writer.finish()
+        self.assertEqual(f.getvalue(), '<p>t</p>\r\n')
+
+    def test_smtp_connection_pool(self):
+        pool = utils.SMTPConnectionPool(server='localhost', port=25, size=1, max_messages=2, max_idle=60)
+        with patch('smtplib.SMTP') as mock_smtp:
+            server = mock_smtp.return_value
+            server.noop.return_value = (250, 'OK')
+            server.mail.return_value = (250, 'OK')
+            server.rcpt.return_value = (250, 'OK')
+            server.data.return_value = (250, 'OK')
+
+            # the connection is reused for the next message
+            pool.sendmail('from@test.com', 'to@test.com', 'msg 1')
+            pool.sendmail('from@test.com', 'to@test.com', 'msg 2')
+            self.assertEqual(mock_smtp.call_count, 1)
+            self.assertEqual(server.data.call_count, 2)
+
+            # the connection is recycled after max_messages messages
+            self.assertEqual(server.quit.call_count, 1)
+            pool.sendmail('from@test.com', 'to@test.com', 'msg 3')
+            self.assertEqual(mock_smtp.call_count, 2)
+
+            # dead connections are replaced
+            server.noop.side_effect = smtplib.SMTPServerDisconnected()
+            pool.sendmail('from@test.com', 'to@test.com', 'msg 4')
+            self.assertEqual(mock_smtp.call_count, 3)
+
+            # a reused connection dropped before the sender is accepted is reopened and the message sent
+            server.noop.side_effect = None
+            server.mail.side_effect = [smtplib.SMTPServerDisconnected(), (250, 'OK')]
+            pool.sendmail('from@test.com', 'to@test.com', 'msg 5')
+            self.assertEqual(mock_smtp.call_count, 4)
+            self.assertEqual(server.data.call_count, 5)
+
+            # a new connection isn't retried
+            pool.close_all()
+            server.mail.side_effect = [smtplib.SMTPServerDisconnected()]
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                pool.sendmail('from@test.com', 'to@test.com', 'msg 6')
+            self.assertEqual(mock_smtp.call_count, 5)
+
+            # a connection dropped after the sender was accepted isn't retried, so the message isn't sent twice
+            server.mail.side_effect = None
+            pool.sendmail('from@test.com', 'to@test.com', 'msg 7')
+            server.data.side_effect = smtplib.SMTPServerDisconnected()
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                pool.sendmail('from@test.com', 'to@test.com', 'msg 8')
+            self.assertEqual(mock_smtp.call_count, 6)
+            self.assertEqual(server.data.call_count, 7)
+            self.assertEqual(pool._idle, [])
+
+            server.data.side_effect = None
+            pool.sendmail('from@test.com', 'to@test.com', 'msg 9')
+            pool.close_all()
+            self.assertEqual(pool._idle, [])
 
     @httpretty.activate
     def test_get_user_email(self):
@@ -112,6 +205,110 @@ class TestmyADSCelery(unittest.TestCase):
 
         self.assertEquals(email, 'test@test.com')
 
+        # the email address is now served from the local cache
+        httpretty.reset()
+        httpretty.register_uri(
+            httpretty.GET, self.app._config.get('API_ADSWS_USER_EMAIL') % user_id,
+            content_type='application/json',
+            status=404,
+            body='{"error": "not found"}'
+        )
+
+        email = utils.get_user_email(userid=user_id)
+
+        self.assertEquals(email, 'test@test.com')
+
+        email = utils.get_user_email(userid=user_id, use_cache=False)
+
+        self.assertIsNone(email)
+
+    @httpretty.activate
+    def test_sync_user_setups(self):
+        setup = [{'id': 1, 'name': 'Query 1', 'qid': 'abc', 'active': True, 'stateful': False,
+                  'frequency': 'weekly', 'type': 'query'}]
+        self.app.set_cached_setups({3: setup})
+
+        # the first sync only records its date, leaving the mirror to be filled by the processing tasks
+        self.assertEqual(utils.sync_user_setups(), 0)
+        self.assertFalse(httpretty.has_request())
+        with self.app.session_scope() as session:
+            since = session.query(KeyValue).filter_by(key='last.setup.sync').one().value
+
+        httpretty.register_uri(
+            httpretty.GET, self.app._config.get('API_VAULT_MYADS_USERS') % adsputils.get_date(since).isoformat(),
+            content_type='application/json',
+            status=200,
+            body=json.dumps({'users': [1, 3]})
+        )
+        httpretty.register_uri(
+            httpretty.GET, self.app._config.get('API_VAULT_MYADS_SETUP') % 1,
+            content_type='application/json',
+            status=200,
+            body=json.dumps(setup)
+        )
+        httpretty.register_uri(
+            httpretty.GET, self.app._config.get('API_VAULT_MYADS_SETUP') % 3,
+            content_type='application/json',
+            status=500,
+            body='{"error": "vault error"}'
+        )
+
+        # users that couldn't be fetched are dropped from the mirror
+        self.assertEqual(utils.sync_user_setups(), 1)
+        self.assertEqual(self.app.get_cached_setup(1, frequency='weekly'), setup)
+        self.assertIsNone(self.app.get_cached_setup(3, frequency='weekly'))
+
+        # the next sync only asks for users updated since this one
+        with self.app.session_scope() as session:
+            since = session.query(KeyValue).filter_by(key='last.setup.sync').one().value
+        httpretty.reset()
+        httpretty.register_uri(
+            httpretty.GET, self.app._config.get('API_VAULT_MYADS_USERS') % adsputils.get_date(since).isoformat(),
+            content_type='application/json',
+            status=200,
+            body=json.dumps({'users': []})
+        )
+        self.assertEqual(utils.sync_user_setups(), 0)
+
+    @httpretty.activate
+    def test_check_cached_setups(self):
+        today = adsputils.get_date().date()
+        arxiv_setup = {'id': 1, 'type': 'template', 'template': 'arxiv', 'frequency': 'daily', 'data': None,
+                       'classes': ['astro-ph']}
+        citations_setup = {'id': 2, 'type': 'template', 'template': 'citations', 'frequency': 'weekly',
+                           'data': 'author:"Kurtz, M."'}
+        built = [dict(s, query=self.app.build_template_query(s, today)) for s in (arxiv_setup, citations_setup)]
+        self.app.set_cached_setups({1: built})
+
+        # the queries built locally match vault's
+        httpretty.register_uri(
+            httpretty.GET, self.app._config.get('API_VAULT_MYADS_SETUP') % 1,
+            content_type='application/json',
+            status=200,
+            body=json.dumps(built)
+        )
+        self.assertEqual(utils.check_cached_setups(), set())
+        self.assertEqual(self.app.get_cached_setup(1), built)
+
+        # vault changed the arXiv template: the user is stored with vault's query, and other users' daily arXiv
+        # setups are fetched from vault for the rest of the day
+        vault_query = [{'q': 'bibstem:arxiv arxiv_class:astro-ph.* entdate:["{0}Z00:00" TO NOW]'.format(today),
+                        'sort': 'bibcode desc'}]
+        httpretty.reset()
+        httpretty.register_uri(
+            httpretty.GET, self.app._config.get('API_VAULT_MYADS_SETUP') % 1,
+            content_type='application/json',
+            status=200,
+            body=json.dumps([dict(arxiv_setup, query=vault_query), built[1]])
+        )
+        self.assertEqual(utils.check_cached_setups(), {('arxiv', 'daily')})
+        self.assertEqual(self.app.get_setup_mismatches(today), {('arxiv', 'daily')})
+        self.assertEqual(self.app.get_cached_setup(1), [dict(arxiv_setup, query=vault_query), built[1]])
+
+        self.app.set_cached_setups({2: [arxiv_setup, citations_setup]})
+        self.assertIsNone(self.app.get_cached_setup(2, frequency='daily'))
+        self.assertEqual(self.app.get_cached_setup(2, frequency='weekly'), [arxiv_setup, built[1]])
+
     @httpretty.activate
     def test_get_query_results(self):
         myADSsetup = {'name': 'Test Query',
@@ -148,9 +345,9 @@ class TestmyADSCelery(unittest.TestCase):
         query_url = query_url + '?utm_source=myads&utm_medium=email&utm_campaign=type:{0}&utm_term={1}&utm_content=queryurl'
         self.assertEqual(results, [{'name': myADSsetup['name'],
                                     'query_url': query_url,
-                                    'results': [{"bibcode": "1971JVST....8..324K",
-                                                 "title": ["High-Capacity Lead Tin Barrel Dome Production Evaporator"],
-                                                 "author_norm": ["Kurtz, J"]}],
+                                    'results': [SearchResult(bibcode=u"1971JVST....8..324K",
+                                                  title=u"High-Capacity Lead Tin Barrel Dome Production Evaporator",
+                                                  authors=(u"Kurtz, J",), num_authors=1)],
                                     "query": "author:Kurtz"
                                     }])
 
@@ -217,11 +414,10 @@ class TestmyADSCelery(unittest.TestCase):
                                     'query': 'bibstem:arxiv (arxiv_class:(astro-ph.*) (AGN)) '
                                              'entdate:["{0}Z00:00" TO "{1}Z23:59"] pubdate:[{2}-00 TO *]'.format(start, end, start_year),
                                     'query_url': query_url,
-                                    'results': [{u'arxiv_id': u'arXiv:1234:5678',
-                                                 u"bibcode": u"1971JVST....8..324K",
-                                                 u"title": [u"High-Capacity Lead Tin Barrel Dome Production Evaporator"],
-                                                 u"author_norm": [u"Kurtz, J"],
-                                                 u'identifier': [u'1971JVST....8..324K', u'arXiv:1234:5678']}]}])
+                                    'results': [SearchResult(bibcode=u"1971JVST....8..324K",
+                                                  title=u"High-Capacity Lead Tin Barrel Dome Production Evaporator",
+                                                  authors=(u"Kurtz, J",), num_authors=1,
+                                                  arxiv_id=u"arXiv:1234:5678")]}])
 
         # test citations query
         myADSsetup = {'name': 'Test Query - citations',
@@ -309,13 +505,10 @@ class TestmyADSCelery(unittest.TestCase):
         self.assertEqual(results, [{'name': 'Test Query - citations (Citations: 161491)',
                                     'query': 'citations(author:Kurtz OR author:"Kurtz, M.")',
                                     'query_url': query_url,
-                                    'results': [{u"bibcode": u"1971JVST....8..324K",
-                                                 u"title": [
-                                                     u"High-Capacity Lead Tin Barrel Dome Production Evaporator"],
-                                                 u"author_norm": [u"Kurtz, J"],
-                                                 u"identifier": [u"1971JVST....8..324K"],
-                                                 u"year": u"1971",
-                                                 u"bibstem": [u"JVST"]}]}])
+                                    'results': [SearchResult(bibcode=u"1971JVST....8..324K",
+                                                  title=u"High-Capacity Lead Tin Barrel Dome Production Evaporator",
+                                                  authors=(u"Kurtz, J",), num_authors=1,
+                                                  year=u"1971", bibstem=(u"JVST",))]}])
 
         # test authors query
         myADSsetup = {'name': 'Test Query - authors',
@@ -371,13 +564,10 @@ class TestmyADSCelery(unittest.TestCase):
         self.assertEqual(results, [{'name': myADSsetup['name'],
                                     'query': 'author:Kurtz entdate:["{0}Z00:00" TO "{1}Z23:59"] pubdate:[{2}-00 TO *]'.format(start, end, start_year),
                                     'query_url': query_url,
-                                    'results': [{u"bibcode": u"1971JVST....8..324K",
-                                                 u"title": [
-                                                     u"High-Capacity Lead Tin Barrel Dome Production Evaporator"],
-                                                 u"author_norm": [u"Kurtz, J"],
-                                                 u"identifier": [u"1971JVST....8..324K"],
-                                                 u"year": u"1971",
-                                                 u"bibstem": [u"JVST"]}]}])
+                                    'results': [SearchResult(bibcode=u"1971JVST....8..324K",
+                                                  title=u"High-Capacity Lead Tin Barrel Dome Production Evaporator",
+                                                  authors=(u"Kurtz, J",), num_authors=1,
+                                                  year=u"1971", bibstem=(u"JVST",))]}])
 
         # test keyword query
         myADSsetup = {'name': 'Test Query - keywords',
@@ -504,34 +694,230 @@ class TestmyADSCelery(unittest.TestCase):
         self.assertEqual(results, [{'name': 'Test Query - keywords - Recent Papers',
                                     'query': 'AGN arxiv_class:(astro-ph.* OR physics.space-ph) entdate:["{0}Z00:00" TO "{1}Z23:59"] pubdate:[{2}-00 TO *]'.format(start, end, start_year),
                                     'query_url': query_url1,
-                                    'results': [{u"bibcode": u"1971JVST....8..324K",
-                                                 u"title": [u"High-Capacity Lead Tin Barrel Dome Production Evaporator"],
-                                                 u"author_norm": [u"Kurtz, J"],
-                                                 u"identifier": [u"1971JVST....8..324K"],
-                                                 u"year": u"1971",
-                                                 u"bibstem": [u"JVST"]}]},
+                                    'results': [SearchResult(bibcode=u"1971JVST....8..324K",
+                                                  title=u"High-Capacity Lead Tin Barrel Dome Production Evaporator",
+                                                  authors=(u"Kurtz, J",), num_authors=1,
+                                                  year=u"1971", bibstem=(u"JVST",))]},
                                    {'name': 'Test Query - keywords - Most Popular',
                                     'query': 'trending(AGN arxiv_class:(astro-ph.* OR physics.space-ph))',
                                     'query_url': query_url2,
-                                    'results': [{u"bibcode": u"1971JVST....8..324K",
-                                                 u"title": [
-                                                     u"High-Capacity Lead Tin Barrel Dome Production Evaporator"],
-                                                 u"author_norm": [u"Kurtz, J"],
-                                                 u"identifier": [u"1971JVST....8..324K"],
-                                                 u"year": u"1971",
-                                                 u"bibstem": [u"JVST"]}]},
+                                    'results': [SearchResult(bibcode=u"1971JVST....8..324K",
+                                                  title=u"High-Capacity Lead Tin Barrel Dome Production Evaporator",
+                                                  authors=(u"Kurtz, J",), num_authors=1,
+                                                  year=u"1971", bibstem=(u"JVST",))]},
                                    {'name': 'Test Query - keywords - Most Cited',
                                     'query': 'useful(AGN arxiv_class:(astro-ph.* OR physics.space-ph))',
                                     'query_url': query_url3,
-                                    'results': [{u"bibcode": u"1971JVST....8..324K",
-                                                 u"title": [
-                                                     u"High-Capacity Lead Tin Barrel Dome Production Evaporator"],
-                                                 u"author_norm": [u"Kurtz, J"],
-                                                 u"identifier": [u"1971JVST....8..324K"],
-                                                 u"year": u"1971",
-                                                 u"bibstem": [u"JVST"]}]}
+                                    'results': [SearchResult(bibcode=u"1971JVST....8..324K",
+                                                  title=u"High-Capacity Lead Tin Barrel Dome Production Evaporator",
+                                                  authors=(u"Kurtz, J",), num_authors=1,
+                                                  year=u"1971", bibstem=(u"JVST",))]}
                                    ])
 
+    @httpretty.activate
+    def test_iter_solr_docs(self):
+        all_docs = [{'bibcode': '2020arXiv2001{0:05d}K'.format(n)} for n in range(1200, 0, -1)]
+        requests = []
+
+        def solr(request, uri, headers):
+            params = dict((k, v[0]) for k, v in request.querystring.items())
+            requests.append(params)
+            start = 0 if params['cursorMark'] == '*' else int(params['cursorMark'])
+            end = start + int(params['rows'])
+            return 200, headers, json.dumps({'response': {'numFound': len(all_docs), 'docs': all_docs[start:end]},
+                                             'nextCursorMark': str(min(end, len(all_docs)))})
+
+        httpretty.register_uri(httpretty.GET, self.app._config.get('API_SOLR_QUERY_ENDPOINT'), body=solr)
+
+        with patch.dict(utils.config, {'SOLR_PAGE_SIZE': 500}):
+            docs = utils._iter_solr_docs(query='bibstem:arxiv', sort='bibcode desc', fields='bibcode', rows=1100)
+            # nothing is fetched until the docs are consumed
+            self.assertEqual(requests, [])
+            self.assertEqual(list(docs), all_docs[:1100])
+
+            # pages are requested with cursorMark, sorted on the unique key, and the last page is cut to size
+            self.assertEqual([(r['cursorMark'], r['rows']) for r in requests], [('*', '500'), ('500', '500'),
+                                                                                 ('1000', '100')])
+            self.assertEqual(requests[0]['sort'], 'bibcode desc, id desc')
+
+            # paging stops at the first short page, without asking for the page after the last result
+            del requests[:]
+            self.assertEqual(len(list(utils._iter_solr_docs(query='bibstem:arxiv', sort='bibcode desc, id asc',
+                                                            fields='bibcode', rows=2000))), 1200)
+            self.assertEqual(len(requests), 3)
+            self.assertEqual(requests[0]['sort'], 'bibcode desc, id asc')
+
+            # ... or once numFound docs were returned
+            del all_docs[1000:]
+            del requests[:]
+            self.assertEqual(len(list(utils._iter_solr_docs(query='bibstem:arxiv', sort='bibcode desc',
+                                                            fields='bibcode', rows=2000))), 1000)
+            self.assertEqual(len(requests), 2)
+
+    @httpretty.activate
+    def test_get_query_results_paged(self):
+        myADSsetup = {'name': 'Test Query',
+                      'qid': 1,
+                      'active': True,
+                      'stateful': True,
+                      'frequency': 'weekly',
+                      'type': 'query',
+                      'rows': 2000,
+                      'fields': 'bibcode,title,author_norm'}
+        all_docs = [{'bibcode': '2020arXiv2001{0:05d}K'.format(n)} for n in range(1200, 0, -1)]
+        requests = []
+
+        def vault(request, uri, headers):
+            params = dict((k, v[0]) for k, v in request.querystring.items())
+            requests.append(params)
+            start = 0 if params['cursorMark'] == '*' else int(params['cursorMark'])
+            end = start + int(params['rows'])
+            return 200, headers, json.dumps({'responseHeader': {'params': {'q': 'author:Kurtz',
+                                                                           'sort': params['sort'],
+                                                                           'cursorMark': params['cursorMark']}},
+                                             'response': {'numFound': len(all_docs), 'docs': all_docs[start:end]},
+                                             'nextCursorMark': str(min(end, len(all_docs)))})
+
+        httpretty.register_uri(
+            httpretty.GET, self.app._config.get('API_VAULT_EXECUTE_QUERY') % (1, myADSsetup['fields'], 2000, 'date'),
+            body=vault)
+
+        with patch.dict(utils.config, {'SOLR_PAGE_SIZE': 500}):
+            results = utils.get_query_results(myADSsetup)
+
+        # large stored queries are paged through vault too
+        self.assertEqual([(r['cursorMark'], r['rows']) for r in requests], [('*', '500'), ('500', '500'),
+                                                                             ('1000', '500')])
+        self.assertEqual(requests[0]['sort'], 'date desc, bibcode desc, id desc')
+        self.assertEqual([r.bibcode for r in results[0]['results']], [d['bibcode'] for d in all_docs])
+
+        # the query shown to the user keeps its own sort
+        query_url = self.app._config.get('QUERY_ENDPOINT') % urllib.urlencode({'q': 'author:Kurtz',
+                                                                              'sort': 'date desc, bibcode desc'})
+        self.assertEqual(results[0]['query_url'], query_url + '?utm_source=myads&utm_medium=email&utm_campaign='
+                                                              'type:{0}&utm_term={1}&utm_content=queryurl')
+
+    @httpretty.activate
+    def test_get_template_query_results_cached(self):
+        myADSsetup = {'name': 'Test Query - arxiv',
+                      'qid': None,
+                      'active': True,
+                      'stateful': False,
+                      'frequency': 'daily',
+                      'type': 'template',
+                      'template': 'arxiv',
+                      'data': None,
+                      'classes': ['astro-ph'],
+                      'query': [{'q': 'bibstem:arxiv arxiv_class:(astro-ph.*) entdate:["2020-01-01Z00:00" TO '
+                                      '"2020-01-01Z23:59"] pubdate:[2019-00 TO *]',
+                                 'sort': 'bibcode desc'}],
+                      'fields': 'bibcode,title,author_norm,identifier',
+                      'rows': 2000}
+
+        httpretty.register_uri(
+            httpretty.GET, self.app._config.get('API_SOLR_QUERY_ENDPOINT'),
+            content_type='application/json',
+            status=200,
+            body=json.dumps({"responseHeader": {"status": 0, "QTime": 23, "params": {}},
+                             "response": {"numFound": 1,
+                                          "start": 0,
+                                          "docs": [{"bibcode": "2020arXiv200100001K",
+                                                    "identifier": ["2020arXiv200100001K", "arXiv:2001.00001"],
+                                                    "title": ["A new paper"],
+                                                    "author_norm": ["Kurtz, M"]}]}})
+        )
+
+        metrics.registry.reset()
+        results = utils.get_template_query_results(myADSsetup, run_id='daily:2020-01-02T00:00:00+00:00')
+        self.assertEqual(results[0]['results'][0]['arxiv_id'], 'arXiv:2001.00001')
+        self.assertIn('myads_query_cache_total{result="miss"} 1', metrics.render())
+
+        # Solr is down, but the same query in the same run is served from the cache
+        httpretty.reset()
+        httpretty.register_uri(
+            httpretty.GET, self.app._config.get('API_SOLR_QUERY_ENDPOINT'),
+            content_type='application/json',
+            status=500,
+            body='error'
+        )
+
+        cached = utils.get_template_query_results(myADSsetup, run_id='daily:2020-01-02T00:00:00+00:00')
+        self.assertEqual(cached, results)
+        self.assertIn('myads_query_cache_total{result="hit"} 1', metrics.render())
+
+        # the cache is scoped to a single run
+        with self.assertRaises(RuntimeError):
+            utils.get_template_query_results(myADSsetup, run_id='daily:2020-01-03T00:00:00+00:00')
+
+        # no caching without a run ID
+        with self.assertRaises(RuntimeError):
+            utils.get_template_query_results(myADSsetup)
+
+    @httpretty.activate
+    def test_precompute_arxiv_categories(self):
+        yesterday = (adsputils.get_date() - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+        earlier = (adsputils.get_date() - datetime.timedelta(days=3)).strftime('%Y-%m-%d')
+        date_q = 'entdate:["{0}Z00:00" TO "{0}Z23:59"] pubdate:[2019-00 TO *]'.format(yesterday)
+        myADSsetup = {'id': 1, 'name': 'arXiv', 'qid': None, 'active': True, 'stateful': False,
+                      'frequency': 'daily', 'type': 'template', 'template': 'arxiv', 'data': None,
+                      'classes': ['astro-ph.GA', 'astro-ph.CO'],
+                      'query': [{'q': 'bibstem:arxiv arxiv_class:(astro-ph.GA OR astro-ph.CO) ' + date_q,
+                                 'sort': 'bibcode desc'}]}
+        # user 3's setup is mirrored as template parameters, its query being built locally
+        built_setup = dict(myADSsetup, classes=['astro-ph.HE'])
+        built_setup['query'] = self.app.build_template_query(built_setup, adsputils.get_date().date())
+        self.app.set_cached_setups({1: [myADSsetup],
+                                    2: [dict(myADSsetup, query=[{'q': 'bibstem:arxiv (arxiv_class:(gr-qc) (AGN)) ' +
+                                                                      date_q, 'sort': 'score desc, bibcode desc'}])],
+                                    3: [built_setup]})
+
+        def doc(n, entry_date, pubdate='2020-01-00'):
+            return {'bibcode': '2020arXiv20010000{0}K'.format(n),
+                    'identifier': ['2020arXiv20010000{0}K'.format(n), 'arXiv:2001.0000{0}'.format(n)],
+                    'title': ['Paper {0}'.format(n)], 'author_norm': ['Kurtz, M'],
+                    'entry_date': entry_date + 'T00:00:00Z', 'pubdate': pubdate}
+        category_docs = {'astro-ph.GA': [doc(3, yesterday), doc(2, earlier), doc(1, yesterday)],
+                         'astro-ph.CO': [doc(4, yesterday, pubdate='2018-01-00'), doc(1, yesterday)],
+                         'astro-ph.HE': [doc(5, yesterday)]}
+        requests = []
+
+        def solr(request, uri, headers):
+            q = request.querystring['q'][0]
+            requests.append(q)
+            arxiv_class = q.split('arxiv_class:(')[1].split(')')[0]
+            return 200, headers, json.dumps({'response': {'numFound': len(category_docs[arxiv_class]),
+                                                          'docs': category_docs[arxiv_class]}})
+
+        httpretty.register_uri(httpretty.GET, self.app._config.get('API_SOLR_QUERY_ENDPOINT'), body=solr)
+
+        # only categories of queries on categories alone are precomputed, once each
+        run_id = 'daily:{0}'.format(yesterday)
+        self.assertEqual(utils.precompute_arxiv_categories(run_id), 3)
+        self.assertEqual(len(requests), 3)
+
+        # the lists are stored for the run, in compact form
+        start, category = self.app.get_arxiv_category(run_id=run_id, arxiv_class='astro-ph.HE')
+        # as far back as the daily queries of a Monday go
+        self.assertEqual(start, (adsputils.get_date().date() - datetime.timedelta(
+            days=self.app._config.get('MYADS_DAILY_TIME_RANGE'))).isoformat() + 'T00:00')
+        self.assertEqual([(entry_date, pubdate, SearchResult.from_list(r)) for entry_date, pubdate, r in category],
+                         [(yesterday + 'T00:00', '2020-01-00',
+                           SearchResult.from_doc(doc(5, yesterday), resolve_arxiv_id=True))])
+
+        # the query is assembled locally: deduplicated, filtered by date and sorted
+        utils.arxiv_category_cache.clear()
+        myADSsetup.update({'fields': 'bibcode,title,author_norm,identifier,year,bibstem', 'rows': 2000})
+        results = utils.get_template_query_results(myADSsetup, run_id=run_id)
+        self.assertEqual(len(requests), 3)
+        self.assertEqual([d['bibcode'] for d in results[0]['results']],
+                         ['2020arXiv200100003K', '2020arXiv200100001K'])
+        self.assertEqual(results[0]['results'][0]['arxiv_id'], 'arXiv:2001.00003')
+        self.assertNotIn('entry_date', results[0]['results'][0])
+
+        myADSsetup['rows'] = 1
+        results = utils.get_template_query_results(myADSsetup, run_id=run_id)
+        self.assertEqual([d['bibcode'] for d in results[0]['results']], ['2020arXiv200100003K'])
+
     def test_get_first_author_formatted(self):
         results_dict = {"bibcode": "2012ApJS..199...26H",
                         "title": ["The 2MASS Redshift Survey: Description and Data Release"],
@@ -556,6 +942,111 @@ class TestmyADSCelery(unittest.TestCase):
         self.assertEquals(split_payload[1].strip(), '"VizieR Online Data Catalog: Spectroscopy of M81 globular ' +
                                                     'clusters," Nantais, J and Huchra, J (2012yCat..51392620N)')
 
+    def test_load_templates(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache_dir = os.path.join(tmpdir, 'templates')
+            bytecode_cache = utils._template_bytecode_cache(cache_dir)
+            self.assertTrue(os.path.isdir(cache_dir))
+
+            # compiled templates are stored, so that other workers can load them
+            with patch.object(utils.env, 'bytecode_cache', bytecode_cache), patch.object(utils, '_result_macros', {}):
+                utils.env.cache.clear()
+                utils.load_templates()
+                self.assertEqual(len(os.listdir(cache_dir)), len(utils.TEMPLATES))
+                self.assertEqual(len(utils._result_macros), 1)
+
+                utils.env.cache.clear()
+                with patch.object(utils.env, 'compile') as compile:
+                    utils.load_templates()
+                    self.assertFalse(compile.called)
+            utils.env.cache.clear()
+
+            with open(os.path.join(tmpdir, 'file'), 'w'):
+                pass
+            self.assertIsNone(utils._template_bytecode_cache(os.path.join(tmpdir, 'file', 'templates')))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_render_result(self):
+        utils.result_cache.clear()
+        doc = {'bibcode': '2019arXiv190800829P',
+               'title': ['Gravitational wave signatures <i>&</i> {0}'],
+               'author_norm': ['Paul, A', 'Banerjee, B', 'Majumdar, D', 'Other, A'],
+               'identifier': ['2019arXiv190800829P', 'arXiv:1908.00829'],
+               'bibstem': ['arXiv']}
+        result = SearchResult.from_doc(doc, resolve_arxiv_id=True)
+
+        html = utils._render_result(result, 'one_col', 'arXiv', 123, 1)
+        self.assertIn(u'>arXiv:1908.00829</a>', html)
+        self.assertIn(u'Gravitational wave signatures &lt;i&gt;&amp;&lt;/i&gt; {0}', html)
+        self.assertIn(u'Paul, A; Banerjee, B; Majumdar, D and 1 more', html)
+        self.assertIn(u'/abs/2019arXiv190800829P/abstract?utm_source=myads&amp;utm_medium=email&amp;'
+                      u'utm_campaign=type:arXiv&amp;utm_term=123&amp;utm_content=rank:1"', html)
+        self.assertIn(u'/link_gateway/2019arXiv190800829P/EPRINT_HTML?utm_source=myads&amp;utm_medium=email&amp;'
+                      u'utm_campaign=type:arXiv&amp;utm_term=123&amp;utm_content=rank:1"', html)
+
+        # the result is rendered once; the per-email values are filled in on each call
+        html = utils._render_result(result, 'one_col', 'general', 456, 7)
+        self.assertIn(u'utm_campaign=type:general&amp;utm_term=456&amp;utm_content=rank:7"', html)
+        self.assertNotIn(u'\x00', html)
+        self.assertEqual((utils.result_cache.hits, utils.result_cache.misses), (1, 1))
+
+        self.assertIn(u'Paul, A and 3 more', utils._render_result(result, 'two_col', 'arXiv', 123, 1))
+        self.assertEqual(utils._render_result(result, 'plain'),
+                         u'"Gravitational wave signatures <i>&</i> {0}," Paul, A; Banerjee, B; Majumdar, D and 1 more '
+                         u'(2019arXiv190800829P)\n')
+        self.assertEqual(len(utils.result_cache), 3)
+
+        # the same paper returned by a general query is shown without its arXiv ID
+        html = utils._render_result(SearchResult.from_doc(doc), 'one_col', 'general', 456, 1)
+        self.assertNotIn(u'arXiv:1908.00829', html)
+        self.assertIn(u'Paul, A; Banerjee, B; Majumdar, D and 1 more', html)
+        self.assertEqual(len(utils.result_cache), 4)
+
+        # least recently used results are evicted
+        cache = utils.LRUCache(size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        utils.result_cache.clear()
+
+    def test_render_sections(self):
+        utils.section_cache.clear()
+        section = dict(payload[0], query='bibstem:arxiv')
+
+        html = utils._render_sections(section, ('one_col',))[0]
+        self.assertIn(u'utm_campaign=type:general&amp;utm_term=123&amp;utm_content=queryurl" title="bibstem:arxiv"', html)
+        self.assertIn(u'utm_campaign=type:general&amp;utm_term=123&amp;utm_content=rank:2"', html)
+
+        # the same section in another user's email is only rendered once, with that user's setup ID
+        html = utils._render_sections(dict(section, id=789), ('one_col',))[0]
+        self.assertIn(u'utm_campaign=type:general&amp;utm_term=789&amp;utm_content=queryurl"', html)
+        self.assertIn(u'utm_campaign=type:general&amp;utm_term=789&amp;utm_content=rank:2"', html)
+        self.assertNotIn(u'utm_term=123', html)
+        self.assertEqual((utils.section_cache.hits, utils.section_cache.misses), (1, 1))
+
+        # a different result list is a different section
+        html = utils._render_sections(dict(section, results=section['results'][:1]), ('one_col',))[0]
+        self.assertNotIn(u'2012ApJS..199...26H', html)
+        self.assertIn(u'No new articles found', utils._render_sections(dict(section, results=[]), ('two_col',))[0])
+        self.assertEqual(utils._render_sections(dict(section, id=789), ('plain',))[0],
+                         utils.payload_to_plain([dict(section, id=789)]))
+
+        # with sizeof, the cache holds values up to a total size
+        cache = utils.LRUCache(size=10, sizeof=len)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        cache.set('c', 'cccc')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.total, 8)
+        cache.set('d', 'd' * 11)
+        self.assertIsNone(cache.get('d'))
+        utils.section_cache.clear()
+
     def test_payload_to_html(self):
 
         formatted_payload = utils.payload_to_html(payload, col=1, email_address="test@tester.com")
@@ -565,7 +1056,7 @@ class TestmyADSCelery(unittest.TestCase):
         self.assertEquals(split_payload[74].strip(),
                           u'<h3><a href="https://ui.adsabs.harvard.edu/search/q=bibstem%3Aarxiv?utm_source=myads&amp;utm_medium=email&amp;utm_campaign=type:general&amp;utm_term=123&amp;utm_content=queryurl" title="" style="color: #000000; ' +
                           u'font-weight: bold;">Query 1</a></h3>')
-        self.assertIn(u'href="https://ui.adsabs.harvard.edu/abs/2012yCat..51392620N/abstract?utm_source=myads&amp;utm_medium=email&amp;utm_campaign=type:general&amp;utm_term=123&amp;utm_content=rank:1"', split_payload[78])
+        self.assertIn(u'href="https://ui.adsabs.harvard.edu/abs/2012yCat..51392620N/abstract?utm_source=myads&amp;utm_medium=email&amp;utm_campaign=type:general&amp;utm_term=123&amp;utm_content=rank:1"', split_payload[75])
 
         formatted_payload = utils.payload_to_html(payload, col=2)
 
@@ -575,11 +1066,22 @@ class TestmyADSCelery(unittest.TestCase):
         self.assertEquals(split_payload[74].strip(),
                           u'<h3><a href="https://ui.adsabs.harvard.edu/search/q=bibstem%3Aarxiv?utm_source=myads&amp;utm_medium=email&amp;utm_campaign=type:general&amp;utm_term=123&amp;utm_content=queryurl" title="" style="color: #000000; ' +
                           u'font-weight: bold;">Query 1</a></h3>')
-        self.assertIn(u'href="https://ui.adsabs.harvard.edu/abs/2012yCat..51392620N/abstract?utm_source=myads&amp;utm_medium=email&amp;utm_campaign=type:general&amp;utm_term=123&amp;utm_content=rank:1"', split_payload[77])
+        self.assertIn(u'href="https://ui.adsabs.harvard.edu/abs/2012yCat..51392620N/abstract?utm_source=myads&amp;utm_medium=email&amp;utm_campaign=type:general&amp;utm_term=123&amp;utm_content=rank:1"', split_payload[75])
 
         formatted_payload = utils.payload_to_html(payload, col=3)
         self.assertIsNone(formatted_payload)
 
+    def test_render_payload(self):
+        for col in (1, 2):
+            plain, html = utils.render_payload(payload, col=col, frequency='weekly', email_address='test@tester.com')
+            self.assertEqual(plain, utils.payload_to_plain(payload))
+            self.assertEqual(html, utils.payload_to_html(payload, col=col, frequency='weekly',
+                                                         email_address='test@tester.com'))
+
+        plain, html = utils.render_payload(payload, col=3)
+        self.assertEqual(plain, utils.payload_to_plain(payload))
+        self.assertIsNone(html)
+
 
 
 
@@ -0,0 +1,117 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import time
+from mock import Mock, patch
+
+from myadsp import watch
+
+# inotify event masks
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+
+
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'matches.input')
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        shutil.rmtree(self.tmpdir)
+
+    def _write_later(self, delay):
+        def write():
+            time.sleep(delay)
+            with open(self.path, 'w') as f:
+                f.write('2019A&A...632A..94J     K58-37447\n')
+        t = threading.Thread(target=write)
+        t.start()
+        return t
+
+    def test_wait_until(self):
+        attempts = []
+
+        def check():
+            attempts.append(time.time())
+            return 'ready' if len(attempts) == 3 else None
+
+        with patch.object(watch.time, 'sleep') as sleep:
+            self.assertEqual(watch.wait_until(check, 100, min_delay=1, max_delay=3), 'ready')
+        # the delay grows between attempts, up to the maximum
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [1, 2])
+
+        with patch.object(watch.time, 'sleep') as sleep:
+            self.assertEqual(watch.wait_until(lambda: 'ready', 100), 'ready')
+        self.assertFalse(sleep.called)
+
+        self.assertIsNone(watch.wait_until(lambda: None, 0.2, min_delay=0.05, max_delay=0.05))
+
+    def test_wait_for_file(self):
+        check = lambda closed: os.path.exists(self.path)
+
+        # notified as soon as the file is written, well before the poll interval
+        if watch.pyinotify is not None:
+            t = self._write_later(0.2)
+            start = time.time()
+            self.assertTrue(watch.wait_for_file(self.path, check, 10, poll_interval=10))
+            self.assertLess(time.time() - start, 5)
+            t.join()
+            os.remove(self.path)
+
+        # without pyinotify, the file is polled
+        with patch.object(watch, 'pyinotify', None):
+            t = self._write_later(0.2)
+            self.assertTrue(watch.wait_for_file(self.path, check, 10, poll_interval=0.1))
+            t.join()
+            os.remove(self.path)
+
+        self.assertIsNone(watch.wait_for_file(self.path, check, 0.3, poll_interval=0.1))
+
+    def test_wait_for_file_events(self):
+        # inotify events are simulated, whether pyinotify is installed or not
+        def event(name, mask):
+            e = Mock(mask=mask)
+            e.name = name
+            return e
+
+        name = os.path.basename(self.path)
+        events = [[event('other', IN_CLOSE_WRITE)], [event(name, IN_ATTRIB)], [event(name, IN_CLOSE_WRITE)]]
+
+        class Notifier(object):
+            def __init__(self, wm, default_proc_fun=None):
+                self.proc_fun = default_proc_fun
+
+            def check_events(self, timeout=None):
+                return True
+
+            def read_events(self):
+                pass
+
+            def process_events(self):
+                for event in events.pop(0):
+                    self.proc_fun(event)
+
+            def stop(self):
+                pass
+
+        pyinotify = Mock(IN_CLOSE_WRITE=IN_CLOSE_WRITE, IN_MOVED_TO=IN_MOVED_TO, IN_ATTRIB=IN_ATTRIB,
+                         Notifier=Notifier)
+        checks = []
+
+        def check(closed):
+            checks.append(closed)
+            return 'ready' if closed else None
+
+        with patch.object(watch, 'pyinotify', pyinotify):
+            self.assertEqual(watch.wait_for_file(self.path, check, 10, poll_interval=10), 'ready')
+        # checked on start and once the watch is set up, not for changes to other files, and with closed set
+        # only once the file was closed after writing
+        self.assertEqual(checks, [False, False, False, True])
+        self.assertEqual(pyinotify.WatchManager.return_value.add_watch.call_args[0],
+                         (self.tmpdir, IN_CLOSE_WRITE | IN_MOVED_TO | IN_ATTRIB))
@@ -1,15 +1,26 @@
 from adsputils import get_date, setup_logging, load_config
 from .emails import Email
 from myadsp import app as app_module
+from .models import KeyValue, UserSetup
+from .records import SearchResult, digest
+from . import metrics
 
 import smtplib, ssl
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from email.header import Header
+import string
+import tempfile
+import uuid
 import urllib
 import json
 import os
-from jinja2 import Environment, PackageLoader, select_autoescape
+import hashlib
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from jinja2 import Environment, FileSystemBytecodeCache, Markup, PackageLoader, escape, select_autoescape
 import datetime
+import re
+from sqlalchemy.dialects.postgresql import insert
 
 app = app_module.myADSCelery('myADS-pipeline', proj_home=os.path.realpath(os.path.join(os.path.dirname(__file__), '../')))
 
@@ -17,24 +28,359 @@ logger = setup_logging('myads_utils')
 config = {}
 config.update(load_config())
 
+
+def _template_bytecode_cache(directory=None):
+    """
+    :param directory: directory where compiled templates are stored; if None, a per-user temporary directory
+    :return: jinja2.FileSystemBytecodeCache, or None if the directory can't be created
+    """
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            logger.warning('Cannot create template cache directory {0}, templates will be compiled: {1}'.
+                           format(directory, e))
+            return None
+    return FileSystemBytecodeCache(directory=directory)
+
+
+# templates are compiled once per process, or loaded already compiled from the bytecode cache; since they aren't
+# checked for changes, edits to the templates take effect when the workers are restarted
 env = Environment(
     loader=PackageLoader('myadsp', 'templates'),
     autoescape=select_autoescape(enabled_extensions=('html', 'xml'),
-                                 default_for_string=True)
+                                 default_for_string=True),
+    bytecode_cache=_template_bytecode_cache(config.get('TEMPLATE_CACHE_DIR')),
+    auto_reload=False
 )
 
+# templates used to build the emails, loaded ahead of the first email by load_templates
+TEMPLATES = ('email.html', 'one_col.html', 'two_col.html', 'results.html')
+# macros of results.html, per link format
+_result_macros = {}
+
+# daily arXiv query on categories alone, as built by vault
+ARXIV_CATEGORY_QUERY = re.compile(r'^bibstem:arxiv arxiv_class:\((?P<classes>[^()]+)\) '
+                                  r'entdate:\["(?P<start>\d{4}-\d{2}-\d{2}Z\d{2}:\d{2})" TO '
+                                  r'(?:"(?P<end>\d{4}-\d{2}-\d{2}Z\d{2}:\d{2})"|NOW)\] '
+                                  r'pubdate:\[(?P<pubdate>[\d-]+) TO \*\]$')
+# fields stored for the precomputed arXiv category lists
+ARXIV_CATEGORY_FIELDS = 'bibcode,title,author_norm,identifier,year,bibstem,entry_date,pubdate'
+
+
+class SMTPConnectionPool(object):
+    """
+    Pool of long-lived SMTP connections, reused across tasks within a worker process
+    """
+
+    def __init__(self, server=None, port=None, use_tls=False, username=None, password=None,
+                 size=2, max_messages=100, max_idle=60):
+        """
+        :param server: SMTP server hostname
+        :param port: SMTP server port
+        :param use_tls: if True, STARTTLS is issued on each new connection
+        :param username: SMTP username; login is skipped if username or password are missing
+        :param password: SMTP password
+        :param size: maximum number of idle connections kept open
+        :param max_messages: number of messages sent on a connection before it is recycled
+        :param max_idle: number of seconds a connection can stay idle before it is assumed closed by the server
+        """
+        self.server = server
+        self.port = port
+        self.use_tls = use_tls
+        self.username = username
+        self.password = password
+        self.size = size
+        self.max_messages = max_messages
+        self.max_idle = max_idle
+        # idle connections, as [smtp connection, number of messages sent, last used timestamp]
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        server = smtplib.SMTP(self.server, self.port)
+        if self.use_tls:
+            server.starttls()
+        if self.username and self.password:
+            server.login(self.username, self.password)
+
+        return [server, 0, time.time()]
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn[0].quit()
+        except Exception:
+            # the server may already have dropped the connection
+            pass
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            return conn[0].noop()[0] == 250
+        except Exception:
+            return False
+
+    def acquire(self):
+        """
+        Returns a live connection, reusing an idle one if possible
+        :return: list: [smtp connection, number of messages sent, last used timestamp]
+        """
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn = self._idle.pop()
+            if time.time() - conn[2] < self.max_idle and self._is_alive(conn):
+                return conn
+            self._close(conn)
+
+        return self._connect()
+
+    def release(self, conn, discard=False):
+        """
+        Returns a connection to the pool after a message was sent with it
+        :param conn: connection, as returned by acquire
+        :param discard: if True, the connection is closed instead of being reused
+        :return: no return
+        """
+        conn[1] += 1
+        conn[2] = time.time()
+        with self._lock:
+            if not discard and conn[1] < self.max_messages and len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        self._close(conn)
+
+    def close_all(self):
+        """
+        Closes all idle connections; used at worker shutdown
+        :return: no return
+        """
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for conn in idle:
+            self._close(conn)
+
+    @staticmethod
+    def _mail(server, from_addr):
+        server.ehlo_or_helo_if_needed()
+        code, resp = server.mail(from_addr)
+        if code != 250:
+            server.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+
+    @staticmethod
+    def _send(server, from_addr, to_addrs, msg):
+        # rest of the exchange of smtplib.SMTP.sendmail, after MAIL; a message file is copied to the socket in chunks,
+        # as it is already in the DATA format
+        if isinstance(to_addrs, basestring):
+            to_addrs = [to_addrs]
+        refused = {}
+        for addr in to_addrs:
+            code, resp = server.rcpt(addr)
+            if code not in (250, 251):
+                refused[addr] = (code, resp)
+        if len(refused) == len(to_addrs):
+            server.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if not hasattr(msg, 'read'):
+            code, resp = server.data(msg)
+            if code != 250:
+                raise smtplib.SMTPDataError(code, resp)
+            return
+        server.putcmd('data')
+        code, resp = server.getreply()
+        if code != 354:
+            raise smtplib.SMTPDataError(code, resp)
+        msg.seek(0)
+        for chunk in iter(lambda: msg.read(65536), ''):
+            server.send(chunk)
+        server.send('.\r\n')
+        code, resp = server.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """
+        Sends a message over a pooled connection. If a reused connection turns out to have been dropped by the server
+        before the sender is accepted, the message is sent over a new connection; a connection dropped later in the
+        exchange isn't retried, since the server may already have accepted the message
+        :param msg: message as a string, or file containing the message in the SMTP DATA format (see SMTPDataWriter)
+        :return: no return
+        """
+        conn = self.acquire()
+        try:
+            try:
+                self._mail(conn[0], from_addr)
+            except smtplib.SMTPServerDisconnected:
+                if conn[1] == 0:
+                    # a new connection; nothing to retry with
+                    raise
+                self.release(conn, discard=True)
+                conn = self._connect()
+                self._mail(conn[0], from_addr)
+            self._send(conn[0], from_addr, to_addrs, msg)
+        except Exception:
+            self.release(conn, discard=True)
+            raise
+        self.release(conn)
+
+
+class SMTPDataWriter(object):
+    """
+    Writes text to a file in the SMTP DATA format, so that it can be sent as is: ASCII only (other characters are
+    dropped), CRLF line endings and leading dots doubled. Text is converted in chunks, so large payloads aren't copied
+    """
+
+    def __init__(self, f, chunk_size=65536):
+        self.f = f
+        self.chunk_size = chunk_size
+        self._line_start = True
+        self._cr = False
+
+    def write(self, text):
+        for start in xrange(0, len(text), self.chunk_size):
+            chunk = text[start:start + self.chunk_size]
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('ascii', 'ignore')
+            if self._cr and chunk.startswith('\n'):
+                # CRLF split between chunks, already written as a line ending
+                chunk = chunk[1:]
+            if not chunk:
+                continue
+            self._cr = chunk.endswith('\r')
+            chunk = chunk.replace('\r\n', '\n').replace('\r', '\n')
+            if self._line_start and chunk.startswith('.'):
+                chunk = '.' + chunk
+            self._line_start = chunk.endswith('\n')
+            self.f.write(chunk.replace('\n.', '\n..').replace('\n', '\r\n'))
+
+    def write_template(self, template, **kwargs):
+        """
+        Writes a str.format template, writing the values in chunks rather than formatting the whole template
+        """
+        for literal, field, spec, conversion in string.Formatter().parse(template):
+            self.write(literal)
+            if field is not None:
+                value = kwargs[field]
+                if spec or not isinstance(value, basestring):
+                    value = format(value, spec)
+                self.write(value)
+
+    def finish(self):
+        """Ends the last line"""
+        if not self._line_start:
+            self.f.write('\r\n')
+            self._line_start = True
+
+
+smtp_pool = SMTPConnectionPool(server=config.get('MAIL_SERVER'),
+                               port=config.get('MAIL_PORT'),
+                               use_tls=config.get('MAIL_USE_TLS', False),
+                               username=config.get('MAIL_USERNAME', None),
+                               password=config.get('MAIL_PASSWORD', None),
+                               size=config.get('MAIL_POOL_SIZE', 2),
+                               max_messages=config.get('MAIL_POOL_MAX_MESSAGES', 100),
+                               max_idle=config.get('MAIL_POOL_MAX_IDLE', 60))
+
+
+class LRUCache(object):
+    """
+    Thread-safe mapping holding up to size entries, or values of total size up to size if sizeof is given; the least
+    recently used entries are evicted to make room for new ones
+    """
+
+    def __init__(self, size=10000, sizeof=None):
+        self.size = size
+        self.sizeof = sizeof
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+        # entries are kept in a circular list, from least to most recently used, of [previous, next, key, value]
+        # links; the root link marks both ends
+        self._links = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: hashable
+        :return: cached value, or None if the key isn't cached
+        """
+        with self._lock:
+            link = self._links.get(key)
+            if link is None:
+                self.misses += 1
+                return None
+            # move the entry to the most recently used end
+            link_prev, link_next, _, value = link
+            link_prev[1] = link_next
+            link_next[0] = link_prev
+            last = self._root[0]
+            last[1] = self._root[0] = link
+            link[0] = last
+            link[1] = self._root
+            self.hits += 1
+            return value
+
+    def _weigh(self, value):
+        return self.sizeof(value) if self.sizeof else 1
+
+    def set(self, key, value):
+        with self._lock:
+            link = self._links.pop(key, None)
+            if link is not None:
+                link[0][1] = link[1]
+                link[1][0] = link[0]
+                self.total -= self._weigh(link[3])
+            weight = self._weigh(value)
+            if weight > self.size:
+                return
+            while self.total + weight > self.size:
+                oldest = self._root[1]
+                oldest[0][1] = oldest[1]
+                oldest[1][0] = oldest[0]
+                del self._links[oldest[2]]
+                self.total -= self._weigh(oldest[3])
+            last = self._root[0]
+            link = [last, self._root, key, value]
+            last[1] = self._root[0] = self._links[key] = link
+            self.total += weight
+
+    def clear(self):
+        with self._lock:
+            self._links.clear()
+            self._root[:] = [self._root, self._root, None, None]
+            self.total = 0
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._links)
+
+
+# rendered results and query sections, shared by all the emails sent from a worker process
+result_cache = LRUCache(size=config.get('RESULT_CACHE_SIZE', 20000))
+section_cache = LRUCache(size=config.get('SECTION_CACHE_SIZE', 10000000), sizeof=lambda parts: sum(map(len, parts)))
+# precomputed arXiv category lists, parsed
+arxiv_category_cache = LRUCache(size=config.get('ARXIV_CATEGORY_CACHE_SIZE', 100000), sizeof=lambda category: len(category[1]))
+
 
 def send_email(email_addr='', email_template=Email, payload_plain=None, payload_html=None, subject=None):
     """
     Encrypts a payload using itsDangerous.TimeSerializer, adding it along with a base
     URL to an email template. Sends an email with this data using the current app's
-    'mail' extension.
+    'mail' extension. The message is assembled in a spooled temporary file, written in the
+    format sent to the SMTP server, so large payloads aren't copied in memory
     :param email_addr: basestring
     :param email_template: emails.Email
     :param payload_plain: basestring
     :param payload_html: basestring (formatted HTML)
     :param subject: basestring
-    :return: msg: MIMEMultipart
+    :return: True if the email was sent, None otherwise
     """
     if (email_addr == '') or (email_addr is None):
         logger.warning('No email address passed for myADS notifications. Not sending email')
@@ -46,52 +392,67 @@ def send_email(email_addr='', email_template=Email, payload_plain=None, payload_
     if subject is None:
         subject = email_template.subject
 
-    # subtype=alternative means each part is equivalent; last attached part is the one to display, if possible
-    msg = MIMEMultipart("alternative")
-    msg["Subject"] = subject
-    msg["From"] = config.get('MAIL_DEFAULT_SENDER')
-    msg["To"] = email_addr
-    plain = MIMEText(email_template.msg_plain.format(payload=payload_plain.encode('ascii', 'ignore')), "plain")
-    html = MIMEText(email_template.msg_html.format(payload=payload_html.encode('ascii', 'ignore'), email_address=email_addr), "html")
-    msg.attach(plain)
-    msg.attach(html)
-
+    boundary = '=' * 15 + uuid.uuid4().hex + '=='
+    msg = tempfile.SpooledTemporaryFile(max_size=config.get('MAIL_SPOOL_SIZE', 1048576))
     try:
-        server = smtplib.SMTP(config.get('MAIL_SERVER'), config.get('MAIL_PORT'))
-        if config.get('MAIL_USE_TLS', False):
-            server.starttls()
-        if config.get('MAIL_USERNAME', None) and config.get('MAIL_PASSWORD', None):
-            server.login(config.get('MAIL_USERNAME'),
-                         config.get('MAIL_PASSWORD'))
-        server.sendmail(config.get('MAIL_DEFAULT_SENDER'),
-                        email_addr,
-                        msg.as_string())
-        server.quit()
-    except Exception as e:
-        logger.error('Error sending email to {0} with payload: {1} with error {2}'.format(email_addr, plain, e))
-        return None
+        writer = SMTPDataWriter(msg)
+        # subtype=alternative means each part is equivalent; last attached part is the one to display, if possible
+        writer.write('Content-Type: multipart/alternative; boundary="{0}"\n'
+                     'MIME-Version: 1.0\n'
+                     'Subject: {1}\n'
+                     'From: {2}\n'
+                     'To: {3}\n'
+                     '\n'.format(boundary, Header(subject).encode(), config.get('MAIL_DEFAULT_SENDER'), email_addr))
+        for subtype, template, payload in (('plain', email_template.msg_plain, payload_plain),
+                                           ('html', email_template.msg_html, payload_html)):
+            writer.write('--{0}\n'
+                         'Content-Type: text/{1}; charset="us-ascii"\n'
+                         'MIME-Version: 1.0\n'
+                         'Content-Transfer-Encoding: 7bit\n'
+                         '\n'.format(boundary, subtype))
+            writer.write_template(template, payload=payload or u'', email_address=email_addr)
+            writer.finish()
+        writer.write('--{0}--\n'.format(boundary))
+
+        try:
+            smtp_pool.sendmail(config.get('MAIL_DEFAULT_SENDER'),
+                               email_addr,
+                               msg)
+        except Exception as e:
+            logger.error('Error sending email to {0} with error {1}'.format(email_addr, e))
+            return None
+    finally:
+        msg.close()
 
     logger.info('Email sent to {0}'.format(email_addr))
-    logger.debug('Email sent to {0} with payload: {1}'.format(email_addr, plain))
-    return msg
+    return True
 
 
-def get_user_email(userid=None):
+def get_user_email(userid=None, use_cache=True):
     """
-    Fetches user email address from adsws
+    Fetches user email address from the local cache, or from adsws if it isn't cached
 
     :param userid: str, system user ID
+    :param use_cache: if False, always fetch from adsws and don't store the result
 
     :return: user email address
     """
 
     if userid:
+        if use_cache:
+            cached = app.get_cached_emails([userid])
+            if cached:
+                return cached.values()[0]
+
         r = app.client.get(config.get('API_ADSWS_USER_EMAIL') % userid,
                            headers={'Accept': 'application/json',
                                     'Authorization': 'Bearer {0}'.format(config.get('API_TOKEN'))}
                            )
         if r.status_code == 200:
-            return r.json()['email']
+            email = r.json()['email']
+            if use_cache:
+                app.set_cached_emails({userid: email})
+            return email
         else:
             logger.warning('Error getting user with ID {0} from the API'.format(userid))
             return None
@@ -100,11 +461,132 @@ def get_user_email(userid=None):
         return None
 
 
+def get_user_setup(userid=None):
+    """
+    Fetches a user's myADS setups from vault
+
+    :param userid: str, system user ID
+
+    :return: list of setups, or None if vault returned an error
+    """
+
+    r = app.client.get(config.get('API_VAULT_MYADS_SETUP') % userid,
+                       headers={'Accept': 'application/json',
+                                'Authorization': 'Bearer {0}'.format(config.get('API_TOKEN'))})
+    if r.status_code != 200:
+        logger.warning('Error getting myADS setup for user {0} from vault'.format(userid))
+        return None
+    return r.json()
+
+
+def sync_user_setups():
+    """
+    Refreshes the local mirror of myADS setups; only the users whose setups changed in vault since the last sync
+    are fetched, then the queries built locally are checked against vault for a sample of the mirrored users. The
+    first sync only records its date: the mirror is then filled by the processing tasks, as they fetch the setups
+    of users missing from it
+
+    :return: number of users synced, or None if the changed users couldn't be fetched from vault
+    """
+
+    with app.session_scope() as session:
+        kv = session.query(KeyValue).filter_by(key='last.setup.sync').first()
+        since = kv.value if kv else None
+
+    sync_date = get_date()
+    if since is None:
+        logger.info('First sync of the myADS setups; setups are added to the mirror by the processing tasks')
+        _set_last_setup_sync(sync_date)
+        return 0
+
+    r = app.client.get(config.get('API_VAULT_MYADS_USERS') % get_date(since).isoformat(),
+                       headers={'Accept': 'application/json',
+                                'Authorization': 'Bearer {0}'.format(config.get('API_TOKEN'))})
+    if r.status_code != 200:
+        logger.warning('Error getting updated myADS users from vault')
+        return None
+    user_ids = r.json()['users']
+
+    pool = ThreadPool(config.get('SETUP_SYNC_THREADS', 8))
+    try:
+        setups = pool.map(get_user_setup, user_ids)
+    finally:
+        pool.close()
+        pool.join()
+
+    chunk_size = config.get('USERS_CHUNK_SIZE', 1000)
+    fetched = [(u, s) for u, s in zip(user_ids, setups) if s is not None]
+    for i in range(0, len(fetched), chunk_size):
+        app.set_cached_setups(dict(fetched[i:i + chunk_size]))
+    # users that couldn't be fetched are dropped from the mirror, so that their tasks go to vault
+    failed = [u for u, s in zip(user_ids, setups) if s is None]
+    for i in range(0, len(failed), chunk_size):
+        app.invalidate_cached_setups(failed[i:i + chunk_size])
+
+    check_cached_setups(config.get('SETUP_CHECK_SAMPLE_SIZE', 50))
+    _set_last_setup_sync(sync_date)
+
+    return len(fetched)
+
+
+def check_cached_setups(sample_size=50):
+    """
+    Compares the templated queries built locally with the ones vault builds today, for a random sample of the
+    mirrored users, to catch the local builder drifting from vault's (e.g. a change to vault's templates or to
+    MYADS_*_TIME_RANGE). The sampled users are stored again with vault's queries wherever they differ, and the
+    templates and frequencies that differed are fetched from vault for all users for the rest of the day
+
+    :param sample_size: number of users to check
+    :return: set of (template, frequency) whose queries differed
+    """
+
+    user_ids = app.sample_cached_setups(sample_size)
+    if not user_ids:
+        return set()
+
+    pool = ThreadPool(config.get('SETUP_SYNC_THREADS', 8))
+    try:
+        setups = pool.map(get_user_setup, user_ids)
+    finally:
+        pool.close()
+        pool.join()
+
+    today = get_date().date()
+    mismatches = set()
+    for user_id, user_setups in zip(user_ids, setups):
+        for s in user_setups or []:
+            if s['type'] != 'template' or 'query' not in s:
+                continue
+            built = app.build_template_query(s, today)
+            if built is not None and built != s['query']:
+                logger.warning('Query built for {0} setup {1} of user {2} differs from vault: {3} != {4}'.
+                               format(s['template'], s['id'], user_id, built, s['query']))
+                mismatches.add((s['template'], s['frequency']))
+
+    app.set_setup_mismatches(today, mismatches)
+    app.set_cached_setups(dict((u, s) for u, s in zip(user_ids, setups) if s is not None))
+
+    return mismatches
+
+
+def _set_last_setup_sync(sync_date=None):
+    """
+    Records the date of a sync of the myADS setups, from which the next sync asks vault for updated users
+    :param sync_date: datetime
+    :return: no return
+    """
+    with app.session_scope() as session:
+        session.execute(insert(KeyValue.__table__).
+                        values(key='last.setup.sync', value=sync_date.isoformat()).
+                        on_conflict_do_update(index_elements=['key'], set_={'value': sync_date.isoformat()}))
+        session.commit()
+
+
 def get_query_results(myADSsetup=None):
     """
     Retrieves results for a stored query
     :param myADSsetup: dict containing query ID and metadata
-    :return: payload: list of dicts containing query name, query url, raw search results
+    :return: payload: list of dicts containing query name, query url, search results (list of SearchResult)
     """
 
     # get the latest results, unless it's not that type of query
@@ -112,16 +594,25 @@ def get_query_results(myADSsetup=None):
         sort = 'date desc, bibcode desc'
     else:
         sort = 'score desc, bibcode desc'
-    q = app.client.get(config.get('API_VAULT_EXECUTE_QUERY') %
-                       (myADSsetup['qid'], myADSsetup['fields'], myADSsetup['rows'], urllib.quote_plus(sort)),
-                       headers={'Accept': 'application/json',
-                                'Authorization': 'Bearer {0}'.format(config.get('API_TOKEN'))})
-    if q.status_code == 200:
-        docs = json.loads(q.text)['response']['docs']
-        q_params = json.loads(q.text)['responseHeader']['params']
-    else:
-        logger.error('Failed getting results for QID {0} from our own API'.format(myADSsetup['qid']))
-        raise RuntimeError(q.text)
+
+    def page_url(sort, rows, cursor):
+        url = config.get('API_VAULT_EXECUTE_QUERY') % \
+            (myADSsetup['qid'], myADSsetup['fields'], rows, urllib.quote_plus(sort))
+        if cursor is not None:
+            url += '&cursorMark={0}'.format(urllib.quote_plus(cursor))
+        return url
+
+    docs = []
+    q_params = None
+    for page, response in enumerate(_iter_pages(page_url, sort=sort, rows=myADSsetup['rows'],
+                                                 description='QID {0}'.format(myADSsetup['qid']))):
+        if page == 0:
+            q_params = response['responseHeader']['params']
+        docs.extend(SearchResult.from_doc(doc) for doc in response['response']['docs'])
+
+    if q_params and q_params.get('sort') == _cursor_sort(sort):
+        # the tiebreak added for paging isn't part of the query shown to the user
+        q_params = dict(q_params, sort=sort)
 
     if q_params:
         # bigquery
@@ -147,11 +638,237 @@ def get_query_results(myADSsetup=None):
     return [{'name': myADSsetup['name'], 'query_url': query_url, 'results': docs, 'query': query}]
 
 
-def get_template_query_results(myADSsetup):
+def _query_cache_key(query=None, sort=None, fields=None, rows=None):
+    """
+    Builds the key for the shared query cache from the canonical form of the query parameters
+    :param query: Solr query string
+    :param sort: Solr sort string
+    :param fields: comma-separated Solr field list
+    :param rows: number of rows requested
+    :return: SHA1 hex digest
+    """
+    canonical = json.dumps([query.strip(),
+                            ','.join(x.strip() for x in sort.split(',')),
+                            ','.join(sorted(x.strip() for x in fields.split(','))),
+                            int(rows)])
+
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def precompute_arxiv_categories(run_id=None):
+    """
+    Fetches the new papers of each arXiv category used in the daily arXiv setups once, and stores them for the run,
+    in compact form. Queries on categories alone are then assembled from these lists, instead of being sent to Solr
+    for every user
+
+    :param run_id: ID of the daily processing run
+    :return: number of categories stored
+    """
+
+    classes = set()
+    with app.session_scope() as session:
+        q = session.query(UserSetup.setups).filter(UserSetup.daily.is_(True)).\
+            execution_options(stream_results=True).yield_per(config.get('USERS_CHUNK_SIZE', 1000))
+        for (setups,) in q:
+            for s in json.loads(setups):
+                if s['frequency'] != 'daily' or s['type'] != 'template' or s['template'] != 'arxiv':
+                    continue
+                # the queries of setups mirrored as template parameters are built locally
+                queries = s.get('query') or app.build_template_query(s, get_date().date()) or []
+                for query in queries:
+                    m = ARXIV_CATEGORY_QUERY.match(query['q'])
+                    if m:
+                        classes.update(c.strip() for c in m.group('classes').split(' OR '))
+
+    # daily queries start today, or MYADS_DAILY_TIME_RANGE days earlier on Mondays
+    start = (get_date().date() - datetime.timedelta(days=config.get('MYADS_DAILY_TIME_RANGE', 2))).isoformat() + \
+        'T00:00'
+    rows = config.get('ARXIV_CATEGORY_ROWS', 5000)
+    num_stored = 0
+    for arxiv_class in sorted(classes):
+        q = 'bibstem:arxiv arxiv_class:({0}) entdate:["{1}" TO NOW]'.format(arxiv_class, start.replace('T', 'Z'))
+        r = app.client.get('{endpoint}?q={query}&sort={sort}&fl={fields}&rows={rows}'.
+                           format(endpoint=config.get('API_SOLR_QUERY_ENDPOINT'),
+                                  query=urllib.quote_plus(q),
+                                  sort=urllib.quote_plus('bibcode desc'),
+                                  fields=ARXIV_CATEGORY_FIELDS,
+                                  rows=rows),
+                           headers={'Authorization': 'Bearer {0}'.format(config.get('API_TOKEN'))})
+        if r.status_code != 200:
+            logger.warning('Error getting new papers for arXiv class {0}: {1}'.format(arxiv_class, r.text))
+            continue
+        response = r.json()['response']
+        if response['numFound'] > len(response['docs']):
+            # incomplete lists can't be used; queries on this class go to Solr
+            logger.warning('Too many new papers for arXiv class {0} ({1}); not precomputed'.
+                           format(arxiv_class, response['numFound']))
+            continue
+
+        # only the dates the queries filter on are kept besides the result itself
+        app.set_arxiv_category(run_id=run_id, arxiv_class=arxiv_class, start=start,
+                               results=[[doc.get('entry_date', '')[:16], doc.get('pubdate', ''),
+                                         SearchResult.from_doc(doc, resolve_arxiv_id=True).to_list()]
+                                        for doc in response['docs']])
+        num_stored += 1
+
+    return num_stored
+
+
+def _cursor_sort(sort=None):
+    """
+    Adds a tiebreak on the unique key to a sort, as cursorMark needs one
+    :param sort: Solr sort string
+    :return: Solr sort string
+    """
+    if any(x.split()[0] == 'id' for x in sort.split(',') if x.strip()):
+        return sort
+    return sort + ', id desc'
+
+
+def _iter_pages(page_url=None, sort=None, rows=None, description=None):
+    """
+    Generator over the responses to a Solr query, sent to Solr or through vault. Result sets larger than
+    SOLR_PAGE_SIZE are fetched in pages using cursorMark, so that only one page of the response is held in memory at
+    a time; paging stops at the first short page, or once numFound docs were returned
+    :param page_url: function of (sort, rows, cursor) returning the URL of a page; cursor is None if the results
+        fit in a single page
+    :param sort: Solr sort string
+    :param rows: maximum number of docs to return
+    :param description: what is being queried, for logging
+    :return: generator of responses, as returned by Solr
+    :raises RuntimeError: if Solr returns an error
+    """
+
+    rows = int(rows)
+    page_size = config.get('SOLR_PAGE_SIZE', 500)
+    paged = rows > page_size
+    if paged:
+        sort = _cursor_sort(sort)
+
+    cursor = '*'
+    returned = 0
+    while returned < rows:
+        page_rows = min(rows - returned, page_size)
+        r = app.client.get(page_url(sort, page_rows, cursor if paged else None),
+                           headers={'Accept': 'application/json',
+                                    'Authorization': 'Bearer {0}'.format(config.get('API_TOKEN'))})
+        if r.status_code != 200:
+            logger.error('Failed getting results for {0} from our own API'.format(description))
+            raise RuntimeError(r.text)
+
+        response = r.json()
+        num_docs = len(response['response']['docs'])
+        num_found = response['response'].get('numFound')
+        next_cursor = response.get('nextCursorMark')
+        returned += num_docs
+        yield response
+        # drop the reference to the page before fetching the next one
+        del r, response
+
+        if not paged or num_docs < page_rows or (num_found is not None and returned >= num_found):
+            return
+        if next_cursor is None:
+            logger.warning('No cursor returned for the next page of results for {0}; only the first {1} results '
+                           'are used'.format(description, returned))
+            return
+        if next_cursor == cursor:
+            return
+        cursor = next_cursor
+
+
+def _iter_solr_docs(query=None, sort=None, fields=None, rows=None):
+    """
+    Generator over the docs returned by Solr for a query, fetched in pages if there are more than SOLR_PAGE_SIZE
+    :param query: Solr query string
+    :param sort: Solr sort string
+    :param fields: comma-separated Solr field list
+    :param rows: maximum number of docs to return
+    :return: generator of docs
+    :raises RuntimeError: if Solr returns an error
+    """
+
+    def page_url(sort, rows, cursor):
+        url = '{endpoint}?q={query}&sort={sort}&fl={fields}&rows={rows}'. \
+            format(endpoint=config.get('API_SOLR_QUERY_ENDPOINT'),
+                   query=urllib.quote_plus(query),
+                   sort=urllib.quote_plus(sort),
+                   fields=fields,
+                   rows=rows)
+        if cursor is not None:
+            url += '&cursorMark={0}'.format(urllib.quote_plus(cursor))
+        return url
+
+    for response in _iter_pages(page_url, sort=sort, rows=rows, description='query {0}'.format(query)):
+        for doc in response['response']['docs']:
+            yield doc
+
+
+def _get_arxiv_category(run_id=None, arxiv_class=None):
+    """
+    Fetches the list of new papers in an arXiv category precomputed for the run. The lists don't change during the
+    run, so parsed lists are kept by each worker process
+    :param run_id: ID of the current processing run
+    :param arxiv_class: arXiv class, as used in the query
+    :return: tuple of (earliest entry date covered; list of (entry date, pubdate, SearchResult)), or None if the
+        category wasn't precomputed
+    """
+
+    key = (run_id, arxiv_class)
+    category = arxiv_category_cache.get(key)
+    if category is None:
+        category = app.get_arxiv_category(run_id=run_id, arxiv_class=arxiv_class)
+        if category is None:
+            return None
+        category = (category[0], [(entry_date, pubdate, SearchResult.from_list(r))
+                                  for entry_date, pubdate, r in category[1]])
+        arxiv_category_cache.set(key, category)
+    return category
+
+
+def _assemble_arxiv_category_query(query=None, sort=None, fields=None, rows=None, run_id=None):
+    """
+    Builds the results of a daily arXiv query on categories alone from the category lists precomputed for the run
+    :param query: Solr query string
+    :param sort: Solr sort string
+    :param fields: comma-separated Solr field list
+    :param rows: number of rows requested
+    :param run_id: ID of the current processing run
+    :return: list of SearchResult, or None if the query can't be assembled locally
+    """
+
+    m = ARXIV_CATEGORY_QUERY.match(query)
+    if not m or sort.strip() != 'bibcode desc':
+        return None
+    # the stored results are built from all the fields a result uses, so they match the results of Solr only if
+    # all of these fields are requested
+    fields = set(f.strip() for f in fields.split(','))
+    if not set(SearchResult.DOC_FIELDS) <= fields <= set(ARXIV_CATEGORY_FIELDS.split(',')):
+        return None
+
+    # bounds are compared with the start of the Solr dates, e.g. 2020-01-01T00:00
+    start = m.group('start').replace('Z', 'T')
+    end = m.group('end').replace('Z', 'T') if m.group('end') else None
+    pubdate = m.group('pubdate')
+
+    results = {}
+    for arxiv_class in m.group('classes').split(' OR '):
+        category = _get_arxiv_category(run_id, arxiv_class.strip())
+        if category is None or category[0] > start:
+            return None
+        for entry_date, result_pubdate, result in category[1]:
+            if entry_date < start or (end and entry_date > end) or result_pubdate < pubdate:
+                continue
+            results[result.bibcode] = result
+
+    return [r for _, r in sorted(results.items(), reverse=True)[:int(rows)]]
+
+
+def get_template_query_results(myADSsetup, run_id=None):
     """
     Retrieves results for a templated query
     :param myADSsetup: dict containing query terms, params, and metadata
-    :return: payload: list of dicts containing query name, query url, raw search results
+    :param run_id: ID of the current processing run; if given, results are shared with other users via the query cache
+    :return: payload: list of dicts containing query name, query url, search results (list of SearchResult)
     """
 
     if myADSsetup['template'] == 'authors':
@@ -198,33 +915,51 @@ def get_template_query_results(myADSsetup):
                          format(endpoint=config.get('API_SOLR_QUERY_ENDPOINT'),
                                 query=urllib.quote_plus(myADSsetup['query'][i]['q']),
                                 sort=urllib.quote_plus(myADSsetup['query'][i]['sort']))
-        r = app.client.get('{query_url}&fl={fields}&rows={rows}'.
-                           format(query_url=query,
-                                  fields=myADSsetup['fields'],
-                                  rows=myADSsetup['rows']),
-                           headers={'Authorization': 'Bearer {0}'.format(config.get('API_TOKEN'))})
+        # results are cached in compact form
+        results = None
+        if run_id:
+            cache_key = _query_cache_key(query=myADSsetup['query'][i]['q'],
+                                         sort=myADSsetup['query'][i]['sort'],
+                                         fields=myADSsetup['fields'],
+                                         rows=myADSsetup['rows'])
+            cached = app.get_cached_query(key=cache_key, run_id=run_id)
+            if cached is None:
+                metrics.inc('myads_query_cache_total', result='miss')
+            else:
+                metrics.inc('myads_query_cache_total', result='hit')
+                results = [SearchResult.from_list(r) for r in cached]
 
-        if r.status_code != 200:
-            logger.error('Failed getting results for query {0} from our own API'.format(myADSsetup['query'][i]))
-            raise RuntimeError(r.text)
-        else:
-            docs = json.loads(r.text)['response']['docs']
-            for doc in docs:
-                arxiv_ids = [j for j in doc['identifier'] if j.startswith('arXiv:')]
-                if len(arxiv_ids) > 0:
-                    doc['arxiv_id'] = arxiv_ids[0]
-            if myADSsetup['template'] == 'citations':
-                # get the number of citations
-                cites_query = '{endpoint}?q={query}&rows=1&stats=true&stats.field=citation_count'. \
-                               format(endpoint=config.get('API_SOLR_QUERY_ENDPOINT'),
-                                      query=urllib.quote_plus(myADSsetup['data']))
-                cites_r = app.client.get(cites_query,
-                                         headers={'Authorization': 'Bearer {0}'.format(config.get('API_TOKEN'))})
-                name[i] = name[i] % int(cites_r.json()['stats']['stats_fields']['citation_count']['sum'])
+        if results is None and run_id and myADSsetup['template'] == 'arxiv':
+            results = _assemble_arxiv_category_query(query=myADSsetup['query'][i]['q'],
+                                                     sort=myADSsetup['query'][i]['sort'],
+                                                     fields=myADSsetup['fields'],
+                                                     rows=myADSsetup['rows'],
+                                                     run_id=run_id)
+            if results is not None:
+                app.set_cached_query(key=cache_key, run_id=run_id, results=[r.to_list() for r in results])
+
+        if results is None:
+            results = [SearchResult.from_doc(doc, resolve_arxiv_id=True)
+                       for doc in _iter_solr_docs(query=myADSsetup['query'][i]['q'],
+                                                  sort=myADSsetup['query'][i]['sort'],
+                                                  fields=myADSsetup['fields'],
+                                                  rows=myADSsetup['rows'])]
+            if run_id:
+                app.set_cached_query(key=cache_key, run_id=run_id, results=[r.to_list() for r in results])
+
+        if myADSsetup['template'] == 'citations':
+            # get the number of citations
+            cites_query = '{endpoint}?q={query}&rows=1&stats=true&stats.field=citation_count'. \
+                           format(endpoint=config.get('API_SOLR_QUERY_ENDPOINT'),
+                                  query=urllib.quote_plus(myADSsetup['data']))
+            cites_r = app.client.get(cites_query,
+                                     headers={'Authorization': 'Bearer {0}'.format(config.get('API_TOKEN'))})
+            name[i] = name[i] % int(cites_r.json()['stats']['stats_fields']['citation_count']['sum'])
 
         query_url = query.replace(config.get('API_SOLR_QUERY_ENDPOINT') + '?', config.get('UI_ENDPOINT') + '/search/') \
                     + '?utm_source=myads&utm_medium=email&utm_campaign=type:{0}&utm_term={1}&utm_content=queryurl'
-        payload.append({'name': name[i], 'query_url': query_url, 'query': myADSsetup['query'][i]['q'], 'results': docs})
+        payload.append({'name': name[i], 'query_url': query_url, 'query': myADSsetup['query'][i]['q'],
+                        'results': results})
 
     return payload
 
@@ -232,22 +967,32 @@ def get_template_query_results(myADSsetup):
 def _get_first_author_formatted(result_dict=None, author_field='author_norm', num_authors=3):
     """
     Get the first author, format it correctly
-    :param result_dict: dict containing the results from solr for a single bibcode, including the author list
-    :param author_field: Solr field to select first author from
+    :param result_dict: SearchResult, or dict containing the results from solr for a single bibcode, including the
+        author list
+    :param author_field: Solr field to select first author from; ignored for SearchResult
     :param num_authors: number of authors to display
     :return: formatted first author
     """
 
-    if author_field not in result_dict:
+    if isinstance(result_dict, SearchResult):
+        if result_dict.authors is None:
+            logger.warning('Author field not supplied in result {0}'.format(result_dict))
+            return ''
+        authors = result_dict.authors
+        num = result_dict.num_authors
+    elif author_field not in result_dict:
         logger.warning('Author field {0} not supplied in result {1}'.format(author_field, result_dict))
         return ''
+    else:
+        authors = result_dict.get(author_field)
+        num = len(authors) if type(authors) == list else 1
 
-    authors = result_dict.get(author_field)
-    if type(authors) == list:
-        num = len(authors)
-        if num_authors < num:
-            first_author = '; '.join(authors[0:num_authors])
-            first_author += ' and {0} more'.format(num-num_authors)
+    if isinstance(authors, (list, tuple)):
+        # a SearchResult only keeps the first MAX_AUTHORS authors
+        shown = min(num_authors, len(authors))
+        if shown < num:
+            first_author = '; '.join(authors[0:shown])
+            first_author += ' and {0} more'.format(num-shown)
         elif num >= 2:
             first_author = '; '.join(authors[:-1])
             first_author += ' and ' + authors[-1]
@@ -262,10 +1007,13 @@ def _get_first_author_formatted(result_dict=None, author_field='author_norm', nu
 def _get_title(result_dict=None):
     """
     Get the title
-    :param result_dict:
+    :param result_dict: SearchResult, or dict containing the results from solr for a single bibcode
     :return: formatted title
     """
 
+    if isinstance(result_dict, SearchResult):
+        return result_dict.title
+
     if type(result_dict.get('title', '')) == list:
         title = result_dict.get('title')[0]
     else:
@@ -274,34 +1022,145 @@ def _get_title(result_dict=None):
     return title
 
 
+# per-email values are rendered as these markers, so that rendered results and sections can be shared between emails
+RESULT_PLACEHOLDERS = re.compile(u'\x00(qtype|id|rank)\x00')
+
+
+def _split_placeholders(rendered):
+    """
+    :param rendered: text rendered with placeholder markers
+    :return: tuple of literal text alternating with placeholder names
+    """
+    return tuple(RESULT_PLACEHOLDERS.split(unicode(rendered)))
+
+
+def _fill_placeholders(parts, values):
+    """
+    :param parts: tuple of literal text alternating with placeholder names
+    :param values: dict of the values of the placeholders, already escaped if needed
+    :return: text with the placeholders filled in
+    """
+    if len(parts) == 1:
+        return parts[0]
+    formatted = list(parts)
+    formatted[1::2] = [values[name] for name in parts[1::2]]
+    return u''.join(formatted)
+
+
+def _get_result_macros():
+    """
+    :return: module of the macros of results.html, for the configured abstract and arXiv links
+    """
+    urls = (config.get('ABSTRACT_UI_ENDPOINT'), config.get('ARXIV_URL'))
+    macros = _result_macros.get(urls)
+    if macros is None:
+        macros = env.get_template('results.html').make_module({'abs_url': urls[0], 'arxiv_url': urls[1]})
+        _result_macros[urls] = macros
+    return macros
+
+
+def _render_result(result=None, variant='plain', qtype=None, id=None, rank=None):
+    """
+    Renders a single result, in plain text or in the markup of one of the HTML layouts. The rendering is cached
+    without the per-email values, which are filled in on each call
+    :param result: SearchResult, or dict containing the results from solr for a single bibcode
+    :param variant: 'plain', or the HTML layout: 'one_col' or 'two_col'
+    :param qtype: query type, for the tracking parameters of the links
+    :param id: setup ID, for the tracking parameters of the links
+    :param rank: position of the result in its query section, for the tracking parameters of the links
+    :return: formatted result; Markup for the HTML layouts
+    """
+
+    if not isinstance(result, SearchResult):
+        result = SearchResult.from_doc(result)
+
+    key = (variant, result)
+    parts = result_cache.get(key)
+    if parts is None:
+        if variant == 'plain':
+            rendered = u"\"{0},\" {1} ({2})\n".format(_get_title(result), _get_first_author_formatted(result),
+                                                       result.bibcode)
+        else:
+            rendered = getattr(_get_result_macros(), variant)(result, u'\x00qtype\x00', u'\x00id\x00', u'\x00rank\x00')
+        parts = _split_placeholders(rendered)
+        result_cache.set(key, parts)
+
+    if variant == 'plain':
+        return parts[0]
+    return Markup(_fill_placeholders(parts, {'qtype': escape(qtype), 'id': escape(id), 'rank': escape(rank)}))
+
+
+def _render_sections(section=None, variants=('plain',)):
+    """
+    Renders a query section, its name linked to the query and its results, in one or several formats, going through
+    the results once. Renderings are cached without the setup ID, which is filled in on each call, so identical
+    sections in different emails are only rendered once
+    :param section: dict containing query name, query url, query type, setup ID and results
+    :param variants: formats: 'plain', or the HTML layout: 'one_col' or 'two_col'
+    :return: list of formatted sections, one per variant; Markup for the HTML layouts
+    """
+
+    results = tuple(r if isinstance(r, SearchResult) else SearchResult.from_doc(r) for r in section['results'])
+    # the results are keyed by digest: the key is held by the cache, but not counted in its size
+    results_digest = digest(results)
+    keys = [(variant, section['name'], section['query_url'], section.get('query'), section['qtype'], results_digest)
+            for variant in variants]
+    parts = [section_cache.get(key) for key in keys]
+
+    missing = [i for i in range(len(variants)) if parts[i] is None]
+    if missing:
+        rendered = dict((i, []) for i in missing)
+        for rank, r in enumerate(results, 1):
+            for i in missing:
+                rendered[i].append(_render_result(r, variants[i], section['qtype'], u'\x00id\x00', rank))
+        for i in missing:
+            if variants[i] == 'plain':
+                rendered[i].insert(0, u"{0} ({1}) \n".format(section['name'],
+                                                            section['query_url'].format(section['qtype'],
+                                                                                        u'\x00id\x00')))
+                rendered[i].append(u"\n")
+                rendered[i] = u''.join(rendered[i])
+            else:
+                rendered[i] = _get_result_macros().section(section, rendered[i], u'\x00id\x00')
+            parts[i] = _split_placeholders(rendered[i])
+            section_cache.set(keys[i], parts[i])
+
+    formatted = []
+    for variant, section_parts in zip(variants, parts):
+        if variant == 'plain':
+            formatted.append(_fill_placeholders(section_parts, {'id': unicode(section['id'])}))
+        else:
+            formatted.append(Markup(_fill_placeholders(section_parts, {'id': escape(section['id'])})))
+    return formatted
+
+
 def payload_to_plain(payload=None):
     """
     Converts the myADS results into the plain text message payload
     :param payload: list of dicts
     :return: plain text formatted payload
     """
-    formatted = u''
-    for p in payload:
-        formatted += u"{0} ({1}) \n".format(p['name'], p['query_url'].format(p['qtype'], p['id']))
-        for r in p['results']:
-            first_author = _get_first_author_formatted(r)
-            if type(r.get('title', '')) == list:
-                title = r.get('title')[0]
-            else:
-                title = r.get('title', '')
-            formatted += u"\"{0},\" {1} ({2})\n".format(title, first_author, r['bibcode'])
-        formatted += u"\n"
-
-    return formatted
+    return u''.join(_render_sections(p, ('plain',))[0] for p in payload)
 
 env.globals['_get_first_author_formatted'] = _get_first_author_formatted
 env.globals['_get_title'] = _get_title
 
 
-def payload_to_html(payload=None, col=1, frequency='daily', email_address=None):
+def load_templates():
     """
-    Converts the myADS results into the HTML formatted message payload
-    :param payload: list of dicts
+    Loads the email templates, compiling them if they aren't in the bytecode cache, so that it isn't done while
+    sending the first emails
+    :return: no return
+    """
+    for name in TEMPLATES:
+        env.get_template(name)
+    _get_result_macros()
+
+
+def _render_html(sections=None, col=1, frequency='daily', email_address=None):
+    """
+    Lays out rendered query sections in the HTML formatted message payload
+    :param sections: list of query sections, rendered in the layout for col
     :param col: number of columns to display in formatted email (1 or 2)
     :param frequency: 'daily' or 'weekly' notification
     :param email_address: email address of user, for footer
@@ -314,24 +1173,60 @@ def payload_to_html(payload=None, col=1, frequency='daily', email_address=None):
         template = env.get_template('one_col.html')
         return template.render(frequency=frequency,
                                date=date_formatted,
-                               payload=payload,
-                               abs_url=config.get('ABSTRACT_UI_ENDPOINT'),
-                               email_address=email_address,
-                               arxiv_url=config.get('ARXIV_URL'))
-
-    elif col == 2:
-        left_col = payload[:len(payload) // 2]
-        right_col = payload[len(payload) // 2:]
+                               sections=sections,
+                               email_address=email_address)
+
+    else:
         template = env.get_template('two_col.html')
         return template.render(frequency=frequency,
                                date=date_formatted,
-                               left_payload=left_col,
-                               right_payload=right_col,
-                               abs_url=config.get('ABSTRACT_UI_ENDPOINT'),
-                               email_address=email_address,
-                               arxiv_url=config.get('ARXIV_URL'))
+                               left_sections=sections[:len(sections) // 2],
+                               right_sections=sections[len(sections) // 2:],
+                               email_address=email_address)
 
-    else:
+
+def payload_to_html(payload=None, col=1, frequency='daily', email_address=None):
+    """
+    Converts the myADS results into the HTML formatted message payload
+    :param payload: list of dicts
+    :param col: number of columns to display in formatted email (1 or 2)
+    :param frequency: 'daily' or 'weekly' notification
+    :param email_address: email address of user, for footer
+    :return: HTML formatted payload
+    """
+
+    if col not in (1, 2):
         logger.warning('Incorrect number of columns (col={0}) passed for payload {1}. No formatting done'.
                        format(col, payload))
         return None
+
+    variant = 'one_col' if col == 1 else 'two_col'
+    sections = [_render_sections(p, (variant,))[0] for p in payload]
+    return _render_html(sections, col=col, frequency=frequency, email_address=email_address)
+
+
+def render_payload(payload=None, col=1, frequency='daily', email_address=None):
+    """
+    Converts the myADS results into both the plain text and the HTML formatted message payloads, going through the
+    results once
+    :param payload: list of dicts
+    :param col: number of columns to display in formatted email (1 or 2)
+    :param frequency: 'daily' or 'weekly' notification
+    :param email_address: email address of user, for footer
+    :return: plain text formatted payload, HTML formatted payload (None if col is incorrect)
+    """
+
+    if col not in (1, 2):
+        logger.warning('Incorrect number of columns (col={0}) passed for payload {1}. No HTML formatting done'.
+                       format(col, payload))
+        return payload_to_plain(payload), None
+
+    variants = ('plain', 'one_col' if col == 1 else 'two_col')
+    plain = []
+    sections = []
+    for p in payload:
+        section_plain, section_html = _render_sections(p, variants)
+        plain.append(section_plain)
+        sections.append(section_html)
+
+    return u''.join(plain), _render_html(sections, col=col, frequency=frequency, email_address=email_address)
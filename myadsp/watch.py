@@ -0,0 +1,100 @@
+"""
+Helpers for waiting on ingest readiness: file change notification, with a polling fallback, and back-off probing
+"""
+
+from adsputils import setup_logging
+import os
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+logger = setup_logging('myads_watch')
+
+
+class _EventCollector(object):
+    """Collects the event masks of the files changed in a watched directory, by file name"""
+
+    def __init__(self):
+        self.masks = {}
+
+    def __call__(self, event):
+        self.masks[event.name] = self.masks.get(event.name, 0) | event.mask
+
+
+def wait_for_file(path, check, timeout, poll_interval=30):
+    """
+    Waits until check() returns a true value. check() is re-evaluated as soon as path is written to or moved into
+    place (if pyinotify is available) and, in any case, at least every poll_interval seconds, since inotify does not
+    report changes made from other hosts on network filesystems
+
+    :param path: file to watch
+    :param check: function of one argument, true if the file was just closed after writing or moved into place, in
+        which case it's complete; returns a true value once the file is ready
+    :param timeout: maximum time to wait (units=seconds)
+    :param poll_interval: maximum time between checks (units=seconds)
+    :return: value returned by check, or None if it timed out
+    """
+    deadline = time.time() + timeout
+    result = check(False)
+    if result:
+        return result
+
+    directory = os.path.dirname(path)
+    if pyinotify is None or not os.path.isdir(directory):
+        return wait_until(lambda: check(False), deadline - time.time(), min_delay=poll_interval,
+                          max_delay=poll_interval)
+
+    complete_mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
+    collector = _EventCollector()
+    wm = pyinotify.WatchManager()
+    notifier = pyinotify.Notifier(wm, default_proc_fun=collector)
+    wm.add_watch(directory, complete_mask | pyinotify.IN_ATTRIB)
+    try:
+        # the file may have changed while the watch was being set up
+        result = check(False)
+        while not result:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            closed = False
+            if notifier.check_events(timeout=int(min(remaining, poll_interval) * 1000)):
+                notifier.read_events()
+                notifier.process_events()
+                mask = collector.masks.get(os.path.basename(path))
+                collector.masks.clear()
+                if mask is None:
+                    continue
+                closed = bool(mask & complete_mask)
+                logger.info('{0} changed, checking it again'.format(path))
+            result = check(closed)
+        return result
+    finally:
+        notifier.stop()
+
+
+def wait_until(check, timeout, min_delay=15, max_delay=300, factor=2):
+    """
+    Calls check() until it returns a true value, sleeping between attempts; the delay starts at min_delay and grows
+    by factor after each attempt, up to max_delay
+
+    :param check: function with no arguments
+    :param timeout: maximum time to wait (units=seconds)
+    :param min_delay: first delay (units=seconds)
+    :param max_delay: maximum delay (units=seconds)
+    :param factor: growth of the delay after each failed attempt
+    :return: value returned by check, or None if it timed out
+    """
+    deadline = time.time() + timeout
+    delay = min_delay
+    while True:
+        result = check()
+        if result:
+            return result
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        time.sleep(min(delay, remaining))
+        delay = min(delay * factor, max_delay)
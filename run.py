@@ -1,5 +1,5 @@
 from adsputils import setup_logging, get_date, load_config
-from myadsp import tasks, utils
+from myadsp import metrics, tasks, utils, watch
 from myadsp.models import KeyValue
 import pyingest.parsers.arxiv as arxiv
 
@@ -10,7 +10,10 @@ import logging
 import warnings
 import datetime
 import gzip
+import struct
+import zlib
 import random
+import math
 import json
 import urllib
 from requests.packages.urllib3 import exceptions
@@ -24,9 +27,10 @@ config.update(load_config())
 
 def _arxiv_ingest_complete(date=None, sleep_delay=60, sleep_timeout=7200):
     """
-    Check if new arXiv records are in Solr - run before running myADS processing
+    Check if new arXiv records are in Solr - run before running myADS processing. Waits for the UpdateAgent file
+    to be completely written, then probes Solr with an increasing delay between attempts
     :param date: date to check arXiv records for; default is set by days-delta from today in config (times in local time)
-    :param sleep_delay: number of seconds to sleep between retries
+    :param sleep_delay: maximum number of seconds to sleep between retries
     :param sleep_timeout: number of seconds to retry in total before timing out completely
     :return: test bibcode or None
     """
@@ -38,27 +42,44 @@ def _arxiv_ingest_complete(date=None, sleep_delay=60, sleep_timeout=7200):
 
     arxiv_file = config.get('ARXIV_UPDATE_AGENT_DIR') + '/UpdateAgent.out.' + date + '.gz'
 
-    arxiv_records = []
-    try:
-        with gzip.open(arxiv_file, 'r') as flist:
-            for l in flist.readlines():
-                # sample line: oai/arXiv.org/0706/2491 2018-06-13T01:00:29
-                arxiv_records.append(l.split()[0])
-    except IOError:
-        logger.warning('arXiv ingest file not found. Exiting.')
-        return None
+    poll_interval = min(sleep_delay, config.get('INGEST_POLL_INTERVAL', 30))
+    last_seen = {}
 
-    arxiv_records.sort()
+    def _arxiv_file_ready(closed):
+        try:
+            stat = os.stat(arxiv_file)
+        except OSError:
+            return None
+        # the file is read once it's no longer being written: either it was just closed after writing or moved into
+        # place, it hasn't changed since the previous check, or it was last modified longer ago than the time
+        # between checks
+        current = (stat.st_mtime, stat.st_size)
+        previous = last_seen.get('stat')
+        last_seen['stat'] = current
+        if not closed and current != previous and stat.st_mtime > time.time() - poll_interval:
+            return None
+        if last_seen.get('unreadable') == current:
+            return None
 
-    # get the highest numbered ID
-    is_new = False
-    while is_new is False:
-        last_record = arxiv_records.pop()
         try:
-            test_new = float(last_record.split('/')[-2])
-            is_new = True
-        except ValueError:
-            continue
+            last_record = _last_arxiv_record(arxiv_file)
+        except (IOError, EOFError, struct.error, zlib.error) as e:
+            logger.warning('arXiv ingest file {0} not complete yet ({1}). Waiting for it to be written'.
+                           format(arxiv_file, e))
+            last_seen['unreadable'] = current
+            return None
+        # wrapped, so that a complete file without new records also ends the wait
+        return [last_record]
+
+    ready = watch.wait_for_file(arxiv_file, _arxiv_file_ready, sleep_timeout, poll_interval=poll_interval)
+    if not ready:
+        logger.warning('arXiv ingest file not found or not complete. Exiting.')
+        return None
+    last_record = ready[0]
+
+    if last_record is None:
+        logger.warning('No new arXiv records found in {0}. Exiting.'.format(arxiv_file))
+        return None
 
     # get the most recent record, convert to a filename
     last_file = config.get('ARXIV_INCOMING_ABS_DIR') + '/' + last_record
@@ -83,55 +104,81 @@ def _arxiv_ingest_complete(date=None, sleep_delay=60, sleep_timeout=7200):
         logger.exception('No bibcode found in arXiv record: {0}'.format(arxiv_record))
         return None
 
-    total_delay = 0
-    while total_delay < sleep_timeout:
-        total_delay += sleep_delay
+    def _test_bibcode_found():
         r = app.client.get('{0}?q=identifier:{1}&fl=bibcode,identifier,entry_date'.format(config.get('API_SOLR_QUERY_ENDPOINT'), last_bibc),
                            headers={'Authorization': 'Bearer ' + config.get('API_TOKEN')})
         if r.status_code != 200:
-            time.sleep(sleep_delay)
             logger.error('Error retrieving bibcode {0} from Solr ({1} {2}), retrying'.
                          format(last_bibc, r.status_code, r.text))
-            continue
+            return None
 
-        numfound = r.json()['response']['numFound']
-        if numfound == 0:
+        if r.json()['response']['numFound'] == 0:
             # nothing found, try again after a sleep
-            time.sleep(sleep_delay)
-            logger.info('arXiv ingest not complete (test arXiv bibcode: {0}). Sleeping {1}s, for a total delay of {2}s.'
-                        .format(last_bibc, sleep_delay, total_delay))
-            continue
-        if numfound > 1:
-            # returning this as true for now, since technically something was found
-            logger.error('Too many records returned for bibcode {0}'.format(last_bibc))
-
-        logger.info('Numfound: {0} for test bibcode {1}. Response: {2}. URL: {3}'.format(numfound, last_bibc,
-                                                                                         json.dumps(r.json()), r.url))
-
-        # check number of bibcodes from ingest
-        if get_date().weekday() == 0:
-            start_date = (get_date() - datetime.timedelta(days=3)).date()
-        else:
-            start_date = (get_date() - datetime.timedelta(days=1)).date()
-        beg_pubyear = (get_date() - datetime.timedelta(days=180)).year
-        q = app.client.get('{0}?q={1}'.format(config.get('API_SOLR_QUERY_ENDPOINT'),
-                                              urllib.quote_plus('bibstem:arxiv entdate:["{0}Z00:00" TO NOW] '
-                                                                'pubdate:[{1}-00 TO *]'.format(start_date, beg_pubyear))),
-                           headers={'Authorization': 'Bearer ' + config.get('API_TOKEN')})
-        logger.info('Total number of arXiv bibcodes ingested: {}'.format(q.json()['response']['numFound']))
+            logger.info('arXiv ingest not complete (test arXiv bibcode: {0}). Retrying.'.format(last_bibc))
+            return None
+        return r
 
-        return last_bibc
+    r = watch.wait_until(_test_bibcode_found, sleep_timeout,
+                         min_delay=min(sleep_delay, config.get('SOLR_PROBE_MIN_DELAY', 15)), max_delay=sleep_delay)
+    if r is None:
+        logger.warning('arXiv ingest did not complete within the {0}s timeout limit. Exiting.'.format(sleep_timeout))
+        return None
 
-    logger.warning('arXiv ingest did not complete within the {0}s timeout limit. Exiting.'.format(sleep_timeout))
+    numfound = r.json()['response']['numFound']
+    if numfound > 1:
+        # returning this as true for now, since technically something was found
+        logger.error('Too many records returned for bibcode {0}'.format(last_bibc))
 
-    return None
+    logger.info('Numfound: {0} for test bibcode {1}. Response: {2}. URL: {3}'.format(numfound, last_bibc,
+                                                                                     json.dumps(r.json()), r.url))
+
+    # check number of bibcodes from ingest
+    if get_date().weekday() == 0:
+        start_date = (get_date() - datetime.timedelta(days=3)).date()
+    else:
+        start_date = (get_date() - datetime.timedelta(days=1)).date()
+    beg_pubyear = (get_date() - datetime.timedelta(days=180)).year
+    q = app.client.get('{0}?q={1}'.format(config.get('API_SOLR_QUERY_ENDPOINT'),
+                                          urllib.quote_plus('bibstem:arxiv entdate:["{0}Z00:00" TO NOW] '
+                                                            'pubdate:[{1}-00 TO *]'.format(start_date, beg_pubyear))),
+                       headers={'Authorization': 'Bearer ' + config.get('API_TOKEN')})
+    logger.info('Total number of arXiv bibcodes ingested: {}'.format(q.json()['response']['numFound']))
+
+    return last_bibc
+
+
+def _last_arxiv_record(arxiv_file):
+    """
+    Finds the highest numbered record in the arXiv UpdateAgent file in a single pass; only records with a numeric
+    directory (new-style IDs) count. Errors reading the file, e.g. while it's being written, are raised
+    :param arxiv_file: path to the gzipped UpdateAgent file
+    :return: record path, or None if the file has no new-style records
+    """
+    last_record = None
+    with gzip.open(arxiv_file, 'r') as flist:
+        for l in flist:
+            # sample line: oai/arXiv.org/0706/2491 2018-06-13T01:00:29
+            fields = l.split(None, 1)
+            if not fields:
+                continue
+            record = fields[0]
+            if last_record is not None and record <= last_record:
+                continue
+            try:
+                float(record.split('/')[-2])
+            except (ValueError, IndexError):
+                continue
+            last_record = record
+
+    return last_record
 
 
 def _astro_ingest_complete(date=None, sleep_delay=60, sleep_timeout=7200):
     """
-    Check if new astronomy records are in Solr; run before weekly processing
+    Check if new astronomy records are in Solr; run before weekly processing. Waits for the astronomy bibcode list
+    to be updated, then probes Solr with an increasing delay between attempts
     :param date: check to check against astronomy bibcode list last updated date
-    :param sleep_delay: number of seconds to sleep between retries
+    :param sleep_delay: maximum number of seconds to sleep between retries
     :param sleep_timeout: number of seconds to retry in total before timing out completely
     :return: test bibcode or None
     """
@@ -142,105 +189,208 @@ def _astro_ingest_complete(date=None, sleep_delay=60, sleep_timeout=7200):
         date = get_date(date)
 
     astro_file = config.get('ASTRO_INCOMING_DIR') + 'matches.input'
+    last_seen = {}
 
-    # make sure file is present and check modified datestamp on file - should be recent (otherwise contains old data)
-    try:
-        mod_date = datetime.datetime.fromtimestamp(os.path.getmtime(astro_file))
-    except OSError:
-        mod_date = None
-
-    # if the file is old or missing, sleep until the file is present and updated
-    if not mod_date or mod_date < date:
-        total_delay = 0
-        while total_delay < sleep_timeout:
-            total_delay += sleep_delay
-            time.sleep(sleep_delay)
-            try:
-                mod_date = datetime.datetime.fromtimestamp(os.path.getmtime(astro_file))
-            except OSError:
-                mod_date = None
-            if mod_date and mod_date > date:
-                break
-        else:
-            # timeout reached before astronomy update completed
-            logger.warning('Astronomy update did not complete within the {0}s timeout limit. Exiting.'.format(sleep_timeout))
-
+    def _astro_file_ready(closed):
+        # make sure file is present and check modified datestamp on file - should be recent (otherwise contains old data)
+        try:
+            stat = os.stat(astro_file)
+        except OSError:
+            return None
+        if datetime.datetime.fromtimestamp(stat.st_mtime) < date:
+            return None
+        # only re-read the file if it changed since the last check
+        if last_seen.get('stat') == (stat.st_mtime, stat.st_size):
             return None
+        last_seen['stat'] = (stat.st_mtime, stat.st_size)
 
-    # make sure the ingest file exists and has enough bibcodes
-    total_delay = 0
-    while total_delay < sleep_timeout:
-        astro_records = []
+        # make sure the ingest file has enough bibcodes
         try:
-            with open(astro_file, 'r') as flist:
-                for l in flist.readlines():
-                    # sample line: 2019A&A...632A..94J     K58-37447
-                    astro_records.append(l.split()[0])
+            num_records, sample = _sample_astro_records(astro_file, config.get('ASTRO_SAMPLE_SIZE'))
         except IOError:
-            time.sleep(sleep_delay)
-            total_delay += sleep_delay
-            logger.warning('Error opening astronomy ingest file. Sleeping {0}s, for a total delay of {1}s'.
-                           format(sleep_delay, total_delay))
-            continue
-
-        if len(astro_records) < 10:
-            time.sleep(sleep_delay)
-            total_delay += sleep_delay
-            logger.warning('Astronomy ingest file too small - ingest not complete. Sleeping {0}s, for a total delay of {1}s'.
-                           format(sleep_delay, total_delay))
-            continue
-        else:
-            break
-    else:
+            logger.warning('Error opening astronomy ingest file. Waiting for it to be updated')
+            return None
+
+        if num_records < 10:
+            logger.warning('Astronomy ingest file too small - ingest not complete. Waiting for it to be updated')
+            return None
+        return sample
+
+    # if the file is old, missing or too small, wait until it's updated
+    sample = watch.wait_for_file(astro_file, _astro_file_ready, sleep_timeout,
+                                 poll_interval=min(sleep_delay, config.get('INGEST_POLL_INTERVAL', 30)))
+    if not sample:
+        # timeout reached before astronomy update completed
+        logger.warning('Astronomy update did not complete within the {0}s timeout limit. Exiting.'.format(sleep_timeout))
+
         return None
 
-    # get several randomly selected bibcodes, in case one had ingest issues
-    sample = random.sample(astro_records, config.get('ASTRO_SAMPLE_SIZE'))
-
-    # check that the astronomy records have made it into solr
-    total_delay = 0
-    while total_delay < sleep_timeout:
-        num_sampled = 0
-        for s in sample:
-            num_sampled += 1
-            r = app.client.get('{0}?q=identifier:{1}&fl=bibcode,identifier,entry_date'.format(config.get('API_SOLR_QUERY_ENDPOINT'), s),
-                               headers={'Authorization': 'Bearer ' + config.get('API_TOKEN')})
-            # if there's a solr error, sleep then move to the next bibcode
-            if r.status_code != 200:
-                time.sleep(sleep_delay)
-                total_delay += sleep_delay
-                logger.error('Error retrieving bibcode {0} from Solr ({1} {2}), sleeping {3}s, for a total delay of {4}s'.
-                             format(s, r.status_code, r.text, sleep_delay, total_delay))
-                continue
+    # check that the astronomy records have made it into solr; several randomly selected bibcodes are checked,
+    # in case some had ingest issues
+    min_found = max(1, int(math.ceil(config.get('ASTRO_SAMPLE_READY_FRACTION', 0.8) * len(sample))))
 
-            numfound = r.json()['response']['numFound']
-            if numfound == 0:
-                # nothing found - if all bibcodes in the sample were tried, sleep then start the while loop again
-                if num_sampled == config.get('ASTRO_SAMPLE_SIZE'):
-                    time.sleep(sleep_delay)
-                    total_delay += sleep_delay
-                    logger.warning('Astronomy ingest not complete for all in sample (sample: {0}). Sleeping {1}s, for a total delay of {2}s.'
-                                   .format(sample, sleep_delay, total_delay))
-                # if we haven't tried the others in the same, try the rest
-                else:
-                    logger.info(
-                        'Astronomy ingest not complete (test astro bibcode: {0}). Trying the next in the sample.'
-                        .format(s))
-                continue
-            elif numfound > 1:
-                # returning this as true for now, since technically something was found
-                logger.error('Too many records returned for bibcode {0}'.format(s))
+    def _sample_found():
+        found = _find_bibcodes(sample)
+        if found is None:
+            return None
+        if len(found) < min_found:
+            logger.warning('Astronomy ingest not complete: {0} of {1} sampled bibcodes found (sample: {2}). Retrying.'
+                           .format(len(found), len(sample), sample))
+            return None
 
-            logger.info('Numfound: {0} for test bibcode {1}. Response: {2}. URL: {3}'.format(numfound, s,
-                                                                                             json.dumps(r.json()),
-                                                                                             r.url))
-            return s
+        logger.info('Found {0} of {1} sampled bibcodes in Solr: {2}'.format(len(found), len(sample), found))
+        return found[0]
+
+    test_bibcode = watch.wait_until(_sample_found, sleep_timeout,
+                                    min_delay=min(sleep_delay, config.get('SOLR_PROBE_MIN_DELAY', 15)),
+                                    max_delay=sleep_delay)
+    if test_bibcode:
+        return test_bibcode
 
     logger.warning('Astronomy ingest did not complete within the {0}s timeout limit. Exiting.'.format(sleep_timeout))
 
     return None
 
 
+def _sample_astro_records(astro_file, sample_size):
+    """
+    Draws a uniform random sample of bibcodes from the astronomy ingest file in a single pass (reservoir sampling)
+    :param astro_file: path to the astronomy bibcode list
+    :param sample_size: number of bibcodes to sample
+    :return: tuple of (number of records in the file, list of sampled bibcodes)
+    """
+    sample = []
+    num_records = 0
+    with open(astro_file, 'r') as flist:
+        for l in flist:
+            # sample line: 2019A&A...632A..94J     K58-37447
+            fields = l.split(None, 1)
+            if not fields:
+                continue
+            num_records += 1
+            if len(sample) < sample_size:
+                sample.append(fields[0])
+            else:
+                i = random.randint(0, num_records - 1)
+                if i < sample_size:
+                    sample[i] = fields[0]
+
+    return num_records, sample
+
+
+def _find_bibcodes(bibcodes):
+    """
+    Checks which of the given bibcodes are in Solr, using a single query
+    :param bibcodes: list of bibcodes
+    :return: list of the bibcodes found, in the given order, or None if Solr returned an error
+    """
+    q = 'identifier:({0})'.format(' OR '.join('"{0}"'.format(b) for b in bibcodes))
+    r = app.client.get(config.get('API_SOLR_QUERY_ENDPOINT'),
+                       params={'q': q, 'fl': 'bibcode,identifier', 'rows': len(bibcodes)},
+                       headers={'Authorization': 'Bearer ' + config.get('API_TOKEN')})
+    if r.status_code != 200:
+        logger.error('Error retrieving bibcodes {0} from Solr ({1} {2})'.format(bibcodes, r.status_code, r.text))
+        return None
+
+    identifiers = set()
+    for doc in r.json()['response']['docs']:
+        identifiers.add(doc.get('bibcode'))
+        identifiers.update(doc.get('identifier', []))
+
+    return [b for b in bibcodes if b in identifiers]
+
+
+def _queue_depth(conn, queue):
+    """
+    Get the number of messages waiting in a queue
+    :param conn: broker connection
+    :param queue: queue name
+    :return: number of messages, or None if the queue can't be inspected
+    """
+    try:
+        channel = conn.channel()
+        try:
+            return channel.queue_declare(queue=queue, passive=True).message_count
+        finally:
+            channel.close()
+    except Exception as e:
+        logger.warning('Could not get the depth of the {0} queue: {1}'.format(queue, e))
+        return None
+
+
+def _wait_for_queue(conn, queue, max_depth, delay, last_depth=0):
+    """
+    Pauses while a queue is deeper than max_depth. If the depth can't be checked, dispatching backs off for delay
+    seconds and the last known depth is assumed, so that a broker error doesn't lift the throttle
+    :param conn: broker connection
+    :param queue: queue name
+    :param max_depth: maximum number of messages waiting in the queue
+    :param delay: pause between checks (units=seconds)
+    :param last_depth: depth found by the previous check
+    :return: queue depth, as last known
+    """
+    depth = _queue_depth(conn, queue)
+    if depth is None:
+        time.sleep(delay)
+        depth = last_depth
+    while depth > max_depth:
+        logger.info('The {0} queue has {1} messages waiting; pausing dispatch for {2}s'.format(queue, depth, delay))
+        time.sleep(delay)
+        checked = _queue_depth(conn, queue)
+        if checked is not None:
+            depth = checked
+    return depth
+
+
+def _dispatch_tasks(users, message):
+    """
+    Submits a processing task for each user. Tasks are published in chunks over a single producer connection;
+    before each chunk, dispatching pauses while the queue of the processing task is deeper than
+    DISPATCH_MAX_QUEUE_DEPTH
+    :param users: list of user IDs
+    :param message: task message, without the user ID
+    :return: list of user IDs whose tasks could not be submitted
+    """
+    chunk_size = config.get('DISPATCH_CHUNK_SIZE', 500)
+    max_queue_depth = config.get('DISPATCH_MAX_QUEUE_DEPTH', 20000)
+    throttle_delay = config.get('DISPATCH_THROTTLE_DELAY', 5)
+    max_retries = config.get('DISPATCH_RETRIES', 3)
+    queue = tasks.task_process_myads.queue
+
+    failed_users = []
+    num_sent = 0
+    depth = 0
+    start = time.time()
+    with app.connection_for_write() as conn, app.producer_or_acquire() as producer:
+        for i in range(0, len(users), chunk_size):
+            depth = _wait_for_queue(conn, queue, max_queue_depth, throttle_delay, last_depth=depth)
+
+            for user in users[i:i + chunk_size]:
+                msg = dict(message, userid=user)
+                retries = 0
+                while True:
+                    try:
+                        tasks.task_process_myads.apply_async(args=(msg,), producer=producer)
+                        num_sent += 1
+                        break
+                    except Exception as e:
+                        # potential backpressure (we are too fast); back off before retrying
+                        if retries >= max_retries:
+                            logger.error('Failed submitting myADS processing task for user {0}: {1}'.format(user, e))
+                            failed_users.append(user)
+                            break
+                        retries += 1
+                        logger.warning('Error submitting myADS processing task for user {0}: {1}. Retry {2}'.
+                                       format(user, e, retries))
+                        time.sleep(throttle_delay * retries)
+
+            elapsed = time.time() - start
+            logger.info('Submitted {0} of {1} myADS processing tasks in {2:.1f}s ({3:.1f} tasks/s)'.
+                        format(num_sent, len(users), elapsed, num_sent / elapsed if elapsed else 0.))
+
+    return failed_users
+
+
 def process_myads(since=None, user_ids=None, user_emails=None, test_send_to=None, admin_email=None, force=False,
                   frequency='daily', test_bibcode=None, **kwargs):
     """
@@ -307,17 +457,60 @@ def process_myads(since=None, user_ids=None, user_emails=None, test_send_to=None
     logger.info('Processing {0} myADS queries since: {1}'.format(frequency, users_since_date.isoformat()))
 
     last_process_date = get_date()
+    run_id = '{0}:{1}'.format(frequency, last_process_date.isoformat())
     all_users = app.get_users(users_since_date.isoformat())
 
-    for user in all_users:
+    try:
+        num_expired = app.expire_cached_queries()
+        logger.info('Removed {0} expired query cache entries'.format(num_expired))
+    except Exception as e:
+        logger.warning('Error removing expired query cache entries: {0}'.format(e))
+
+    try:
+        for path in metrics.remove_stale(config.get('METRICS_DIR')):
+            logger.info('Removed metrics file {0} of a worker that is no longer running'.format(path))
+    except OSError as e:
+        logger.warning('Error removing stale metrics files: {0}'.format(e))
+
+    try:
+        num_setups = utils.sync_user_setups()
+    except Exception as e:
+        logger.warning('Error syncing the myADS setups: {0}'.format(e))
+        num_setups = None
+
+    if num_setups is None:
+        # the mirror may be out of date, so every user gets a task; tasks fall back to vault for unknown users
+        logger.warning('myADS setups were not synced; not filtering users by frequency')
+    else:
+        logger.info('Synced the myADS setups of {0} updated users'.format(num_setups))
+
+        # skip users that have no queries of this frequency
+        skipped = set()
+        chunk_size = config.get('USERS_CHUNK_SIZE', 1000)
+        for i in range(0, len(all_users), chunk_size):
+            skipped.update(app.get_users_without_frequency(all_users[i:i + chunk_size], frequency=frequency))
+        if skipped:
+            all_users = [u for u in all_users if u not in skipped]
+            logger.info('Skipping {0} users with no {1} myADS queries'.format(len(skipped), frequency))
+
+    if frequency == 'daily':
         try:
-            tasks.task_process_myads.delay({'userid': user, 'frequency': frequency, 'force': force,
-                                            'test_bibcode': test_bibcode})
-        except:  # potential backpressure (we are too fast)
-            time.sleep(2)
-            print 'Conn problem, retrying...', user
-            tasks.task_process_myads.delay({'userid': user, 'frequency': frequency, 'force': force,
-                                            'test_bibcode': test_bibcode})
+            num_categories = utils.precompute_arxiv_categories(run_id)
+            logger.info('Precomputed the new papers of {0} arXiv categories'.format(num_categories))
+        except Exception as e:
+            # queries on categories go to Solr instead
+            logger.warning('Error precomputing arXiv categories: {0}'.format(e))
+
+    failed_users = _dispatch_tasks(all_users, {'frequency': frequency, 'force': force,
+                                               'test_bibcode': test_bibcode, 'run_id': run_id})
+    if failed_users:
+        logger.error('Failed to submit {0} myADS processing tasks for users: {1}'.format(len(failed_users), failed_users))
+        if admin_email:
+            msg = utils.send_email(email_addr=admin_email,
+                                   payload_plain='Failed to submit processing tasks for users: {0}'.format(failed_users),
+                                   payload_html='Failed to submit processing tasks for users: {0}'.format(failed_users),
+                                   subject='myADS {0} processing: {1} users not submitted'.format(frequency,
+                                                                                                 len(failed_users)))
 
     # update last processed timestamp
     with app.session_scope() as session:
@@ -335,8 +528,10 @@ def process_myads(since=None, user_ids=None, user_emails=None, test_send_to=None
             kv.value = last_process_date.isoformat()
         session.commit()
 
-    print 'Done submitting {0} myADS processing tasks for {1} users.'.format(frequency, len(all_users))
-    logger.info('Done submitting {0} myADS processing tasks for {1} users.'.format(frequency, len(all_users)))
+    print 'Done submitting {0} myADS processing tasks for {1} users ({2} failed).'.format(frequency, len(all_users),
+                                                                                         len(failed_users))
+    logger.info('Done submitting {0} myADS processing tasks for {1} users ({2} failed).'.format(frequency, len(all_users),
+                                                                                               len(failed_users)))
 
 
 if __name__ == '__main__':